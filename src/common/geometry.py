@@ -1,18 +1,73 @@
 import pyproj
 from pyproj import CRS
-from functools import partial
+from functools import partial, lru_cache
+from multiprocessing import Pool
+import numpy as np
+import shapely
 from shapely.ops import transform
 
+@lru_cache(maxsize=None)
+def get_transformer(from_epsg: int, to_epsg: int) -> pyproj.Transformer:
+    """Returns a (cached) transformer for projecting coordinates from one CRS to another. The transformers
+    are created only once per pair of EPSG codes, as creating them is relatively slow.
+    """
+    return pyproj.Transformer.from_crs(
+        crs_from=CRS('epsg:'+ str(from_epsg)), 
+        crs_to=CRS('epsg:'+ str(to_epsg)),
+        always_xy=True)
+
 def project_geom(geom, geom_epsg: int = 4326, to_epsg: int = 3879):
     """Projects Shapely geometry object (e.g. Point or LineString) to another CRS. 
     The default conversion is from EPSG 4326 to 3879.
     """
-    from_epsg_str = 'epsg:'+ str(geom_epsg)
-    to_epsg_str = 'epsg:'+ str(to_epsg)
+    project = get_transformer(geom_epsg, to_epsg)
+    return transform(project.transform, geom)
 
-    project = pyproj.Transformer.from_crs(
-        crs_from=CRS(from_epsg_str), 
-        crs_to=CRS(to_epsg_str),
-        always_xy=True)
+def project_coords(coords: np.ndarray, geom_epsg: int = 4326, to_epsg: int = 3879) -> np.ndarray:
+    """Projects an array of coordinates of shape (N, 2) (e.g. a coordinate buffer of many geometries) 
+    to another CRS in one call. The default conversion is from EPSG 4326 to 3879.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    x, y = get_transformer(geom_epsg, to_epsg).transform(coords[:, 0], coords[:, 1])
+    return np.column_stack((x, y))
+
+def project_geoms(geoms, geom_epsg: int = 4326, to_epsg: int = 3879) -> np.ndarray:
+    """Projects an array (or list or GeoSeries) of Shapely geometry objects to another CRS. Coordinates of 
+    all geometries are projected at once (see project_coords). The default conversion is from EPSG 4326 to 3879.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    return shapely.transform(geoms, partial(project_coords, geom_epsg=geom_epsg, to_epsg=to_epsg))
+
+def __get_intersecting_indexes(geoms: np.ndarray, extent) -> np.ndarray:
+    """Returns the indexes of the geometries that intersect with the extent polygon.
+    """
+    tree = shapely.STRtree(geoms)
+    return tree.query(extent, predicate='intersects')
+
+def get_intersects_mask(geoms, extent, processes: int = 1, empty_intersects: bool = True) -> np.ndarray:
+    """Returns a boolean array telling which of the geometries (an array or GeoSeries of Shapely 
+    geometries) intersect with the extent polygon (in the same CRS). Instead of testing the geometries 
+    one by one, the (prepared) extent is queried against a spatial index (STRtree) of the geometries. 
+    Empty geometries are regarded as intersecting by default (i.e. they are kept if the mask is used 
+    for clipping features to the extent).
+
+    If processes > 1, the geometries are split to as many spatial chunks (by x coordinate) 
+    that are queried in parallel worker processes.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    shapely.prepare(extent)
+    mask = np.zeros(len(geoms), dtype=bool)
+
+    if (processes > 1 and len(geoms) > processes):
+        order = np.argsort(shapely.bounds(geoms)[:, 0])
+        chunks = np.array_split(order, processes)
+        with Pool(processes=processes) as pool:
+            chunk_indexes = pool.starmap(__get_intersecting_indexes, [(geoms[chunk], extent) for chunk in chunks])
+        for chunk, indexes in zip(chunks, chunk_indexes):
+            mask[chunk[indexes]] = True
+    elif (len(geoms) > 0):
+        mask[__get_intersecting_indexes(geoms, extent)] = True
 
-    return transform(project.transform, geom) 
+    if (empty_intersects == True):
+        mask[shapely.is_empty(geoms) | shapely.is_missing(geoms)] = True
+    return mask
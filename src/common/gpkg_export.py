@@ -0,0 +1,65 @@
+from queue import Queue
+from threading import Thread
+import geopandas as gpd
+from common.logger import Logger
+
+class GpkgExportQueue:
+    """A queue for writing GeoDataFrames to GeoPackage layers in a background thread, so that (debug) exports
+    do not block the processing. Layers are written one at a time in the order in which they were added
+    to the queue. The queue should be closed (or used as a context manager) to wait for the pending exports.
+
+    Attributes:
+        log (optional): A Logger object for logging the exports.
+    """
+
+    def __init__(self, log: Logger = None):
+        self.log = log
+        self.errors = []
+        self.__queue = Queue()
+        self.__thread = Thread(target=self.__write_layers, daemon=True)
+        self.__thread.start()
+
+    def export(self, gdf: gpd.GeoDataFrame, gpkg: str, layer: str, mode: str = 'w', copy: bool = True) -> None:
+        """Adds a GeoDataFrame to the queue for writing it to a layer of a GeoPackage file. A copy (snapshot)
+        of the GeoDataFrame is queued by default, so that it can be modified while waiting for the export.
+        Copying can be skipped for GeoDataFrames that are not used after the call (e.g. results of drop()).
+        """
+        self.__queue.put((gdf.copy() if copy else gdf, gpkg, layer, mode))
+
+    def __write_layers(self) -> None:
+        while True:
+            item = self.__queue.get()
+            if (item is None):
+                self.__queue.task_done()
+                break
+            gdf, gpkg, layer, mode = item
+            try:
+                gdf.to_file(gpkg, layer=layer, driver='GPKG', mode=mode)
+                if (self.log is not None): self.log.debug(f'exported {len(gdf.index)} features to {gpkg} (layer={layer})')
+            except Exception as e:
+                self.errors.append(e)
+                if (self.log is not None): self.log.error(f'failed to export layer {layer} to {gpkg}: {e}')
+            finally:
+                self.__queue.task_done()
+
+    def wait(self) -> None:
+        """Blocks until all queued layers have been written.
+        """
+        self.__queue.join()
+
+    def close(self, raise_errors: bool = True) -> None:
+        """Waits for the pending exports and stops the writer thread. Raises the first error of the exports, if any
+        (and raise_errors is True).
+        """
+        if (self.__thread.is_alive()):
+            self.__queue.put(None)
+            self.__thread.join()
+        if (self.errors and raise_errors):
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # errors of the exports are not raised over an exception raised within the with block
+        self.close(raise_errors=exc_type is None)
@@ -1,7 +1,11 @@
 """igraph I/O utilities for green paths route planner.
 
 This module provides functions for both loading and exporting street network graph
-files for Green Paths route planner. External graph files use GraphML text format. 
+files for Green Paths route planner. External graph files use GraphML text format. Alternatively,
+graphs can be exported to (and loaded from) a columnar binary format, in which node and edge attributes 
+are stored as typed columns of GeoParquet files (geometries as WKB). For sharing a loaded graph
+between processes, numeric attributes and geometries can be exported to a snapshot file of flat arrays
+that can be memory-mapped. 
 
 An important export of the module are Enum classes that include names of edge and node attributes.
 The values of the enums are used as attribute names in the graph objects as well as in the exported 
@@ -12,13 +16,24 @@ is read to pandas DataFrame object.
 """
 
 import ast
+import os
+import gzip
+import json
+import shutil
+import hashlib
 from enum import Enum
-from typing import List, Dict
+from typing import List, Dict, NamedTuple
+from xml.sax.saxutils import escape
+import numpy as np
+import pandas as pd
 import geopandas as gpd
 import igraph as ig
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pyproj import CRS
+import shapely
 from shapely import wkt
-from shapely.geometry import LineString
+from shapely.geometry import Point, LineString, GeometryCollection
 
 
 # enum names are used as dataframe column names 
@@ -62,6 +77,7 @@ class Edge(Enum):
    noises: Dict[int, float] = 'n' # nodata = None, no noises = {}
    noise_source: NoiseSource = 'ns' # nodata = None, no noises = ''
    noise_sources: Dict[NoiseSource, int] = 'nss' # nodata = None, no noises = {}
+   noise_bins: np.ndarray = 'nb' # noises as exposures to noise_bins (float32 array), nodata = NaN, no noises = 0.0
    aqi: float = 'aqi' # air quality index
    gvi_gsv: float = 'g_gsv' # mean green view index (GVI) calculated from Google Street View (GSV) images
    gvi_low_veg_share: float = 'g_lv' # share of low (<2m) vegetation in 30m buffer around edge
@@ -71,6 +87,10 @@ class Edge(Enum):
    gvi: float = 'g' # combined GVI to use in routing (one of the above two)
 
 
+# lower limits of the dB classes of the dense (fixed-bin) representation of noise exposures (Edge.noise_bins)
+noise_bins = [40, 45, 50, 55, 60, 65, 70, 75]
+
+
 def to_str(value):
     return str(value) if value != 'None' else None
 def to_int(value):
@@ -85,6 +105,77 @@ def to_dict(value):
    return ast.literal_eval(value) if value != 'None' else None
 def to_tuple(value):
    return ast.literal_eval(value) if value != 'None' else None
+def to_noise_bins(value):
+   return np.fromstring(value.strip('[]'), dtype=np.float32, sep=' ') if value != 'None' else None
+
+
+def noises_to_bins(noises: Dict[int, float]) -> np.ndarray:
+    """Converts noise exposures from dictionary form (e.g. { 45: 13.2, 50: 22.1 }) to a float32 array of 
+    exposures to the dB classes of noise_bins. dB values are floored to the classes (e.g. 47 -> 45), 
+    thus the conversion is lossy for adjusted dB values. Nodata (None) noises are converted to NaN array. 
+    """
+    bins = np.zeros(len(noise_bins), dtype=np.float32)
+    if noises is None:
+        bins[:] = np.nan
+        return bins
+    for db, exposure in noises.items():
+        bins[min(max(int(db - noise_bins[0]) // 5, 0), len(noise_bins) - 1)] += exposure
+    return bins
+
+
+def bins_to_noises(bins: np.ndarray) -> Dict[int, float]:
+    """Converts noise exposures from array form (see noises_to_bins) to dictionary form. 
+    """
+    if bins is None or np.isnan(bins[0]):
+        return None
+    return { db: round(float(exposure), 5) for db, exposure in zip(noise_bins, bins) if exposure }
+
+
+def get_noise_bin_matrix(noises: List[Dict[int, float]]) -> np.ndarray:
+    """Returns noise exposures of a list of edges as one (len(noises), len(noise_bins)) float32 matrix.
+    """
+    matrix = np.zeros((len(noises), len(noise_bins)), dtype=np.float32)
+    for idx, edge_noises in enumerate(noises):
+        matrix[idx] = noises_to_bins(edge_noises)
+    return matrix
+
+
+# bulk converters decode a whole attribute (list of text values) at once
+
+__bool_by_text = { 'True': True, 'False': False, 'None': None }
+
+def to_str_list(values: list) -> list:
+    return [value if value != 'None' else None for value in values]
+def to_int_list(values: list) -> list:
+    if 'None' in values: return [to_int(value) for value in values]
+    return np.array(values, dtype=np.int64).tolist()
+def to_float_list(values: list) -> list:
+    if 'None' in values: return [to_float(value) for value in values]
+    return np.array(values, dtype=np.float64).tolist()
+def to_geom_list(values: list) -> list:
+    return list(gpd.GeoSeries.from_wkt([value if value != 'None' else None for value in values]))
+def to_bool_list(values: list) -> list:
+    try:
+        return [__bool_by_text[value] for value in values]
+    except KeyError as e:
+        raise ValueError(f'Invalid boolean value: {e}')
+def __parse_dict(value: str, key_converter, value_converter) -> dict:
+    """Parses text of format {k1: v1, k2: v2} to a dictionary."""
+    if value == 'None': return None
+    if value == '{}': return {}
+    items = [item.split(': ') for item in value[1:-1].split(', ')]
+    return { key_converter(k): value_converter(v) for k, v in items }
+def to_noises_list(values: list) -> list:
+    """E.g. '{45: 13.2, 50: 22.1}' -> { 45: 13.2, 50: 22.1 }"""
+    return [__parse_dict(value, int, float) for value in values]
+def to_noise_sources_list(values: list) -> list:
+    """E.g. "{'road': 3, 'train': 6}" -> { 'road': 3, 'train': 6 }"""
+    return [__parse_dict(value, lambda k: k.strip('\''), int) for value in values]
+def to_noise_bins_list(values: list) -> list:
+    return [to_noise_bins(value) for value in values]
+def to_uv_list(values: list) -> list:
+    """E.g. '(1, 2)' -> (1, 2)"""
+    return [tuple(int(id) for id in value[1:-1].split(', ')) if value != 'None' else None for value in values]
 
 
 __value_converter_by_edge_attribute = {
@@ -109,6 +200,7 @@ __value_converter_by_edge_attribute = {
     Edge.noises: to_dict,
     Edge.noise_source: to_str,
     Edge.noise_sources: to_dict,
+    Edge.noise_bins: to_noise_bins,
     Edge.aqi: to_float,
     Edge.gvi_gsv: to_float,
     Edge.gvi_low_veg_share: to_float,
@@ -129,11 +221,139 @@ __value_converter_by_node_attribute = {
     Node.traffic_light: to_bool,
 }
 
+__bulk_converter_by_edge_attribute = {
+    Edge.id_ig: to_int_list,
+    Edge.id_otp: to_str_list,
+    Edge.id_way: to_int_list,
+    Edge.uv: to_uv_list,
+    Edge.name_otp: to_str_list,
+    Edge.geometry: to_geom_list,
+    Edge.geom_wgs: to_geom_list,
+    Edge.length: to_float_list,
+    Edge.length_b: to_float_list,
+    Edge.edge_class: to_str_list,
+    Edge.street_class: to_str_list,
+    Edge.is_stairs: to_bool_list,
+    Edge.is_no_thru_traffic: to_bool_list,
+    Edge.allows_walking: to_bool_list,
+    Edge.allows_biking: to_bool_list,
+    Edge.traversable_walking: to_bool_list,
+    Edge.traversable_biking: to_bool_list,
+    Edge.bike_safety_factor: to_float_list,
+    Edge.noises: to_noises_list,
+    Edge.noise_source: to_str_list,
+    Edge.noise_sources: to_noise_sources_list,
+    Edge.noise_bins: to_noise_bins_list,
+    Edge.aqi: to_float_list,
+    Edge.gvi_gsv: to_float_list,
+    Edge.gvi_low_veg_share: to_float_list,
+    Edge.gvi_high_veg_share: to_float_list,
+    Edge.gvi_comb_gsv_veg: to_float_list,
+    Edge.gvi_comb_gsv_high_veg: to_float_list,
+    Edge.gvi: to_float_list
+}
+
+__bulk_converter_by_node_attribute = {
+    Node.id_ig: to_int_list,
+    Node.id_otp: to_str_list,
+    Node.name_otp: to_str_list,
+    Node.geometry: to_geom_list,
+    Node.geom_wgs: to_geom_list,
+    Node.traversable_walking: to_bool_list,
+    Node.traversable_biking: to_bool_list,
+    Node.traffic_light: to_bool_list,
+}
+
+
+__graphml_header = '''<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns
+         http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">
+'''
+
+__xml_quote_entity = { '"': '&quot;' }
+
+
+# arrow types of the attributes in the columnar (GeoParquet) graph files, geometries are stored as WKB
+
+__arrow_type_by_edge_attribute = {
+    Edge.id_ig: pa.int64(),
+    Edge.id_otp: pa.string(),
+    Edge.id_way: pa.int64(),
+    Edge.uv: pa.list_(pa.int64()),
+    Edge.name_otp: pa.string(),
+    Edge.geometry: pa.binary(),
+    Edge.geom_wgs: pa.binary(),
+    Edge.length: pa.float64(),
+    Edge.length_b: pa.float64(),
+    Edge.edge_class: pa.string(),
+    Edge.street_class: pa.string(),
+    Edge.is_stairs: pa.bool_(),
+    Edge.is_no_thru_traffic: pa.bool_(),
+    Edge.allows_walking: pa.bool_(),
+    Edge.allows_biking: pa.bool_(),
+    Edge.traversable_walking: pa.bool_(),
+    Edge.traversable_biking: pa.bool_(),
+    Edge.bike_safety_factor: pa.float64(),
+    Edge.noises: pa.map_(pa.int32(), pa.float64()),
+    Edge.noise_source: pa.string(),
+    Edge.noise_sources: pa.map_(pa.string(), pa.int64()),
+    Edge.noise_bins: pa.list_(pa.float32(), len(noise_bins)),
+    Edge.aqi: pa.float64(),
+    Edge.gvi_gsv: pa.float64(),
+    Edge.gvi_low_veg_share: pa.float64(),
+    Edge.gvi_high_veg_share: pa.float64(),
+    Edge.gvi_comb_gsv_veg: pa.float64(),
+    Edge.gvi_comb_gsv_high_veg: pa.float64(),
+    Edge.gvi: pa.float64()
+}
+
+__arrow_type_by_node_attribute = {
+    Node.id_ig: pa.int64(),
+    Node.id_otp: pa.string(),
+    Node.name_otp: pa.string(),
+    Node.geometry: pa.binary(),
+    Node.geom_wgs: pa.binary(),
+    Node.traversable_walking: pa.bool_(),
+    Node.traversable_biking: pa.bool_(),
+    Node.traffic_light: pa.bool_(),
+}
+
+# EPSG codes of the geometry attributes, written to the GeoParquet metadata
+__epsg_by_geom_attribute = {
+    'geom': 3879,
+    'geom_wgs': 4326
+}
+
+
+def __to_geom_values(values: list) -> list:
+    """Returns geometries decoded from raw WKT text or WKB values (or the values as such if they are not raw)."""
+    if any(isinstance(value, str) for value in values):
+        return to_geom_list(values)
+    if any(isinstance(value, bytes) for value in values):
+        return list(gpd.GeoSeries.from_wkb(values))
+    return values
+
+
+def decode_raw_geoms(seq, attrs: List[Enum]) -> None:
+    """Decodes geometry attributes that were left as raw WKT text by read_graphml or as raw WKB by read_graph_arrow 
+    (decode_geoms=False). The decoded geometries are updated to the given vertex or edge sequence (G.vs or G.es), 
+    hence the decoding is done only on the first access of the geometries. 
+    """
+    for attr in attrs:
+        if (attr.value not in __epsg_by_geom_attribute or attr.value not in seq.attribute_names()):
+            continue
+        values = seq[attr.value]
+        if any(isinstance(value, (str, bytes)) for value in values):
+            seq[attr.value] = __to_geom_values(values)
+
 
 def get_edge_dicts(G: ig.Graph, attrs: List[Enum] = [Edge.geometry]) -> list:
     """Returns all edges of a graph as a list of dictionaries. Only the selected attributes (attrs)
     are included in the dictionaries. 
     """
+    decode_raw_geoms(G.es, attrs)
     edge_dicts = []
     for edge in G.es:
         edge_attrs = edge.attributes()
@@ -146,37 +366,68 @@ def get_edge_dicts(G: ig.Graph, attrs: List[Enum] = [Edge.geometry]) -> list:
     return edge_dicts
 
 
+def __get_ig_attr_values(seq, attr: str) -> list:
+    """Returns the values of an igraph property (e.g. index, source or target) of all vertices or edges.
+    """
+    if (attr == 'index'):
+        return list(range(len(seq)))
+    if (attr in ['source', 'target'] and isinstance(seq, ig.EdgeSeq)):
+        edge_list = seq.graph.get_edgelist()
+        return [uv[0] for uv in edge_list] if attr == 'source' else [uv[1] for uv in edge_list]
+    return [getattr(item, attr) for item in seq]
+
+
+def __get_gdf(
+    seq, 
+    ig_class, 
+    id_attr: Enum, 
+    attrs: List[Enum], 
+    ig_attrs: List[str], 
+    geom_attr: Enum, 
+    epsg: int,
+    geom_buffers: dict = None
+) -> gpd.GeoDataFrame:
+    """Builds a (Geo)DataFrame from whole attribute columns of a vertex or edge sequence (G.vs or G.es).
+    """
+    decode_raw_geoms(seq, [geom_attr] + attrs if geom_attr else attrs)
+    attr_names = seq.attribute_names()
+    ids = seq[id_attr.value] if id_attr else list(range(len(seq)))
+
+    columns = {}
+    if geom_attr and geom_buffers and geom_attr in geom_buffers:
+        columns[geom_attr.name] = get_buffer_geoms(geom_buffers[geom_attr])
+    elif geom_attr:
+        columns[geom_attr.name] = seq[geom_attr.value]
+
+    for attr in attrs:
+        if attr.value in attr_names:
+            columns[attr.name] = seq[attr.value]
+
+    for attr in ig_attrs:
+        if (hasattr(ig_class, attr)):
+            columns[attr] = __get_ig_attr_values(seq, attr)
+
+    if not geom_attr:
+        return pd.DataFrame(columns, index=ids)
+
+    return gpd.GeoDataFrame(columns, geometry=geom_attr.name, index=ids, crs=CRS.from_epsg(epsg))
+
+
 def get_edge_gdf(
     G: ig.Graph, 
     id_attr: Enum = None, 
     attrs: List[Enum] = [], 
     ig_attrs: List[str] = [], 
     geom_attr: Enum = Edge.geometry, 
-    epsg: int = 3879
+    epsg: int = 3879,
+    geom_buffers: Dict[Edge, 'GeometryBuffer'] = None
 ) -> gpd.GeoDataFrame:
     """Returns all edges of a graph as GeoPandas GeoDataFrame. The default is to load the projected geometry,
-    but it can be overridden by defining another geom_attr and the corresponding epsg. 
+    but it can be overridden by defining another geom_attr and the corresponding epsg. If geom_attr is None, 
+    the edges are returned as pandas DataFrame without geometry. If geometry buffers (see get_geometry_buffers)
+    are given, the geometries are built from them instead of the edge attributes. 
     """
-
-    edge_dicts = []
-    ids = []
-    for edge in G.es:
-        edge_dict = {}
-        edge_attrs = edge.attributes()
-        ids.append(edge_attrs[id_attr.value] if id_attr else edge.index)
-        edge_dict[geom_attr.name] = edge_attrs[geom_attr.value]
-        
-        for attr in attrs:
-            if attr.value in edge_attrs:
-                edge_dict[attr.name] = edge_attrs[attr.value]
-
-        for attr in ig_attrs:
-            if (hasattr(edge, attr)):
-                edge_dict[attr] = getattr(edge, attr)
-        
-        edge_dicts.append(edge_dict)
-
-    return gpd.GeoDataFrame(edge_dicts, geometry=geom_attr.name, index=ids, crs=CRS.from_epsg(epsg))
+    return __get_gdf(G.es, ig.Edge, id_attr, attrs, ig_attrs, geom_attr, epsg, geom_buffers)
 
 
 def get_node_gdf(
@@ -188,60 +439,190 @@ def get_node_gdf(
     epsg: int = 3879
 ) -> gpd.GeoDataFrame:
     """Returns all nodes of a graph as pandas GeoDataFrame. The default is to load the projected geometry,
-    but it can be overridden by defining another geom_attr and a corresponding epsg. 
+    but it can be overridden by defining another geom_attr and a corresponding epsg. If geom_attr is None, 
+    the nodes are returned as pandas DataFrame without geometry. 
     """
-    
-    node_dicts = []
-    ids = []
-    for node in G.vs:
-        node_dict = {}
-        node_attrs = node.attributes()
-        ids.append(node_attrs[id_attr.value] if id_attr else node.index)
-        node_dict[geom_attr.name] = node_attrs[geom_attr.value]
+    return __get_gdf(G.vs, ig.Vertex, id_attr, attrs, ig_attrs, geom_attr, epsg)
 
-        for attr in attrs:
-            if attr.value in node_attrs:
-                node_dict[attr.name] = node_attrs[attr.value]
-        
-        for attr in ig_attrs:
-            if (hasattr(node, attr)):
-                node_dict[attr] = getattr(node, attr)
-        
-        node_dicts.append(node_dict)
 
-    return gpd.GeoDataFrame(node_dicts, geometry=geom_attr.name, index=ids, crs=CRS.from_epsg(epsg))
+def __decode_values(values: list, bulk_converter, converter, bulk_decode: bool, attr: str = '', log = None) -> list:
+    """Decodes a list of text values of an attribute with the bulk converter (if bulk_decode is True)
+    or value by value with the converter. Falls back to the converter if the bulk converter cannot
+    parse the values (raises ValueError or TypeError). 
+    """
+    if bulk_decode:
+        try:
+            return bulk_converter(values)
+        except (ValueError, TypeError) as e:
+            if log: log.debug(f'Bulk decoding of attribute {attr} failed ({e}), decoding values one by one')
+    return [converter(value) for value in values]
 
 
-def read_graphml(graph_file: str, log = None) -> ig.Graph:
+def read_graphml(
+    graph_file: str, 
+    log = None, 
+    bulk_decode: bool = True, 
+    n_attrs: List[Node] = [], 
+    e_attrs: List[Edge] = [], 
+    decode_geoms: bool = True,
+    cache_dir: str = None,
+    cache_size_limit_mb: int = 5000
+) -> ig.Graph:
     """Loads an igraph graph object from GraphML file, including all edge and node
-    attributes that are found in the data and recognized by this module. 
+    attributes that are found in the data and recognized by this module. If edge or node 
+    attributes are specified (n_attrs, e_attrs), only the selected attributes are decoded 
+    and other attributes are deleted from the graph. 
+    
+    Gzip compressed GraphML files (ending with .gz) are decompressed before reading. 
+    If decode_geoms is False, geometry attributes are left as raw WKT text that is decoded 
+    on first access by get_edge_dicts, get_edge_gdf or get_node_gdf (see decode_raw_geoms). 
     
     Since all attributes are saved in text format, an attribute specific converter must be found 
     in the dictionary __value_converter_by_node_attribute for each attribute. 
-    Attributes for which a converter is not found are omitted. 
+    Attributes for which a converter is not found are omitted. By default, the attributes are 
+    decoded a whole column at a time by the converters in __bulk_converter_by_node_attribute 
+    (and edge attribute), which can be disabled by setting bulk_decode to False. 
+
+    If cache_dir is given, the decoded graph is cached to the directory in the columnar 
+    format of export_graph_arrow, keyed by the size, modification time and content hash of 
+    the graph file as well as the selected attributes and decode_geoms. Later reads of the same graph file 
+    (and arguments) are loaded from the cache, in which case raw geometries (decode_geoms=False) are read as WKB 
+    instead of WKT text. Least recently used cache entries 
+    are deleted when the total size of the cache exceeds cache_size_limit_mb (see also clear_graph_cache). 
     """
+
+    if cache_dir:
+        cache_entry = os.path.join(cache_dir, __get_graph_cache_key(graph_file, n_attrs, e_attrs, decode_geoms))
+        if os.path.isdir(cache_entry):
+            os.utime(cache_entry)
+            if log: log.debug(f'Reading graph from cache {cache_entry}')
+            return read_graph_arrow(cache_entry, log, decode_geoms)
     
     G = ig.Graph()
-    G = G.Read_GraphML(graph_file)
+    G = G.Read_GraphMLz(graph_file) if graph_file.endswith('.gz') else G.Read_GraphML(graph_file)
     del(G.vs['id'])
 
+    n_attr_names = [attr.value for attr in n_attrs]
+    e_attr_names = [attr.value for attr in e_attrs]
+    geom_attr_names = [] if decode_geoms else list(__epsg_by_geom_attribute.keys())
+
     for attr in G.vs[0].attributes():
+        if (n_attrs and attr not in n_attr_names):
+            del(G.vs[attr])
+            continue
+        if (attr in geom_attr_names):
+            G.vs[attr] = to_str_list(G.vs[attr])
+            continue
         try:
             converter = __value_converter_by_node_attribute[Node(attr)]
-            G.vs[attr] = [converter(value) for value in list(G.vs[attr])]
+            bulk_converter = __bulk_converter_by_node_attribute[Node(attr)]
+            G.vs[attr] = __decode_values(list(G.vs[attr]), bulk_converter, converter, bulk_decode, attr, log)
         except Exception:
             if log: log.warning(f'Failed to read node attribute {attr}')
             
     for attr in G.es[0].attributes():
+        if (e_attrs and attr not in e_attr_names):
+            del(G.es[attr])
+            continue
+        if (attr in geom_attr_names):
+            G.es[attr] = to_str_list(G.es[attr])
+            continue
         try:
             converter = __value_converter_by_edge_attribute[Edge(attr)]
-            G.es[attr] = [converter(value) for value in list(G.es[attr])]
+            bulk_converter = __bulk_converter_by_edge_attribute[Edge(attr)]
+            G.es[attr] = __decode_values(list(G.es[attr]), bulk_converter, converter, bulk_decode, attr, log)
         except Exception:
             if log: log.warning(f'Failed to read edge attribute {attr}')
 
+    if cache_dir:
+        __write_graph_cache(G, graph_file, cache_entry, cache_size_limit_mb, log)
+
     return G
 
 
+def __get_graph_cache_key(graph_file: str, n_attrs: List[Node], e_attrs: List[Edge], decode_geoms: bool) -> str:
+    """Returns a cache key (hash) of the size, modification time and content of the graph file,
+    the names of the selected attributes and the decode_geoms flag.
+    """
+    stat = os.stat(graph_file)
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(graph_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(chunk)
+    key = json.dumps([
+        stat.st_size, 
+        stat.st_mtime_ns, 
+        content_hash.hexdigest(), 
+        sorted(attr.value for attr in n_attrs), 
+        sorted(attr.value for attr in e_attrs),
+        decode_geoms
+    ])
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def __get_dir_size(dir_path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(dir_path) if entry.is_file())
+
+
+def __write_graph_cache(G: ig.Graph, graph_file: str, cache_entry: str, cache_size_limit_mb: int, log = None) -> None:
+    """Writes the graph to a cache entry and deletes least recently used entries if the total 
+    size of the cache exceeds the limit. 
+    """
+    cache_dir = os.path.dirname(cache_entry)
+    temp_entry = f'{cache_entry}.tmp{os.getpid()}'
+    export_graph_arrow(G, temp_entry)
+    with open(os.path.join(temp_entry, 'source.json'), 'w') as f:
+        json.dump({ 'graph_file': os.path.abspath(graph_file) }, f)
+    try:
+        os.rename(temp_entry, cache_entry)
+    except OSError:
+        # written by another process in the meanwhile
+        shutil.rmtree(temp_entry, ignore_errors=True)
+    if log: log.debug(f'Wrote graph to cache {cache_entry}')
+
+    entries = [entry for entry in os.scandir(cache_dir) if entry.is_dir() and '.tmp' not in entry.name]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    sizes = { entry.path: __get_dir_size(entry.path) for entry in entries }
+    total_size = sum(sizes.values())
+    for entry in entries:
+        if total_size <= cache_size_limit_mb * 1024 * 1024 or entry.path == cache_entry:
+            break
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total_size -= sizes[entry.path]
+        if log: log.debug(f'Deleted least recently used cache entry {entry.path}')
+
+
+def clear_graph_cache(cache_dir: str, graph_file: str = None) -> int:
+    """Deletes all entries from the graph cache (see read_graphml) or only the entries of the given 
+    graph file. Returns the number of deleted entries. 
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    deleted_count = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir(): continue
+        if graph_file:
+            try:
+                with open(os.path.join(entry.path, 'source.json')) as f:
+                    if json.load(f)['graph_file'] != os.path.abspath(graph_file): continue
+            except Exception:
+                continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+        deleted_count += 1
+    return deleted_count
+
+
+def __get_graphml_key(key_id: str, domain: str, attr_name: str) -> str:
+    return f'  <key id="{key_id}" for="{domain}" attr.name="{escape(attr_name, __xml_quote_entity)}" attr.type="string"/>\n'
+
+
+def __get_graphml_data(key_ids: Dict[str, str], attrs: dict, indent: str) -> str:
+    return ''.join(
+        f'{indent}<data key="{key_id}">{escape(str(attrs[attr_name]))}</data>\n' 
+        for attr_name, key_id in key_ids.items()
+    )
+
+
 def export_to_graphml(
     G: ig.Graph, 
     graph_file: str, 
@@ -251,33 +632,480 @@ def export_to_graphml(
     """Writes the given graph object to a text file in GraphML format. Only the
     selected edge and node attributes are included in the export if some are specified. 
     If no edge or node attributes are specified, all found attributes are exported. 
-    Attribute values are written as text, converted by str(value). 
+    Attribute values are written as text, converted by str(value). The file is gzip 
+    compressed if the name of the file ends with .gz. 
+
+    Nodes and edges are written to the file one by one, so that neither the graph
+    nor its attributes (as text) need to be copied in memory during the export. 
+    """
+
+    n_attr_names = [attr.value for attr in n_attrs] if n_attrs else G.vs.attribute_names()
+    e_attr_names = [attr.value for attr in e_attrs] if e_attrs else G.es.attribute_names()
+    g_key_ids = { name: f'g_{name}' for name in G.attributes() }
+    n_key_ids = { name: f'v_{name}' for name in n_attr_names }
+    e_key_ids = { name: f'e_{name}' for name in e_attr_names }
+
+    open_file = gzip.open if graph_file.endswith('.gz') else open
+
+    with open_file(graph_file, 'wt', encoding='utf-8') as f:
+        f.write(__graphml_header)
+        for name, key_id in g_key_ids.items():
+            f.write(__get_graphml_key(key_id, 'graph', name))
+        for name, key_id in n_key_ids.items():
+            f.write(__get_graphml_key(key_id, 'node', name))
+        for name, key_id in e_key_ids.items():
+            f.write(__get_graphml_key(key_id, 'edge', name))
+
+        f.write(f'  <graph id="G" edgedefault="{"directed" if G.is_directed() else "undirected"}">\n')
+        f.write(__get_graphml_data(g_key_ids, { name: G[name] for name in G.attributes() }, '    '))
+
+        for node in G.vs:
+            f.write(f'    <node id="n{node.index}">\n')
+            f.write(__get_graphml_data(n_key_ids, node.attributes(), '      '))
+            f.write('    </node>\n')
+
+        for edge in G.es:
+            f.write(f'    <edge source="n{edge.source}" target="n{edge.target}">\n')
+            f.write(__get_graphml_data(e_key_ids, edge.attributes(), '      '))
+            f.write('    </edge>\n')
+
+        f.write('  </graph>\n</graphml>\n')
+
+
+def __to_arrow_array(values: list, arrow_type: pa.DataType) -> pa.Array:
+    """Converts a list of attribute values to a typed arrow array. 
+    """
+    if arrow_type == pa.binary():
+        # raw (not yet decoded) geometries are decoded only for the export
+        return pa.array(gpd.GeoSeries(__to_geom_values(values)).to_wkb(), type=arrow_type)
+    if arrow_type == pa.string():
+        return pa.array([str(value) if value is not None else None for value in values], type=arrow_type)
+    if isinstance(arrow_type, pa.MapType):
+        # noise attributes may be held as text if they were updated to the graph from CSV files
+        values = [to_dict(value) if isinstance(value, str) else value for value in values]
+        return pa.array([list(value.items()) if value is not None else None for value in values], type=arrow_type)
+    if isinstance(arrow_type, pa.ListType):
+        return pa.array([list(value) if value is not None else None for value in values], type=arrow_type)
+    if isinstance(arrow_type, pa.FixedSizeListType):
+        nodata = np.full(arrow_type.list_size, np.nan, dtype=np.float32)
+        flat_values = np.concatenate([value if value is not None else nodata for value in values]) if values else []
+        return pa.FixedSizeListArray.from_arrays(pa.array(flat_values, type=arrow_type.value_type), arrow_type.list_size)
+    return pa.array(values, type=arrow_type)
+
+
+def __from_arrow_array(array: pa.ChunkedArray, decode_geoms: bool = True) -> list:
+    """Converts a typed arrow array (column) to a list of attribute values. Geometries are left as raw WKB
+    if decode_geoms is False. 
     """
+    if array.type == pa.binary():
+        if not decode_geoms:
+            return array.to_pylist()
+        return list(gpd.GeoSeries.from_wkb(array.to_numpy(zero_copy_only=False)))
+    if isinstance(array.type, pa.FixedSizeListType):
+        flat_values = array.combine_chunks().flatten().to_numpy(zero_copy_only=False)
+        return list(flat_values.reshape(-1, array.type.list_size))
+    values = array.to_pylist()
+    if isinstance(array.type, pa.MapType):
+        return [dict(value) if value is not None else None for value in values]
+    if isinstance(array.type, pa.ListType):
+        return [tuple(value) if value is not None else None for value in values]
+    return values
+
 
-    Gc = G.copy() # avoid mutating the original graph
+def __get_geo_metadata(column_names: List[str]) -> dict:
+    """Returns GeoParquet metadata for the geometry columns of a node or edge table.
+    """
+    geom_columns = [name for name in column_names if name in __epsg_by_geom_attribute]
+    return {
+        'version': '0.4.0',
+        'primary_column': geom_columns[0],
+        'columns': {
+            name: {
+                'encoding': 'WKB',
+                'crs': CRS.from_epsg(__epsg_by_geom_attribute[name]).to_json_dict(),
+                'geometry_type': 'Unknown'
+            } for name in geom_columns
+        }
+    }
+
+
+def __to_arrow_table(attr_values: Dict[Enum, list], arrow_types: dict, metadata: dict) -> pa.Table:
+    arrays = [__to_arrow_array(values, arrow_types[attr]) for attr, values in attr_values.items()]
+    names = [attr.value if isinstance(attr, Enum) else attr for attr in attr_values.keys()]
+    table = pa.Table.from_arrays(arrays, names=names)
+    if any(name in __epsg_by_geom_attribute for name in names):
+        metadata['geo'] = json.dumps(__get_geo_metadata(names))
+    return table.replace_schema_metadata(metadata)
+
+
+def export_graph_arrow(
+    G: ig.Graph, 
+    graph_dir: str, 
+    n_attrs: List[Node] = [], 
+    e_attrs: List[Edge] = []
+) -> None:
+    """Writes the given graph object to a directory as two GeoParquet files: nodes.parquet and edges.parquet. 
+    Only the selected edge and node attributes are included in the export if some are specified. 
+    If no edge or node attributes are specified, all found attributes are exported. Attribute values 
+    are written as typed columns named by the values of the Node and Edge enums. Source and target 
+    nodes of the edges are written to columns source and target. 
+    """
 
     if not n_attrs:
-        for attr in Node:
-            if (attr.value in Gc.vs[0].attributes()):
-                Gc.vs[attr.value] = [str(value) for value in list(Gc.vs[attr.value])]
-    else:
-        for attr in n_attrs:
-            Gc.vs[attr.value] = [str(value) for value in list(Gc.vs[attr.value])]
-        # delete unspecified attributes
-        for node_attr in G.vs.attribute_names():
-            if (node_attr not in [attr.value for attr in n_attrs]):
-                del(Gc.vs[node_attr])
-    
+        n_attrs = [attr for attr in Node if attr.value in G.vs.attribute_names()]
     if not e_attrs:
-        for attr in Edge:
-            if (attr.value in Gc.es[0].attributes()):
-                Gc.es[attr.value] = [str(value) for value in list(Gc.es[attr.value])]
-    else:
-        for attr in e_attrs:
-            Gc.es[attr.value] = [str(value) for value in list(Gc.es[attr.value])]
-        # delete unspecified attributes
-        for edge_attr in G.es.attribute_names():
-            if (edge_attr not in [attr.value for attr in e_attrs]):
-                del(Gc.es[edge_attr])
-
-    Gc.save(graph_file, format='graphml')
+        e_attrs = [attr for attr in Edge if attr.value in G.es.attribute_names()]
+
+    os.makedirs(graph_dir, exist_ok=True)
+
+    node_values = { attr: G.vs[attr.value] for attr in n_attrs }
+    node_table = __to_arrow_table(node_values, __arrow_type_by_node_attribute, {})
+    pq.write_table(node_table, os.path.join(graph_dir, 'nodes.parquet'))
+
+    edge_list = G.get_edgelist()
+    edge_values = { 
+        'source': [uv[0] for uv in edge_list], 
+        'target': [uv[1] for uv in edge_list], 
+        **{ attr: G.es[attr.value] for attr in e_attrs }
+    }
+    edge_types = { 'source': pa.int64(), 'target': pa.int64(), **__arrow_type_by_edge_attribute }
+    edge_table = __to_arrow_table(edge_values, edge_types, { 'directed': str(G.is_directed()) })
+    pq.write_table(edge_table, os.path.join(graph_dir, 'edges.parquet'))
+
+
+def read_graph_arrow(graph_dir: str, log = None, decode_geoms: bool = True) -> ig.Graph:
+    """Loads an igraph graph object from a directory of GeoParquet files written by export_graph_arrow, 
+    including all edge and node attributes that are found in the data and recognized by this module. 
+    Attributes (columns) that are not recognized by this module are omitted. If decode_geoms is False,
+    geometry attributes are left as raw WKB that is decoded on first access (see decode_raw_geoms). 
+    """
+
+    node_table = pq.read_table(os.path.join(graph_dir, 'nodes.parquet'))
+    edge_table = pq.read_table(os.path.join(graph_dir, 'edges.parquet'))
+    directed = edge_table.schema.metadata.get(b'directed', b'True') == b'True'
+
+    G = ig.Graph(directed=directed)
+    G.add_vertices(node_table.num_rows)
+    G.add_edges(zip(edge_table.column('source').to_pylist(), edge_table.column('target').to_pylist()))
+
+    for attr in node_table.column_names:
+        try:
+            G.vs[Node(attr).value] = __from_arrow_array(node_table.column(attr), decode_geoms)
+        except Exception:
+            if log: log.warning(f'Failed to read node attribute {attr}')
+
+    for attr in edge_table.column_names:
+        if attr in ('source', 'target'): continue
+        try:
+            G.es[Edge(attr).value] = __from_arrow_array(edge_table.column(attr), decode_geoms)
+        except Exception:
+            if log: log.warning(f'Failed to read edge attribute {attr}')
+
+    return G
+
+
+__snapshot_magic = b'HGSNAP01'
+__snapshot_alignment = 64
+__snapshot_dtype_by_arrow_type = {
+    pa.int64(): 'int64',
+    pa.float64(): 'float64',
+    pa.bool_(): 'bool'
+}
+# values by which None is written to the data arrays, None values are restored by validity masks (<name>_valid)
+__snapshot_nodata_by_dtype = {
+    'int64': 0,
+    'float64': np.nan,
+    'bool': False
+}
+
+
+def __get_coord_buffers(geoms: list) -> tuple:
+    """Returns the coordinates of the given geometries as a flat (n, 2) array and the offsets
+    (len(geoms) + 1) of the coordinates of each geometry in it. Empty geometries have no coordinates.
+    """
+    coords, geom_idxs = shapely.get_coordinates(np.asarray(geoms, dtype=object), return_index=True)
+    offsets = np.zeros(len(geoms) + 1, dtype=np.int64)
+    offsets[1:] = np.bincount(geom_idxs, minlength=len(geoms)).cumsum()
+    return coords, offsets
+
+
+def __get_snapshot_arrays(seq, attrs: List[Enum], arrow_types: dict, prefix: str) -> Dict[str, np.ndarray]:
+    arrays = {}
+    decode_raw_geoms(seq, attrs)
+    for attr in attrs:
+        values = seq[attr.value]
+        if attr.value in __epsg_by_geom_attribute:
+            coords, offsets = __get_coord_buffers(values)
+            arrays[f'{prefix}{attr.value}_coords'] = coords
+            arrays[f'{prefix}{attr.value}_offsets'] = offsets
+        elif attr == Edge.noises:
+            arrays[f'{prefix}{attr.value}_bins'] = get_noise_bin_matrix(values)
+        elif attr == Edge.noise_bins:
+            arrays[f'{prefix}{attr.value}'] = np.array([
+                value if value is not None else noises_to_bins(None) for value in values
+            ], dtype=np.float32).reshape(-1, len(noise_bins))
+        elif arrow_types[attr] in __snapshot_dtype_by_arrow_type:
+            dtype = __snapshot_dtype_by_arrow_type[arrow_types[attr]]
+            valid = np.array([value is not None for value in values], dtype=bool)
+            nodata = __snapshot_nodata_by_dtype[dtype]
+            arrays[f'{prefix}{attr.value}'] = np.array([
+                value if value is not None else nodata for value in values
+            ], dtype=dtype)
+            if not valid.all():
+                arrays[f'{prefix}{attr.value}_valid'] = valid
+    return arrays
+
+
+def __is_snapshot_attribute(attr: Enum, arrow_types: dict) -> bool:
+    return (
+        attr.value in __epsg_by_geom_attribute 
+        or attr in [Edge.noises, Edge.noise_bins]
+        or arrow_types[attr] in __snapshot_dtype_by_arrow_type
+    )
+
+
+def export_graph_snapshot(
+    G: ig.Graph, 
+    snapshot_file: str, 
+    n_attrs: List[Node] = [], 
+    e_attrs: List[Edge] = []
+) -> None:
+    """Writes the edge list and numeric node and edge attributes (int, float & bool) of the graph 
+    to a single binary file as flat arrays that can be memory-mapped (see load_graph_snapshot). 
+    Geometries are written as coordinate buffers and noise exposures (Edge.noises) as noise bins 
+    (see noises_to_bins). Edge.noise_bins is written as (ecount, len(noise_bins)) matrix. 
+    If no edge or node attributes are specified, all found attributes of the supported types are exported. 
+    None values of int, float and bool attributes are written as 0, NaN and False, respectively, and 
+    an additional validity mask array (<name>_valid, False for None) is written for the attributes that 
+    have None values. read_graph_snapshot restores the None values by the masks. 
+    """
+
+    if not n_attrs:
+        n_attrs = [attr for attr in Node if attr.value in G.vs.attribute_names()]
+    if not e_attrs:
+        e_attrs = [attr for attr in Edge if attr.value in G.es.attribute_names()]
+    n_attrs = [attr for attr in n_attrs if __is_snapshot_attribute(attr, __arrow_type_by_node_attribute)]
+    e_attrs = [attr for attr in e_attrs if __is_snapshot_attribute(attr, __arrow_type_by_edge_attribute)]
+
+    arrays = { 'edges': np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2) }
+    arrays.update(__get_snapshot_arrays(G.vs, n_attrs, __arrow_type_by_node_attribute, 'v_'))
+    arrays.update(__get_snapshot_arrays(G.es, e_attrs, __arrow_type_by_edge_attribute, 'e_'))
+
+    # the offsets of the arrays are relative to the beginning of the data (after the header)
+    array_meta = {}
+    offset = 0
+    for name, array in arrays.items():
+        array_meta[name] = { 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset }
+        offset += -(-array.nbytes // __snapshot_alignment) * __snapshot_alignment
+
+    header = json.dumps({ 
+        'directed': G.is_directed(), 
+        'vcount': G.vcount(), 
+        'ecount': G.ecount(), 
+        'arrays': array_meta 
+    }).encode('utf-8')
+    data_start = -(-(len(__snapshot_magic) + 8 + len(header)) // __snapshot_alignment) * __snapshot_alignment
+
+    with open(snapshot_file, 'wb') as f:
+        f.write(__snapshot_magic)
+        f.write(np.uint64(data_start).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + array_meta[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def load_graph_snapshot(snapshot_file: str) -> dict:
+    """Opens a graph snapshot written by export_graph_snapshot. Returns the metadata of the snapshot
+    (directed, vcount, ecount) and the arrays of the snapshot as read-only memory-mapped numpy arrays 
+    (under key arrays). Since the arrays are not copied to memory, many processes can share them 
+    through the page cache of the OS. 
+    """
+    with open(snapshot_file, 'rb') as f:
+        if f.read(len(__snapshot_magic)) != __snapshot_magic:
+            raise ValueError(f'{snapshot_file} is not a graph snapshot file')
+        data_start = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = f.read(data_start - len(__snapshot_magic) - 8).rstrip(b'\x00')
+
+    snapshot = json.loads(header.decode('utf-8'))
+    snapshot['arrays'] = {
+        name: np.memmap(
+            snapshot_file, 
+            dtype=np.dtype(meta['dtype']), 
+            mode='r', 
+            offset=data_start + meta['offset'], 
+            shape=tuple(meta['shape'])
+        ) if np.prod(meta['shape']) > 0 else np.empty(tuple(meta['shape']), dtype=np.dtype(meta['dtype']))
+        for name, meta in snapshot['arrays'].items()
+    }
+    return snapshot
+
+
+def __get_geoms_from_coord_buffers(coords: np.ndarray, offsets: np.ndarray, geom_type) -> list:
+    return [
+        geom_type(coords[start:end]) if end > start else GeometryCollection() 
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def read_graph_snapshot(snapshot_file: str) -> ig.Graph:
+    """Loads an igraph graph object from a graph snapshot written by export_graph_snapshot. 
+    Unlike the memory-mapped arrays of load_graph_snapshot, the attributes of the graph object
+    are copied to memory. Noise exposures are read to Edge.noises as dictionaries of noise bins
+    and Edge.noise_bins as float32 arrays.
+    """
+    snapshot = load_graph_snapshot(snapshot_file)
+    arrays = snapshot['arrays']
+
+    G = ig.Graph(directed=snapshot['directed'])
+    G.add_vertices(snapshot['vcount'])
+    G.add_edges(arrays['edges'].tolist())
+
+    for seq, prefix, attr_enum, geom_type in ((G.vs, 'v_', Node, Point), (G.es, 'e_', Edge, LineString)):
+        for name, array in arrays.items():
+            if not name.startswith(prefix): continue
+            attr = name[len(prefix):]
+            if attr.endswith('_coords'):
+                attr = attr[:-len('_coords')]
+                seq[attr] = __get_geoms_from_coord_buffers(array, arrays[f'{prefix}{attr}_offsets'], geom_type)
+            elif attr.endswith('_valid'):
+                continue
+            elif attr.endswith('_bins'):
+                seq[attr[:-len('_bins')]] = [bins_to_noises(bins) for bins in array]
+            elif array.ndim == 2:
+                seq[attr_enum(attr).value] = list(np.array(array))
+            elif not attr.endswith('_offsets'):
+                values = array.tolist()
+                if f'{name}_valid' in arrays:
+                    values = [value if valid else None for value, valid in zip(values, arrays[f'{name}_valid'].tolist())]
+                seq[attr_enum(attr).value] = values
+
+    return G
+
+
+class GeometryBuffer(NamedTuple):
+    """Coordinates of the line geometries of all edges as one flat (n, 2) float64 array and the offsets 
+    (ecount + 1) of the coordinates of each edge in it. 
+    """
+    coords: np.ndarray
+    offsets: np.ndarray
+
+
+def get_geometry_buffers(
+    G: ig.Graph, 
+    attrs: List[Edge] = [Edge.geometry, Edge.geom_wgs], 
+    delete_attrs: bool = True
+) -> Dict[Edge, GeometryBuffer]:
+    """Moves the edge geometries of the given attributes (one per CRS) to geometry buffers. This greatly reduces 
+    the memory usage of large graphs compared to holding a shapely object per edge. If delete_attrs is True,
+    the geometry attributes are deleted from the graph. Geometries can be built from the buffers on demand 
+    by get_buffer_geom and get_buffer_geoms (or restored to the graph by set_buffer_geoms). 
+    """
+    decode_raw_geoms(G.es, attrs)
+    geom_buffers = {}
+    for attr in attrs:
+        geom_buffers[attr] = GeometryBuffer(*__get_coord_buffers(G.es[attr.value]))
+        if delete_attrs:
+            del(G.es[attr.value])
+    return geom_buffers
+
+
+def get_buffer_geom(geom_buffer: GeometryBuffer, edge_id: int) -> LineString:
+    """Returns the geometry of a single edge from a geometry buffer. 
+    """
+    start, end = geom_buffer.offsets[edge_id], geom_buffer.offsets[edge_id + 1]
+    return LineString(geom_buffer.coords[start:end]) if end > start else GeometryCollection()
+
+
+def get_buffer_geoms(geom_buffer: GeometryBuffer, edge_ids: List[int] = None) -> np.ndarray:
+    """Returns the geometries of all edges (or the selected edges) from a geometry buffer as an array 
+    of shapely objects. The geometries are built in a vectorized manner. Edges without coordinates
+    get empty geometries (GeometryCollection).
+    """
+    edge_ids = np.arange(len(geom_buffer.offsets) - 1) if edge_ids is None else np.asarray(edge_ids, dtype=np.int64)
+    starts = geom_buffer.offsets[edge_ids]
+    counts = geom_buffer.offsets[edge_ids + 1] - starts
+
+    geoms = np.empty(len(edge_ids), dtype=object)
+    geoms[:] = [GeometryCollection()] * len(edge_ids)
+    has_coords = counts > 0
+    if has_coords.any():
+        # gather the coordinates of the selected edges to consecutive ranges
+        counts = counts[has_coords]
+        range_starts = np.cumsum(counts) - counts
+        coord_idxs = np.repeat(starts[has_coords] - range_starts, counts) + np.arange(counts.sum())
+        geoms[has_coords] = shapely.linestrings(
+            geom_buffer.coords[coord_idxs], 
+            indices=np.repeat(np.arange(len(counts)), counts)
+        )
+    return geoms
+
+
+def set_buffer_geoms(G: ig.Graph, geom_buffers: Dict[Edge, GeometryBuffer]) -> None:
+    """Sets geometries from geometry buffers back to the edge attributes of the graph. 
+    """
+    for attr, geom_buffer in geom_buffers.items():
+        G.es[attr.value] = list(get_buffer_geoms(geom_buffer))
+
+
+class IdMapping(NamedTuple):
+    """Mappings of previous id_ig values of edges and nodes to the new ones after re-indexing a graph 
+    (see reindex_graph), as int64 arrays indexed by the previous ids. Deleted edges and nodes are mapped to -1. 
+    """
+    edges: np.ndarray
+    nodes: np.ndarray
+
+
+def get_id_mismatch_count(seq, attr: Enum) -> int:
+    """Returns the number of edges or nodes of a sequence (G.es or G.vs) whose id_ig attribute does not 
+    match their index. 
+    """
+    if (attr.value not in seq.attribute_names()):
+        return len(seq)
+    return int(np.count_nonzero(np.array(seq[attr.value], dtype=np.int64) != np.arange(len(seq))))
+
+
+def __reindex_seq(seq, attr: Enum) -> np.ndarray:
+    indexes = np.arange(len(seq), dtype=np.int64)
+    prev_ids = np.array(seq[attr.value], dtype=np.int64) if attr.value in seq.attribute_names() else indexes
+    id_map = np.full(prev_ids.max() + 1 if len(prev_ids) else 0, -1, dtype=np.int64)
+    id_map[prev_ids] = indexes
+    seq[attr.value] = indexes.tolist()
+    return id_map
+
+
+def reindex_graph(G: ig.Graph) -> IdMapping:
+    """Reassigns igraph indexes of edges and nodes to their id_ig attributes (e.g. after deleting edges or nodes).
+    Returns the mappings of the previous ids to the new ones, so that data keyed by the previous ids can be 
+    remapped by remap_ids instead of recomputing it. 
+    """
+    return IdMapping(__reindex_seq(G.es, Edge.id_ig), __reindex_seq(G.vs, Node.id_ig))
+
+
+def remap_ids(id_map: np.ndarray, ids) -> np.ndarray:
+    """Maps ids (e.g. a column of an attribute table) by an id mapping array (e.g. IdMapping.edges) with
+    one array lookup. Ids that were deleted (or are unknown to the mapping) are mapped to -1. 
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    new_ids = np.full(len(ids), -1, dtype=np.int64)
+    known = (ids >= 0) & (ids < len(id_map))
+    new_ids[known] = id_map[ids[known]]
+    return new_ids
+
+
+def combine_id_mappings(first: IdMapping, second: IdMapping) -> IdMapping:
+    """Combines the mappings of two successive re-indexings to a mapping from the ids before the first 
+    re-indexing to the ids after the second one. 
+    """
+    return IdMapping(remap_ids(second.edges, first.edges), remap_ids(second.nodes, first.nodes))
+
+
+def save_id_mapping(id_mapping: IdMapping, mapping_file: str) -> None:
+    """Saves an id mapping to a compressed NumPy (.npz) file. 
+    """
+    np.savez_compressed(mapping_file, edges=id_mapping.edges, nodes=id_mapping.nodes)
+
+
+def load_id_mapping(mapping_file: str) -> IdMapping:
+    with np.load(mapping_file) as mapping:
+        return IdMapping(mapping['edges'], mapping['nodes'])
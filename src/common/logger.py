@@ -1,5 +1,13 @@
+import sys
 import time
+import json
+from functools import wraps
+from contextlib import contextmanager
 from datetime import datetime
+try:
+    import resource
+except ImportError:
+    resource = None
 
 class Logger:
     """A simple class for writing log messages. 
@@ -48,3 +56,115 @@ class Logger:
         log_str = f'--- {time_elapsed} {unit} --- {text}'
 
         self.print_log(log_str, 'INFO')
+
+
+def get_peak_rss_mb() -> float:
+    """Returns the peak resident set size (RSS) of the process in MB, or None if it is not available (e.g. on Windows).
+    On Linux, the peak is read from /proc/self/status (VmHWM), since ru_maxrss is inherited over fork and exec
+    (i.e. it may be the peak of the parent process in a spawned subprocess).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if (resource is None): return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+
+
+class Stage:
+    """Measurements of a processing stage recorded by StageProfiler. The number of processed rows (e.g. 
+    features or edges) can be set to the attribute rows within the stage.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = None
+        self.wall_time_s = None
+        self.cpu_time_s = None
+        self.peak_rss_delta_mb = None
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'wall_time_s': self.wall_time_s,
+            'cpu_time_s': self.cpu_time_s,
+            'peak_rss_delta_mb': self.peak_rss_delta_mb,
+            'rows': self.rows
+        }
+
+
+class StageProfiler:
+    """A lightweight profiler for recording wall time, CPU time, increase of peak RSS and row counts of 
+    processing stages. Stages are measured with the context manager stage() or the decorator profile(). 
+    If the profiler is disabled, stages are not measured (nor logged) and the calls cost practically nothing.
+
+    Attributes:
+        log (optional): A Logger object for logging the measurements of the stages as they finish.
+        enabled (optional): A boolean variable indicating whether the stages should be measured.
+    """
+
+    def __init__(self, log: Logger = None, enabled: bool = True):
+        self.log = log
+        self.enabled = enabled
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measures the stage executed within the context. Yields a Stage object to which the row count of the 
+        stage can be set.
+        """
+        stage = Stage(name)
+        if (self.enabled == False):
+            yield stage
+            return
+
+        peak_rss = get_peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.wall_time_s = round(time.perf_counter() - wall_start, 3)
+            stage.cpu_time_s = round(time.process_time() - cpu_start, 3)
+            if (peak_rss is not None):
+                stage.peak_rss_delta_mb = round(get_peak_rss_mb() - peak_rss, 1)
+            self.stages.append(stage)
+            if (self.log is not None):
+                rows_str = f', {stage.rows} rows' if stage.rows is not None else ''
+                self.log.info(
+                    f'--- {stage.wall_time_s} s (cpu {stage.cpu_time_s} s, peak rss +{stage.peak_rss_delta_mb} MB{rows_str}) --- {name}'
+                )
+
+    def profile(self, name: str = None):
+        """Returns a decorator for measuring each call of a function as a stage (named by the function by default).
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if (self.enabled == False):
+                    return func(*args, **kwargs)
+                with self.stage(name if name else func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def get_report(self) -> dict:
+        return {
+            'created': datetime.utcnow().isoformat(),
+            'total_wall_time_s': round(sum(stage.wall_time_s for stage in self.stages), 3),
+            'stages': [stage.to_dict() for stage in self.stages]
+        }
+
+    def export_report(self, json_file: str) -> None:
+        """Writes the measurements of the recorded stages to a JSON file (if the profiler is enabled).
+        """
+        if (self.enabled == False): return
+        with open(json_file, 'w') as f:
+            json.dump(self.get_report(), f, indent=2)
+        if (self.log is not None):
+            self.log.info(f'exported stage report to {json_file}')
@@ -23,6 +23,9 @@ out_edge_attrs = [
     E.id_ig, E.uv, E.id_way, E.geometry, E.geom_wgs, 
     E.length, E.length_b, E.noises, E.gvi
 ]
+# dense noise exposures are exported too if they were set to the graph (see noise_graph_update)
+if E.noise_bins.value in graph.es.attribute_names():
+    out_edge_attrs.append(E.noise_bins)
 
 
 def set_biking_lengths(graph, edge_gdf):
@@ -46,7 +49,8 @@ def set_way_ids(graph, edge_gdf):
 edge_gdf = ig_utils.get_edge_gdf(
     graph, 
     attrs=[E.id_ig, E.length, E.bike_safety_factor], 
-    ig_attrs=['source', 'target']
+    ig_attrs=['source', 'target'], 
+    geom_attr=None
 )
 
 set_biking_lengths(graph, edge_gdf)
@@ -83,12 +87,12 @@ graph.delete_vertices(outside_hel_ids)
 del_node_ids = [v.index for v in graph.vs.select(_degree_eq=0)]
 graph.delete_vertices(del_node_ids)
 # reassign igraph indexes to edge and node attributes
-graph.es[E.id_ig.value] = [e.index for e in graph.es]
-graph.vs[N.id_ig.value] = [v.index for v in graph.vs]
+ig_utils.reindex_graph(graph)
 # recalculate uv_id edge attributes
 edge_gdf = ig_utils.get_edge_gdf(
     graph, 
-    ig_attrs=['source', 'target']
+    ig_attrs=['source', 'target'], 
+    geom_attr=None
 )
 set_uv(graph, edge_gdf)
 
@@ -2,6 +2,7 @@ from typing import List, Dict
 import os
 import igraph as ig
 import json
+import numpy as np
 import common.igraph as ig_utils
 from shapely.geometry import Point, LineString
 from common.igraph import Edge as E
@@ -92,14 +93,39 @@ def __as_geojson_feature_collection(df_dicts) -> dict:
     }
 
 
+def __get_mean_noise_levels_by_bins(noise_bins: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Returns mean noise levels of edges from noise exposures as noise bin matrix (see ig_utils.noises_to_bins).
+    Exposures to 40 dB are estimated as in __update_db_40_exp. Raises ValueError if some edges have nodata
+    noise bins (NaN) or zero length, for which the mean noise level cannot be calculated.
+    """
+    nodata_count = np.isnan(noise_bins).any(axis=1).sum()
+    if nodata_count:
+        raise ValueError(f'noise bins of {nodata_count} edges are nodata (NaN)')
+    zero_length_count = (lengths == 0.0).sum()
+    if zero_length_count:
+        raise ValueError(f'cannot calculate mean noise levels for {zero_length_count} edges of zero length')
+    bins = noise_bins.astype(np.float64)
+    bins[:, 0] += np.round(lengths - np.round(bins.sum(axis=1), 3), 2)
+    # estimate mean dB of 5 dB range to be min dB + 2.5 dB
+    sum_db = (bins * (np.array(ig_utils.noise_bins) + 2.5)).sum(axis=1)
+    return np.round(sum_db / lengths, 1)
+
+
 def create_geojson(graph: ig.Graph) -> dict:
-    df = ig_utils.get_edge_gdf(graph, attrs=[E.id_way, E.length, E.noises, E.gvi], geom_attr=E.geom_wgs)
+    """Creates GeoJSON feature collection of the edges of the graph. If the graph has the attribute noise_bins, 
+    mean noise levels are calculated from it, otherwise from the attribute noises. 
+    """
+    noise_attr = E.noise_bins if E.noise_bins.value in graph.es.attribute_names() else E.noises
+    df = ig_utils.get_edge_gdf(graph, attrs=[E.id_way, E.length, noise_attr, E.gvi], geom_attr=E.geom_wgs)
     # drop edges without geometry
     df = df[df[E.geom_wgs.name].apply(lambda geom: isinstance(geom, LineString))]
     # drop edges with duplicate geometry
     df = df.drop_duplicates(E.id_way.name)
-    df[E.noises.name] = df.apply(lambda x: __update_db_40_exp(x[E.noises.name], x[E.length.name]), axis=1)
-    df['db'] = df.apply(lambda x: __get_mean_noise_level(x[E.noises.name], x[E.length.name]), axis=1)
+    if noise_attr == E.noise_bins:
+        df['db'] = __get_mean_noise_levels_by_bins(np.vstack(df[E.noise_bins.name]), df[E.length.name].to_numpy())
+    else:
+        df[E.noises.name] = df.apply(lambda x: __update_db_40_exp(x[E.noises.name], x[E.length.name]), axis=1)
+        df['db'] = df.apply(lambda x: __get_mean_noise_level(x[E.noises.name], x[E.length.name]), axis=1)
     df['db'] = [__get_noise_range(db) for db in df['db']]
     # simplify geometries a bit, TODO think about if this is needed (as decrease in file size is small)
     df[E.geom_wgs.name] = [geom.simplify(0.00005, preserve_topology=True) for geom in df[E.geom_wgs.name]]
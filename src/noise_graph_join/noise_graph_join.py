@@ -2,16 +2,20 @@ import sys
 sys.path.append('..')
 import os
 import fiona
+from contextlib import nullcontext
 import math
 from pyproj import CRS
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 from common.logger import Logger
+from common.gpkg_export import GpkgExportQueue
 import utils as utils
+import noise_raster as noise_raster_utils
 import common.igraph as ig_utils
 from common.igraph import Edge as E, Node as N
 from schema import SamplingGdf as S
+from noise_raster import NoiseRaster
 from typing import List, Set, Dict, Tuple
 
 def noise_graph_join(
@@ -21,12 +25,33 @@ def noise_graph_join(
     noise_layers: Dict[str, gpd.GeoDataFrame],
     nodata_layer: gpd.GeoDataFrame,
     b_debug: bool=False,
-    debug_gpkg: str=''
+    debug_gpkg: str='',
+    noise_rasters: Dict[str, NoiseRaster]=None,
+    raster_validation_csv: str=None,
+    noise_index: utils.NoiseLayerIndex=None,
+    gpkg_exports: GpkgExportQueue=None
     ) -> gpd.GeoDataFrame:
+    """Joins noise values to edges from noise layers by sampling points. Noise values are queried from a spatial index
+    over the polygons of all noise layers (noise_index), which should be built once (see utils.get_noise_layer_index)
+    and reused when processing the edges in chunks. If rasterized noise layers (noise_rasters) are given, noise values
+    are looked up from them instead. With raster_validation_csv, the looked up values are also compared to the ones
+    from the polygon join and the report is written to the CSV.
+
+    Debug layers are written to debug_gpkg in a background thread by the given export queue (gpkg_exports), which
+    can be shared by the calls for all chunks so that only the end of the whole run waits for the exports. If
+    no queue is given, a queue of the call is created and the call waits for its exports before returning.
+    """
+
+    if (noise_index is None and (noise_rasters is None or raster_validation_csv)):
+        noise_index = utils.get_noise_layer_index(noise_layers, log)
+
+    def join_noise_values(sampling_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        if (noise_rasters is None):
+            return utils.query_noise_values(sampling_gdf, noise_index, log)
+        return noise_raster_utils.lookup_noise_values(sampling_gdf, noise_rasters, log)
 
     # create sampling points
-    edge_gdf = utils.add_sampling_points_to_gdf(edge_gdf, sampling_interval=3)
-    point_gdf = utils.explode_sampling_point_gdf(edge_gdf, points_geom_column=S.sampling_points)
+    point_gdf = utils.get_sampling_point_gdf(edge_gdf, sampling_interval)
 
     # select only unique sampling points for sampling
     point_gdf = utils.add_unique_geom_id(point_gdf, log)
@@ -38,101 +63,106 @@ def noise_graph_join(
     uniq_point_gdf = utils.add_inside_nodata_zone_column(uniq_point_gdf, nodata_layer, log)
     # columns: edge_id, sample_len, xy_id, nodata_zone (1 / na)
 
-    if (b_debug == True):
-        if os.path.exists(debug_gpkg):
-            os.remove(debug_gpkg)
-        log.info('exporting edges and sampling points for debugging')
-        edge_gdf.drop(columns=[S.sampling_points]).to_file(debug_gpkg, layer='graph_edges', driver='GPKG')
-        uniq_point_gdf.to_file(debug_gpkg, layer='sampling_points', driver='GPKG')
-
-    # spatially join noise values by sampling points from a set of noise surface layers
-    noise_samples = utils.sjoin_noise_values(uniq_point_gdf, noise_layers, log)
+    # debug layers are written to a GeoPackage in a background thread (only if debugging)
+    b_own_exports = b_debug == True and gpkg_exports is None
+    with (GpkgExportQueue(log) if b_own_exports else nullcontext(gpkg_exports)) as gpkg_exports:
+        if (b_debug == True):
+            if os.path.exists(debug_gpkg):
+                # layers of a previous call may still be pending for the same file
+                gpkg_exports.wait()
+                os.remove(debug_gpkg)
+            log.info('exporting edges and sampling points for debugging')
+            gpkg_exports.export(edge_gdf, debug_gpkg, 'graph_edges')
+            gpkg_exports.export(uniq_point_gdf, debug_gpkg, 'sampling_points')
+
+        # spatially join noise values by sampling points from a set of noise surface layers
+        noise_samples = join_noise_values(uniq_point_gdf)
+
+        if (noise_rasters is not None and raster_validation_csv):
+            log.info('validating noise values of rasters against polygon join')
+            sjoin_samples = utils.query_noise_values(uniq_point_gdf, noise_index, log)
+            validation_report = noise_raster_utils.get_raster_validation_report(noise_samples, sjoin_samples, list(noise_layers.keys()))
+            validation_report.to_csv(raster_validation_csv, index=False)
+            log.info(f'raster lookup matched polygon join for {validation_report["match_share"].min()} % of samples (worst layer), see {raster_validation_csv}')
     
-    noise_samples[S.no_noise_values] = noise_samples.apply(lambda row: utils.all_noise_values_none(row, noise_layers), axis=1)
-    utils.log_none_noise_stats(log, noise_samples)
+        noise_samples[S.no_noise_values] = noise_samples.apply(lambda row: utils.all_noise_values_none(row, noise_layers), axis=1)
+        utils.log_none_noise_stats(log, noise_samples)
 
-    # add column indicating wether sampling points is both located in potential nodata_zone and is missing noise values
-    noise_samples[S.missing_noises] = noise_samples.apply(lambda row: True if (row[S.nodata_zone] == 1) & (row[S.no_noise_values] == True) else False, axis=1)
-    normal_samples = noise_samples[noise_samples[S.missing_noises] == False].copy()
+        # add column indicating wether sampling points is both located in potential nodata_zone and is missing noise values
+        noise_samples[S.missing_noises] = noise_samples.apply(lambda row: True if (row[S.nodata_zone] == 1) & (row[S.no_noise_values] == True) else False, axis=1)
+        normal_samples = noise_samples[noise_samples[S.missing_noises] == False].copy()
 
-    if (b_debug == True):
-        noise_samples.to_file(debug_gpkg, layer='sampling_points_noise', driver='GPKG')
+        if (b_debug == True):
+            gpkg_exports.export(noise_samples, debug_gpkg, 'sampling_points_noise')
 
-    missing_noises_count = len(noise_samples[noise_samples[S.missing_noises] == True])
-    missing_share = round(100 * missing_noises_count/len(noise_samples.index), 2)
-    log.info(f'found {missing_noises_count} ({missing_share} %) sampling points for which noise values need to be interpolated')
+        missing_noises_count = len(noise_samples[noise_samples[S.missing_noises] == True])
+        missing_share = round(100 * missing_noises_count/len(noise_samples.index), 2)
+        log.info(f'found {missing_noises_count} ({missing_share} %) sampling points for which noise values need to be interpolated')
 
-    # define columns for sampled values
-    sampling_columns = [S.xy_id, S.road, S.train, S.tram, S.metro, S.n_max, S.n_max_sources, S.n_max_adj]
+        # define columns for sampled values
+        sampling_columns = [S.xy_id, S.road, S.train, S.tram, S.metro, S.n_max, S.n_max_sources, S.n_max_adj]
 
-    if (missing_noises_count == 0):
-        log.info('processing noise samples')
-        all_samples = utils.aggregate_noise_values(normal_samples)
-        all_samples = all_samples[sampling_columns]
-    else:
-        # interpolate noise values for sampling points missing them in nodata zones
-        interpolated_samples = noise_samples[noise_samples[S.missing_noises] == True][[S.xy_id, S.geometry]].copy()
-        interpolated_samples[S.offset_sampling_points] = [utils.get_sampling_points_around(point, distance=7, count=20) for point in interpolated_samples[S.geometry]]
-        offset_sampling_points = utils.explode_offset_sampling_point_gdf(interpolated_samples, S.offset_sampling_points)
+        if (missing_noises_count == 0):
+            log.info('processing noise samples')
+            all_samples = utils.aggregate_noise_values(normal_samples)
+            all_samples = all_samples[sampling_columns]
+        else:
+            # interpolate noise values for sampling points missing them in nodata zones
+            interpolated_samples = noise_samples[noise_samples[S.missing_noises] == True][[S.xy_id, S.geometry]].copy()
+            interpolated_samples[S.offset_sampling_points] = [utils.get_sampling_points_around(point, distance=7, count=20) for point in interpolated_samples[S.geometry]]
+            offset_sampling_points = utils.explode_offset_sampling_point_gdf(interpolated_samples, S.offset_sampling_points)
 
-        if (b_debug == True):
-            offset_sampling_points.to_file(debug_gpkg, layer='offset_sampling_points', driver='GPKG')
+            if (b_debug == True):
+                gpkg_exports.export(offset_sampling_points, debug_gpkg, 'offset_sampling_points')
 
-        # join noise values to offset sampling points
-        offset_sampling_point_noises = utils.sjoin_noise_values(offset_sampling_points, noise_layers, log)
+            # join noise values to offset sampling points
+            offset_sampling_point_noises = join_noise_values(offset_sampling_points)
         
-        if (b_debug == True):
-            offset_sampling_point_noises.to_file(debug_gpkg, layer='offset_sampling_point_noises', driver='GPKG')
-
-        # calculate average noise values per xy_id from offset sampling points
-        offset_samples_by_xy_id = offset_sampling_point_noises.groupby(by=S.xy_id)
-        row_accumulator = []
-        for xy_id, group in offset_samples_by_xy_id:
-            samples = group.copy()
-            samples = samples.fillna(0)
-            interpolated_sample = {name: samples[name].quantile(.7, interpolation='nearest') for name in noise_layers.keys()}
-            interpolated_sample[S.xy_id] = xy_id
-            row_accumulator.append(interpolated_sample)
-
-        interpolated_noise_samples = pd.DataFrame(row_accumulator)
-        interpolated_noise_samples = interpolated_noise_samples.replace(0, np.nan)
+            if (b_debug == True):
+                gpkg_exports.export(offset_sampling_point_noises, debug_gpkg, 'offset_sampling_point_noises')
+
+            # calculate average noise values per xy_id from offset sampling points
+            noise_columns = list(noise_layers.keys())
+            offset_samples = offset_sampling_point_noises[[S.xy_id] + noise_columns].fillna(0)
+            interpolated_noise_samples = offset_samples.groupby(by=S.xy_id)[noise_columns].quantile(.7, interpolation='nearest').reset_index()
+            interpolated_noise_samples = interpolated_noise_samples.replace(0, np.nan)
         
-        # add newly sampled noise values to sampling points missing them
-        interpolated_samples = pd.merge(interpolated_samples.drop(columns=[S.offset_sampling_points]), interpolated_noise_samples, on=S.xy_id, how='left')
-        if (b_debug == True):
-            interpolated_samples.to_file(debug_gpkg, layer='interpolated_samples', driver='GPKG')
+            # add newly sampled noise values to sampling points missing them
+            interpolated_samples = pd.merge(interpolated_samples.drop(columns=[S.offset_sampling_points]), interpolated_noise_samples, on=S.xy_id, how='left')
+            if (b_debug == True):
+                gpkg_exports.export(interpolated_samples, debug_gpkg, 'interpolated_samples')
 
-        # add maximum noise values etc. to sampling points
-        log.info('processing noise samples')
-        normal_samples = utils.aggregate_noise_values(normal_samples)
-        interpolated_samples = utils.aggregate_noise_values(interpolated_samples, prefer_syke=True)
+            # add maximum noise values etc. to sampling points
+            log.info('processing noise samples')
+            normal_samples = utils.aggregate_noise_values(normal_samples)
+            interpolated_samples = utils.aggregate_noise_values(interpolated_samples, prefer_syke=True)
 
-        # combine sampling point dataframes to one
-        normal_samples = normal_samples[sampling_columns]
-        interpolated_samples = interpolated_samples[sampling_columns]
+            # combine sampling point dataframes to one
+            normal_samples = normal_samples[sampling_columns]
+            interpolated_samples = interpolated_samples[sampling_columns]
 
-        all_samples = pd.concat([normal_samples, interpolated_samples], ignore_index=True)
+            all_samples = pd.concat([normal_samples, interpolated_samples], ignore_index=True)
     
-    if (all_samples[S.xy_id].nunique() != len(all_samples.index)):
-        log.error(f'found invalid number of unique sampling point ids: {len(all_samples.index)} != {all_samples[S.xy_id].nunique()}')
+        if (all_samples[S.xy_id].nunique() != len(all_samples.index)):
+            log.error(f'found invalid number of unique sampling point ids: {len(all_samples.index)} != {all_samples[S.xy_id].nunique()}')
     
-    if (initial_sampling_count != len(all_samples.index)):
-        log.error(f'found mismatch in sampling point count: {len(all_samples.index)} != {initial_sampling_count}')
+        if (initial_sampling_count != len(all_samples.index)):
+            log.error(f'found mismatch in sampling point count: {len(all_samples.index)} != {initial_sampling_count}')
 
-    final_samples = pd.merge(point_gdf, all_samples, how='left', on=S.xy_id)
+        final_samples = pd.merge(point_gdf, all_samples, how='left', on=S.xy_id)
 
-    if (len(final_samples.index) != len(point_gdf.index)):
-        log.error(f'mismatch in row counts after merging sampled values to initial sampling points: {len(final_samples.index)} != {len(point_gdf.index)}')
+        if (len(final_samples.index) != len(point_gdf.index)):
+            log.error(f'mismatch in row counts after merging sampled values to initial sampling points: {len(final_samples.index)} != {len(point_gdf.index)}')
 
-    if (b_debug == True):
-        log.info('exporting sampling points to gpkg')
-        final_samples_gdf = gpd.GeoDataFrame(final_samples, crs=CRS.from_epsg(3879))
-        final_samples_gdf.drop(columns=[S.n_max_sources]).to_file(debug_gpkg, layer='final_noise_samples', driver='GPKG')
+        if (b_debug == True):
+            log.info('exporting sampling points to gpkg')
+            final_samples_gdf = gpd.GeoDataFrame(final_samples, crs=CRS.from_epsg(3879))
+            gpkg_exports.export(final_samples_gdf, debug_gpkg, 'final_noise_samples', copy=False)
 
-    edge_noises = utils.aggregate_noises_by_edge(final_samples, log)
+        edge_noises = utils.aggregate_noises_by_edge(final_samples, log)
 
-    if (len(edge_noises.index) != edge_gdf[S.sampling_points].count()):
-        log.error(f'mismatch in final aggregated noise values by edges ({len(edge_noises.index)} != {len(edge_gdf.index)})')
+        if (len(edge_noises.index) != point_gdf[S.edge_id].nunique()):
+            log.error(f'mismatch in final aggregated noise values by edges ({len(edge_noises.index)} != {len(edge_gdf.index)})')
 
     log.info('all done')
     return edge_noises.rename(columns={ S.edge_id: E.id_ig.name })
@@ -149,7 +179,7 @@ def export_edge_noise_csv(edge_noises: pd.DataFrame, out_dir: str):
 
 if (__name__ == '__main__'):
     log = Logger(printing=True, log_file='noise_graph_join.log', level='debug')
-    graph = ig_utils.read_graphml('data/hma.graphml')
+    graph = ig_utils.read_graphml('data/hma.graphml', e_attrs=[E.id_ig, E.geometry])
     log.info(f'read graph of {graph.ecount()} edges')
     edge_gdf = ig_utils.get_edge_gdf(graph, attrs=[E.id_ig])
     edge_gdf = edge_gdf.sort_values(E.id_ig.name)
@@ -163,6 +193,14 @@ if (__name__ == '__main__'):
     # read nodata zone: narrow area between noise surfaces of different municipalities
     nodata_layer = gpd.read_file('data/extents.gpkg', layer='municipal_boundaries')
 
+    # optionally look up noise values from rasterized (and cached) noise layers instead of joining the polygons
+    raster_resolution = None
+    b_validate_rasters = True
+    noise_rasters = noise_raster_utils.get_noise_rasters(noise_layers, raster_resolution, 'noise_rasters/', log) if raster_resolution else None
+    b_validate_rasters = b_validate_rasters and noise_rasters is not None
+    # the polygon index is needed also for validating the raster lookup against the exact polygon join
+    noise_index = utils.get_noise_layer_index(noise_layers, log) if (noise_rasters is None or b_validate_rasters) else None
+
     # process chunks of edges together by dividing gdf to parts
     processing_size = 50000
     split_gdf_count = math.ceil(len(edge_gdf)/processing_size)
@@ -173,21 +211,28 @@ if (__name__ == '__main__'):
     if (max_processed_id > 0):
         log.info(f'found previously processed edges up to edge id {max_processed_id}')
 
-    for idx, gdf in enumerate(gdfs):
-
-        if (gdf[E.id_ig.name].max() <= max_processed_id):
-            log.info(f'skipping {idx+1} of {len(gdfs)} edge gdfs (processed before)')
-            continue
-        else:
-            log.info(f'processing {idx+1} of {len(gdfs)} edge gdfs')
-
-        edge_noises = noise_graph_join(
-            log = log,
-            edge_gdf=gdf,
-            sampling_interval = 3,
-            noise_layers = noise_layers,
-            nodata_layer = nodata_layer,
-            b_debug = False,
-            debug_gpkg = 'debug/noise_join_debug.gpkg'
-        )
-        export_edge_noise_csv(edge_noises, 'out_csv/')
+    # debug layers of all chunks are written by one background queue, waited for only at the end of the run
+    b_debug = False
+    with (GpkgExportQueue(log) if b_debug else nullcontext()) as gpkg_exports:
+        for idx, gdf in enumerate(gdfs):
+
+            if (gdf[E.id_ig.name].max() <= max_processed_id):
+                log.info(f'skipping {idx+1} of {len(gdfs)} edge gdfs (processed before)')
+                continue
+            else:
+                log.info(f'processing {idx+1} of {len(gdfs)} edge gdfs')
+
+            edge_noises = noise_graph_join(
+                log = log,
+                edge_gdf=gdf,
+                sampling_interval = 3,
+                noise_layers = noise_layers,
+                nodata_layer = nodata_layer,
+                b_debug = b_debug,
+                debug_gpkg = f'debug/{idx}_noise_join_debug.gpkg',
+                noise_rasters = noise_rasters,
+                raster_validation_csv = f'debug/{idx}_noise_raster_validation.csv' if b_validate_rasters else None,
+                noise_index = noise_index,
+                gpkg_exports = gpkg_exports
+            )
+            export_edge_noise_csv(edge_noises, 'out_csv/')
@@ -21,11 +21,20 @@ def noise_graph_update(graph: ig.Graph, noise_csv_dir: str, log: Logger) -> None
     for csv_file in noise_csvs:
         edge_noises = pd.read_csv(noise_csv_dir + csv_file)
         edge_noises[E.noise_source.name] = edge_noises[E.noise_source.name].replace({np.nan: ''})
+        edge_noises[E.noises.name] = ig_utils.to_noises_list(list(edge_noises[E.noises.name]))
         log.info(f'updating {len(edge_noises)} edge noises from '+ csv_file)
         for edge in edge_noises.itertuples():
             graph.es[getattr(edge, E.id_ig.name)][E.noises.value] = getattr(edge, E.noises.name)
             graph.es[getattr(edge, E.id_ig.name)][E.noise_source.value] = getattr(edge, E.noise_source.name)
 
+def set_edge_noise_bins(graph: ig.Graph, log: Logger) -> None:
+    """Sets noise exposures of edges to attribute noise_bins in dense (fixed-bin) form (see ig_utils.noises_to_bins). 
+    The rows of the noise bin matrix are views to a single array in order to keep memory usage low. 
+    """
+    noise_bin_matrix = ig_utils.get_noise_bin_matrix(graph.es[E.noises.value])
+    graph.es[E.noise_bins.value] = list(noise_bin_matrix)
+    log.info(f'set noise bins to {len(noise_bin_matrix)} edges')
+
 def set_default_and_na_edge_noises(graph: ig.Graph, data_extent: Polygon, log: Logger) -> None:
     """Sets noise attributes of edges to their default values and None outside the extent of the noise data.
     """
@@ -53,6 +62,7 @@ if (__name__ == '__main__'):
     out_graph_file = 'out_graph/hma.graphml'
     data_extent_file = 'data/HMA.geojson'
     noise_csv_dir = 'out_csv/'
+    b_noise_bins = False
 
     data_extent: Polygon = geom_utils.project_geom(gpd.read_file(data_extent_file)['geometry'][0])
     graph = ig_utils.read_graphml(in_graph_file, log)
@@ -61,6 +71,9 @@ if (__name__ == '__main__'):
 
     noise_graph_update(graph, noise_csv_dir, log)
 
+    if (b_noise_bins == True):
+        set_edge_noise_bins(graph, log)
+
     ig_utils.export_to_graphml(graph, out_graph_file)
     log.info(f'exported graph of {graph.ecount()} edges')
     log.info('all done')
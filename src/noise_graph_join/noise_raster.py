@@ -0,0 +1,190 @@
+import sys
+sys.path.append('..')
+import os
+import json
+import math
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio.features
+from rasterio.enums import MergeAlg
+from rasterio.transform import from_origin
+from common.logger import Logger
+from schema import SamplingGdf as S
+from typing import Dict, NamedTuple
+
+class NoiseRaster(NamedTuple):
+    """Noise values (db_low) of a noise layer rasterized to a grid of square cells. The array is of type uint8
+    and 0 marks cells without noise values. Row 0 of the array is the northernmost row of the grid.
+    """
+    name: str
+    array: np.ndarray
+    minx: float
+    maxy: float
+    resolution: float
+
+def get_layer_signature(noise_gdf: gpd.GeoDataFrame, name: str) -> dict:
+    """Returns a signature of a noise layer for detecting whether a cached raster of it is still valid.
+    The signature includes a hash of the geometries (as WKB) and values of the layer, so that also edits
+    to the polygons that keep the bounds and values unchanged invalidate the cached raster.
+    """
+    minx, miny, maxx, maxy = noise_gdf.total_bounds
+    content_hash = hashlib.blake2b(digest_size=16)
+    content_hash.update(pd.util.hash_array(shapely.to_wkb(np.asarray(noise_gdf.geometry.values, dtype=object)).astype(object)).tobytes())
+    content_hash.update(noise_gdf[name].to_numpy(dtype=np.float64).tobytes())
+    return {
+        'feature_count': len(noise_gdf.index),
+        'bounds': [round(float(coord), 3) for coord in (minx, miny, maxx, maxy)],
+        'value_sum': round(float(noise_gdf[name].sum()), 3),
+        'content_hash': content_hash.hexdigest()
+    }
+
+def __get_raster_paths(cache_dir: str, name: str, resolution: float) -> tuple:
+    file_name = f'{name}_{resolution}m'
+    return os.path.join(cache_dir, f'{file_name}.npy'), os.path.join(cache_dir, f'{file_name}.json')
+
+def rasterize_noise_layer(
+    noise_gdf: gpd.GeoDataFrame,
+    name: str,
+    resolution: float,
+    out_file: str = None
+    ) -> NoiseRaster:
+    """Rasterizes the noise values of a polygon layer (values in column [name]) by burning all polygons to
+    the grid at once (a cell gets the value of a polygon if the center of the cell is inside it). Where polygons
+    overlap, the highest noise value is kept (as in removing duplicate samples of the polygon join). If out_file
+    is given, the array is written to it as a memory mapped .npy file instead of keeping it in memory.
+
+    Raises:
+        ValueError: If the noise values are not integers between 1 and 255.
+    """
+    values = noise_gdf[name].to_numpy(dtype=np.float64)
+    if (len(values) > 0 and (np.isnan(values).any() or values.min() < 1 or values.max() > 255 or (values % 1 != 0).any())):
+        raise ValueError(f'noise values of layer {name} cannot be rasterized to uint8 (expected integers between 1 and 255)')
+
+    minx, miny, maxx, maxy = noise_gdf.total_bounds if len(values) > 0 else (0.0, 0.0, 0.0, 0.0)
+    minx = math.floor(minx / resolution) * resolution
+    maxy = math.ceil(maxy / resolution) * resolution
+    width = max(math.ceil((maxx - minx) / resolution), 1)
+    height = max(math.ceil((maxy - miny) / resolution), 1)
+
+    if (out_file is not None):
+        array = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.uint8, shape=(height, width))
+        array[:] = 0
+    else:
+        array = np.zeros((height, width), dtype=np.uint8)
+
+    geoms = np.asarray(noise_gdf.geometry.values, dtype=object)
+    valid = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+    if (valid.any()):
+        # polygons are burned in the order of ascending values, so that the highest value is left where they overlap
+        order = np.argsort(values[valid], kind='stable')
+        rasterio.features.rasterize(
+            zip(geoms[valid][order], values[valid][order].astype(np.uint8)),
+            out=array,
+            transform=from_origin(minx, maxy, resolution, resolution),
+            merge_alg=MergeAlg.replace
+        )
+
+    if (out_file is not None):
+        array.flush()
+
+    return NoiseRaster(name, array, float(minx), float(maxy), resolution)
+
+def get_noise_rasters(
+    noise_layers: Dict[str, gpd.GeoDataFrame],
+    resolution: float,
+    cache_dir: str,
+    log: Logger = None
+    ) -> Dict[str, NoiseRaster]:
+    """Returns rasterized noise layers (see rasterize_noise_layer) by name. Rasters are cached to cache_dir
+    as .npy files (and .json metadata) and read from there as memory mapped arrays if the layer has not changed
+    since the rasterization.
+    """
+    if (not os.path.exists(cache_dir)):
+        os.makedirs(cache_dir)
+
+    noise_rasters = {}
+    for name, noise_gdf in noise_layers.items():
+        array_file, meta_file = __get_raster_paths(cache_dir, name, resolution)
+        signature = get_layer_signature(noise_gdf, name)
+
+        if (os.path.exists(array_file) and os.path.exists(meta_file)):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if (meta['signature'] == signature):
+                if (log is not None): log.debug(f'reading cached noise raster of layer [{name}] from {array_file}')
+                noise_rasters[name] = NoiseRaster(name, np.load(array_file, mmap_mode='r'), meta['minx'], meta['maxy'], meta['resolution'])
+                continue
+            if (log is not None): log.info(f'noise layer [{name}] has changed since caching its raster')
+
+        if (log is not None): log.info(f'rasterizing noise layer [{name}] at resolution of {resolution} m')
+        noise_raster = rasterize_noise_layer(noise_gdf, name, resolution, out_file=array_file)
+        with open(meta_file, 'w') as f:
+            json.dump({
+                'minx': noise_raster.minx,
+                'maxy': noise_raster.maxy,
+                'resolution': resolution,
+                'shape': list(noise_raster.array.shape),
+                'signature': signature
+            }, f, indent=2)
+        noise_rasters[name] = NoiseRaster(name, np.load(array_file, mmap_mode='r'), noise_raster.minx, noise_raster.maxy, resolution)
+
+    return noise_rasters
+
+def get_raster_values(noise_raster: NoiseRaster, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """Returns the noise values of the raster at the given locations as an array of floats (NaN for no noise value).
+    """
+    rows = np.floor((noise_raster.maxy - ys) / noise_raster.resolution).astype(np.int64)
+    cols = np.floor((xs - noise_raster.minx) / noise_raster.resolution).astype(np.int64)
+    height, width = noise_raster.array.shape
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    values = np.full(len(xs), np.nan)
+    values[inside] = noise_raster.array[rows[inside], cols[inside]]
+    values[values == 0] = np.nan
+    return values
+
+def lookup_noise_values(gdf: gpd.GeoDataFrame, noise_rasters: Dict[str, NoiseRaster], log: Logger = None) -> gpd.GeoDataFrame:
+    """Adds noise values from the rasterized noise layers to a GeoDataFrame of sampling points (one column per layer).
+    Works as a faster alternative to utils.sjoin_noise_values (with the same output schema).
+    """
+    sample_gdf = gdf.copy()
+    geoms = np.asarray(sample_gdf[S.geometry].values, dtype=object)
+    xs, ys = shapely.get_x(geoms), shapely.get_y(geoms)
+    for name, noise_raster in noise_rasters.items():
+        sample_gdf[name] = get_raster_values(noise_raster, xs, ys)
+    if (log is not None): log.debug(f'looked up values of {len(noise_rasters)} noise rasters for {len(sample_gdf.index)} sampling points')
+    return sample_gdf
+
+def get_raster_validation_report(
+    raster_samples: pd.DataFrame,
+    sjoin_samples: pd.DataFrame,
+    noise_layers: list,
+    sample_id: str = S.xy_id
+    ) -> pd.DataFrame:
+    """Compares noise values looked up from the noise rasters with the ones of the exact polygon join for the same
+    sampling points. Returns a DataFrame with counts of (mis)matching samples by noise layer.
+    """
+    compared = pd.merge(
+        raster_samples[[sample_id] + noise_layers],
+        sjoin_samples[[sample_id] + noise_layers],
+        on=sample_id, how='inner', suffixes=('_raster', '_sjoin')
+    )
+    rows = []
+    for name in noise_layers:
+        raster_values = compared[f'{name}_raster'].to_numpy(dtype=np.float64)
+        sjoin_values = compared[f'{name}_sjoin'].to_numpy(dtype=np.float64)
+        both_nan = np.isnan(raster_values) & np.isnan(sjoin_values)
+        matches = both_nan | (raster_values == sjoin_values)
+        rows.append({
+            'layer': name,
+            'sample_count': len(compared.index),
+            'sjoin_count': int((~np.isnan(sjoin_values)).sum()),
+            'raster_count': int((~np.isnan(raster_values)).sum()),
+            'mismatch_count': int((~matches).sum()),
+            'missing_in_raster': int((np.isnan(raster_values) & ~np.isnan(sjoin_values)).sum()),
+            'extra_in_raster': int((~np.isnan(raster_values) & np.isnan(sjoin_values)).sum()),
+            'match_share': round(100 * matches.mean(), 3) if len(matches) > 0 else 100.0
+        })
+    return pd.DataFrame(rows)
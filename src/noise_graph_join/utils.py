@@ -3,6 +3,7 @@ sys.path.append('..')
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import shapely
 from statistics import mode
 from collections import Counter
 from common.igraph import Edge
@@ -10,7 +11,7 @@ from common.logger import Logger
 from shapely.geometry import LineString, Point, GeometryCollection
 from schema import SamplingGdf as S
 from pyproj import CRS
-from typing import List, Set, Dict, Tuple
+from typing import List, Set, Dict, Tuple, NamedTuple
 
 def get_point_sampling_distances(sample_count: int) -> List[float]:
     """Calculates set of distances for sample points as relative shares. 
@@ -55,10 +56,52 @@ def explode_sampling_point_gdf(gdf, points_geom_column: str) -> gpd.GeoDataFrame
     point_gdf = gpd.GeoDataFrame(row_accumulator, crs=CRS.from_epsg(3879))
     return point_gdf
 
+def get_sampling_point_gdf(gdf, sampling_interval: int) -> gpd.GeoDataFrame:
+    """Creates sampling points for all LineString geometries of the gdf by specified interval (m) (sampling_interval)
+    and returns them as GeoDataFrame with columns edge_id (index of the gdf), sample_len and geometry. The points
+    are equal to the ones created by add_sampling_points_to_gdf & explode_sampling_point_gdf, but the sample 
+    counts and (normalized) distances of the points are calculated as arrays and all points are interpolated at once.
+    """
+    geoms = np.asarray(gdf[S.geometry].values, dtype=object)
+    is_line = shapely.get_type_id(geoms) == shapely.GeometryType.LINESTRING
+    lines = geoms[is_line]
+    lengths = shapely.length(lines)
+    sample_counts = np.round(lengths / sampling_interval).astype(np.int64)
+    sample_counts[sample_counts == 0] = 1
+
+    # distances of the points as shares of the lengths of the lines (see get_point_sampling_distances)
+    line_idxs = np.repeat(np.arange(len(lines)), sample_counts)
+    sp_indexes = np.arange(len(line_idxs)) - np.repeat(np.cumsum(sample_counts) - sample_counts, sample_counts)
+    sample_shares = 1 / sample_counts[line_idxs]
+    sample_distances = sample_shares / 2 + sp_indexes * sample_shares
+
+    return gpd.GeoDataFrame({
+        S.edge_id: gdf.index.values[is_line][line_idxs],
+        S.sample_len: np.round(lengths / sample_counts, 10)[line_idxs],
+        S.geometry: shapely.line_interpolate_point(lines[line_idxs], sample_distances, normalized=True)
+    }, geometry=S.geometry, crs=CRS.from_epsg(3879))
+
+def get_xy_ids(xs, ys) -> np.ndarray:
+    """Returns unique identifiers (int64) for locations by packing their x and y coordinates (EPSG:3879) 
+    quantized to 0.1 m to one integer (x in the upper and y in the lower 32 bits).
+    """
+    x_q = np.round(np.asarray(xs, dtype=np.float64) * 10).astype(np.int64)
+    y_q = np.round(np.asarray(ys, dtype=np.float64) * 10).astype(np.int64)
+    if (len(y_q) > 0 and (y_q.min() < 0 or y_q.max() >= 2**32 or np.abs(x_q).max() >= 2**31)):
+        raise ValueError('coordinates out of the range of packed xy ids')
+    return (x_q << 32) | y_q
+
+def get_xy_from_xy_ids(xy_ids) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the (quantized) x and y coordinates of the locations of the given xy ids (see get_xy_ids).
+    """
+    xy_ids = np.asarray(xy_ids, dtype=np.int64)
+    return (xy_ids >> 32) / 10, (xy_ids & 0xFFFFFFFF) / 10
+
 def add_unique_geom_id(point_gdf: gpd.GeoDataFrame, log: Logger=None) -> gpd.GeoDataFrame:
-    """Adds an unique identifier (string) to GeoDataFrame of points based on point locations (x/y). 
+    """Adds an unique identifier (int64, see get_xy_ids) to GeoDataFrame of points based on point locations (x/y). 
     """
-    point_gdf[S.xy_id] = [f'{str(round(geom.x, 1))}_{str(round(geom.y, 1))}' for geom in point_gdf[S.geometry]]
+    geoms = np.asarray(point_gdf[S.geometry].values, dtype=object)
+    point_gdf[S.xy_id] = get_xy_ids(shapely.get_x(geoms), shapely.get_y(geoms))
     unique_count = point_gdf[S.xy_id].nunique()
     unique_share = round(100 * unique_count/len(point_gdf.index), 2)
     log.info(f'found {unique_count} unique sampling points ({unique_share} %)')
@@ -162,7 +205,61 @@ def sjoin_noise_values(gdf, noise_layers: dict, log: Logger=None) -> gpd.GeoData
 
     return distinct_samples.drop(columns=['sample_idx'])
 
+class NoiseLayerIndex(NamedTuple):
+    """A spatial index (STRtree) over the polygons of all noise layers. Each polygon is tagged with the index
+    of its layer (in layer_names) and its noise value.
+    """
+    tree: shapely.STRtree
+    layer_ids: np.ndarray
+    values: np.ndarray
+    layer_names: List[str]
+
+def get_noise_layer_index(noise_layers: Dict[str, gpd.GeoDataFrame], log: Logger=None) -> NoiseLayerIndex:
+    """Builds one spatial index over the polygons of all noise layers. Noise values are read from the column
+    named by the layer (i.e. db_low renamed to the name of the layer).
+    """
+    layer_names = list(noise_layers.keys())
+    geoms = np.concatenate([np.asarray(gdf.geometry.values, dtype=object) for gdf in noise_layers.values()])
+    layer_ids = np.concatenate([np.full(len(gdf.index), idx, dtype=np.int32) for idx, gdf in enumerate(noise_layers.values())])
+    values = np.concatenate([gdf[name].to_numpy(dtype=np.float64) for name, gdf in noise_layers.items()])
+    if (log is not None): log.info(f'built spatial index of {len(geoms)} polygons from {len(layer_names)} noise layers')
+    return NoiseLayerIndex(shapely.STRtree(geoms), layer_ids, values, layer_names)
+
+def query_noise_values(gdf, noise_index: NoiseLayerIndex, log: Logger=None) -> gpd.GeoDataFrame:
+    """Adds noise values of all noise layers to sampling points (one column per layer) by a single bulk query
+    to the spatial index of the noise layers. The highest value is kept for points within overlapping polygons
+    of a layer (as in remove_duplicate_samples). Has the same output schema as sjoin_noise_values.
+    """
+    points = np.asarray(gdf[S.geometry].values, dtype=object)
+    point_idxs, poly_idxs = noise_index.tree.query(points, predicate='within')
+    value_matrix = np.full((len(points), len(noise_index.layer_names)), np.nan)
+    np.fmax.at(value_matrix, (point_idxs, noise_index.layer_ids[poly_idxs]), noise_index.values[poly_idxs])
+    if (log is not None): log.debug(f'queried {len(point_idxs)} noise values for {len(points)} sampling points')
+
+    sample_gdf = gdf.copy()
+    for idx, name in enumerate(noise_index.layer_names):
+        sample_gdf[name] = value_matrix[:, idx]
+    return sample_gdf
+
+noise_source_columns = [S.road, S.train, S.tram, S.metro]
+
+def get_noise_source_names(sources_mask: int) -> List[str]:
+    """Returns the names of the noise sources of a bitmask of noise sources (n_max_sources), in which bit i
+    refers to noise_source_columns[i], e.g. 5 -> ['road', 'tram'].
+    """
+    return [name for idx, name in enumerate(noise_source_columns) if sources_mask & (1 << idx)]
+
+def get_first_finite_values(values: np.ndarray) -> np.ndarray:
+    """Returns the first finite value of each row of a matrix, or NaN if a row has no finite values.
+    """
+    finite = np.isfinite(values)
+    first_values = values[np.arange(len(values)), np.argmax(finite, axis=1)] if values.shape[1] > 0 else np.full(len(values), np.nan)
+    return np.where(finite.any(axis=1), first_values, np.nan)
+
 def aggregate_noise_values(sample_gdf, prefer_syke: bool=False) -> gpd.GeoDataFrame:
+    """Adds columns road, train, tram, metro, rail, n_max, n_max_sources and n_max_adj to sampling points. Noise sources
+    of the max noise value (n_max_sources) are given as a bitmask (see get_noise_source_names).
+    """
 
     # 1) select noise value for each source (type)
     road_columns = [S.hel_road, S.hel_hway, S.espoo_road, S.espoo_hway, S.syke_road, S.syke_hway]
@@ -176,59 +273,28 @@ def aggregate_noise_values(sample_gdf, prefer_syke: bool=False) -> gpd.GeoDataFr
         train_columns = [S.syke_train, S.hel_train, S.espoo_train]
         tram_columns = [S.syke_tram, S.hel_tram]
         metro_columns = [S.syke_metro, S.hel_metro]
-    
-    def get_first_non_nan_or_nan(row, columns: list) -> float:
-        for col in columns:
-            if np.isfinite(row[col]): return row[col]
-        return np.nan
 
-    sample_gdf[S.road] = sample_gdf.apply(lambda row: get_first_non_nan_or_nan(row, road_columns), axis=1)
-    sample_gdf[S.train] = sample_gdf.apply(lambda row: get_first_non_nan_or_nan(row, train_columns), axis=1)
-    sample_gdf[S.tram] = sample_gdf.apply(lambda row: get_first_non_nan_or_nan(row, tram_columns), axis=1)
-    sample_gdf[S.metro] = sample_gdf.apply(lambda row: get_first_non_nan_or_nan(row, metro_columns), axis=1)
+    for name, columns in zip(noise_source_columns, [road_columns, train_columns, tram_columns, metro_columns]):
+        sample_gdf[name] = get_first_finite_values(sample_gdf[columns].to_numpy(dtype=np.float64))
 
     # 2) add maximum noise value among rail noise sources (TODO decide if this is needed after all?)
     rail_columns = [S.train, S.tram, S.metro]
     sample_gdf[S.rail] = sample_gdf[rail_columns].max(axis=1)
 
     # 3) add maximum noise value among different sources
-    def get_max_noise_value(row, columns: list) -> float:
-        values = [row[col] for col in columns if np.isfinite(row[col])]
-        return np.nanmax(values) if values else np.nan
-
-    noise_columns = [S.road, S.train, S.tram, S.metro]
-    sample_gdf[S.n_max] = sample_gdf.apply(lambda row: get_max_noise_value(row, noise_columns), axis=1)
-
-    # 4) add name(s) of noise sources of maximum noise values
-    def get_sources_of_max_noise(row, columns: list) -> tuple:
-        """Returns list of names of the noise sources that have the maximum noise value.
-        """
-        if np.isfinite(row[S.n_max]):
-            max_noise = row[S.n_max]
-            values = [row[col] for col in columns]
-            # if the max noise value is only by one source, return the name of it
-            if (values.count(max_noise) == 1):
-                return [columns[values.index(max_noise)]]
-            else:
-                source_indexes = [i for i in range(len(values)) if values[i] == max_noise]
-                return [columns[i] for i in source_indexes]
-        else:
-            return []
-
-    sample_gdf[S.n_max_sources] = sample_gdf.apply(lambda row: get_sources_of_max_noise(row, noise_columns), axis=1)
-
-    # 5) adjust max noises based on number of max noise sources
-    def get_adjusted_max_noise(row) -> float:
-        """Returns the max noise value if it is based on only one noise source. If many noise sources cause the max noise value, 
-        adjusts the max noise value by adding decibels by the count of noise sources.  
-        """
-        if row[S.n_max_sources]:
-            add_db = len(row[S.n_max_sources]) if len(row[S.n_max_sources]) > 1 else 0
-            return row[S.n_max] + add_db
-        else:
-            return np.nan
-
-    sample_gdf[S.n_max_adj] = sample_gdf.apply(lambda row: get_adjusted_max_noise(row), axis=1)
+    source_values = sample_gdf[noise_source_columns].to_numpy(dtype=np.float64)
+    finite = np.isfinite(source_values)
+    n_max = np.where(finite, source_values, -np.inf).max(axis=1)
+    n_max[~finite.any(axis=1)] = np.nan
+    sample_gdf[S.n_max] = n_max
+
+    # 4) add noise sources of maximum noise values as a bitmask
+    is_max_source = source_values == n_max[:, None]
+    sample_gdf[S.n_max_sources] = (is_max_source * (1 << np.arange(len(noise_source_columns)))).sum(axis=1).astype(np.uint8)
+
+    # 5) adjust max noises based on number of max noise sources (add one dB per source if there are many)
+    max_source_counts = is_max_source.sum(axis=1)
+    sample_gdf[S.n_max_adj] = n_max + np.where(max_source_counts > 1, max_source_counts, 0)
     return sample_gdf
 
 def aggregate_noises_by_edge(sample_gdf: gpd.GeoDataFrame, log: Logger) -> pd.DataFrame:
@@ -238,7 +304,11 @@ def aggregate_noises_by_edge(sample_gdf: gpd.GeoDataFrame, log: Logger) -> pd.Da
     agg_columns = [S.edge_id, S.n_max_adj, S.n_max_sources, S.sample_len]
     out_columns = [S.edge_id, Edge.noises.name, Edge.noise_source.name, Edge.noise_sources.name]
 
-    edge_noises = sample_gdf[agg_columns].groupby(S.edge_id).agg(
+    source_names_by_mask = [get_noise_source_names(mask) for mask in range(1 << len(noise_source_columns))]
+    sample_df = sample_gdf[agg_columns].copy()
+    sample_df[S.n_max_sources] = [source_names_by_mask[mask] for mask in sample_df[S.n_max_sources]]
+
+    edge_noises = sample_df.groupby(S.edge_id).agg(
         db_counts=(S.n_max_adj, lambda x: x.value_counts().to_dict()),
         sources=(S.n_max_sources, 'sum'),
         sample_len=(S.sample_len, 'median')
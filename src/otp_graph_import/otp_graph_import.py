@@ -1,17 +1,310 @@
-from typing import List, Set, Dict, Tuple
+from typing import List, Set, Dict, Tuple, Callable
+import os
 import sys
+import tempfile
+from contextlib import nullcontext
 sys.path.append('..')
 from shapely.geometry import Point, LineString
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import igraph as ig
-import shapely.wkt
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pyproj import CRS
 from common.igraph import Node, Edge
 import common.igraph as ig_utils
 import common.geometry as geom_utils
-from common.logger import Logger
+from common.logger import Logger, StageProfiler
+from common.gpkg_export import GpkgExportQueue
+
+# explicit dtypes of the columns of the node and edge CSV files exported by OTP
+__node_csv_dtypes = {
+    Node.id_otp.name: 'int64',
+    Node.name_otp.name: 'str',
+    'vertex_class': 'str',
+    Node.traversable_walking.name: 'bool',
+    Node.traversable_biking.name: 'bool',
+    'label': 'str',
+    Node.traffic_light.name: 'bool',
+    'x': 'float64',
+    'y': 'float64',
+    Node.geometry.name: 'str'
+}
+
+__edge_csv_dtypes = {
+    Edge.id_otp.name: 'int64',
+    Edge.name_otp.name: 'str',
+    'node_orig_id': 'int64',
+    'node_dest_id': 'int64',
+    Edge.length.name: 'float64',
+    Edge.edge_class.name: 'str',
+    Edge.street_class.name: 'float64',
+    Edge.is_stairs.name: 'bool',
+    Edge.is_no_thru_traffic.name: 'bool',
+    'permission': 'str',
+    Edge.allows_walking.name: 'bool',
+    Edge.allows_biking.name: 'bool',
+    Edge.traversable_walking.name: 'bool',
+    Edge.traversable_biking.name: 'bool',
+    Edge.bike_safety_factor.name: 'float64',
+    Edge.geometry.name: 'str'
+}
+
+# queries for filtering out edges that are unsuitable for both walking and cycling
+edge_filter_queries = [
+    f'{Edge.allows_walking.name} == True or {Edge.allows_biking.name} == True',
+    f'{Edge.is_no_thru_traffic.name} == False'
+]
+
+def read_otp_csv(csv_file: str, dtypes: dict) -> pd.DataFrame:
+    """Reads a node or edge CSV file exported by OTP with a multithreaded columnar reader (pyarrow).
+    Empty strings are read as NaN (as by the default reader of pandas).
+    """
+    df = pd.read_csv(csv_file, sep=';', engine='pyarrow', dtype=dtypes)
+    str_columns = [col for col, dtype in dtypes.items() if dtype == 'str' and col in df.columns]
+    df[str_columns] = df[str_columns].replace('', np.nan)
+    return df
+
+def get_wgs_geoseries(wkt_geoms: pd.Series, empty_geom) -> gpd.GeoSeries:
+    """Parses WKT geometries (in WGS84) at once. Missing geometries are replaced with empty_geom.
+    """
+    geoms = gpd.GeoSeries.from_wkt(wkt_geoms, crs=CRS.from_epsg(4326))
+    geoms[geoms.isna()] = empty_geom
+    return geoms
+
+def get_projected_otp_gdf(df: pd.DataFrame, empty_geom) -> gpd.GeoDataFrame:
+    """Creates a GeoDataFrame from nodes or edges read from OTP CSV file. WKT geometries are parsed and 
+    reprojected to ETRS-GK25 (EPSG:3879), while WGS84 geometries are kept in column geom_wgs.
+    """
+    wgs_geoms = get_wgs_geoseries(df[Edge.geometry.name], empty_geom)
+    df[Edge.geometry.name] = gpd.GeoSeries(geom_utils.project_geoms(wgs_geoms), index=df.index, crs=CRS.from_epsg(3879))
+    df[Edge.geom_wgs.name] = wgs_geoms
+    return gpd.GeoDataFrame(df, geometry=Edge.geometry.name, crs=CRS.from_epsg(3879))
+
+def __get_staging_schema(dtypes: dict, columns: List[str]) -> pa.Schema:
+    """Returns arrow schema for staging the given (known) columns of OTP CSV data. Geometries are stored as WKB.
+    """
+    arrow_type_by_dtype = { 'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_(), 'str': pa.string() }
+    return pa.schema([
+        pa.field(col, pa.binary()) if col in (Edge.geometry.name, Edge.geom_wgs.name) 
+        else pa.field(col, arrow_type_by_dtype[dtypes[col]])
+        for col in columns
+        if col in (Edge.geometry.name, Edge.geom_wgs.name) or col in dtypes
+    ])
+
+def stage_otp_csv_chunks(
+    csv_file: str, 
+    dtypes: dict, 
+    schema: pa.Schema, 
+    staging_file: str, 
+    chunk_size: int, 
+    process_chunk: Callable[[pd.DataFrame], gpd.GeoDataFrame]
+) -> Tuple[int, int]:
+    """Reads a node or edge CSV file exported by OTP in chunks of chunk_size rows. Each chunk is processed by
+    process_chunk (e.g. parsed, reprojected, filtered and clipped) and the columns of the schema are appended
+    to a Parquet file (staging_file). Thus, only one chunk of the CSV data is held in memory at a time.
+    Returns the counts of the read and staged rows.
+    """
+    read_count, staged_count = 0, 0
+    with pq.ParquetWriter(staging_file, schema) as writer:
+        for chunk in pd.read_csv(csv_file, sep=';', dtype=dtypes, chunksize=chunk_size, float_precision='round_trip'):
+            read_count += len(chunk.index)
+            gdf = process_chunk(chunk)
+            staged_count += len(gdf.index)
+            df = pd.DataFrame({
+                col: gpd.GeoSeries(gdf[col]).to_wkb() if schema.field(col).type == pa.binary() else gdf[col]
+                for col in schema.names
+            })
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+    return read_count, staged_count
+
+def read_staged_otp_gdf(staging_file: str) -> gpd.GeoDataFrame:
+    """Reads nodes or edges staged by stage_otp_csv_chunks to GeoDataFrame (as created by get_projected_otp_gdf).
+    """
+    table = pq.read_table(staging_file)
+    df = table.to_pandas()
+    str_columns = [field.name for field in table.schema if field.type == pa.string()]
+    df[str_columns] = df[str_columns].where(df[str_columns].notna(), np.nan)
+    df[Edge.geom_wgs.name] = gpd.GeoSeries.from_wkb(df[Edge.geom_wgs.name], crs=CRS.from_epsg(4326))
+    df[Edge.geometry.name] = gpd.GeoSeries.from_wkb(df[Edge.geometry.name], crs=CRS.from_epsg(3879))
+    return gpd.GeoDataFrame(df, geometry=Edge.geometry.name, crs=CRS.from_epsg(3879))
+
+def read_otp_csvs_by_chunks(
+    node_csv_file: str,
+    edge_csv_file: str,
+    extent,
+    chunk_size: int,
+    staging_dir: str,
+    debug_otp_graph_gpkg: str = None,
+    log: Logger = Logger(printing=True),
+    gpkg_exports: GpkgExportQueue = None
+) -> Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    """Reads nodes and edges from CSV files exported by OTP in chunks, so that peak memory usage is bounded 
+    by chunk_size (rows) instead of the size of the CSV files. Edges of each chunk are filtered by 
+    edge_filter_queries and clipped to the extent (polygon in EPSG:3879), before the remaining data is spilled
+    to Parquet files in staging_dir. Edges are staged first, so that only the nodes of the staged edges need to
+    be staged (other nodes would be deleted from the graph as isolated nodes anyway). Only the compact staged data
+    is then loaded (returned) as GeoDataFrames for building the graph. If debug_otp_graph_gpkg is given, all 
+    (unfiltered) nodes and edges are appended to it chunk by chunk (in the background if gpkg_exports is given).
+    """
+    debug_layers = set()
+
+    def export_debug_chunk(gdf: gpd.GeoDataFrame, layer: str) -> None:
+        mode = 'a' if layer in debug_layers else 'w'
+        if (gpkg_exports != None):
+            gpkg_exports.export(gdf.drop(columns=[Edge.geom_wgs.name]), debug_otp_graph_gpkg, layer, mode=mode, copy=False)
+        else:
+            gdf.drop(columns=[Edge.geom_wgs.name]).to_file(debug_otp_graph_gpkg, layer=layer, driver='GPKG', mode=mode)
+        debug_layers.add(layer)
+
+    # otp ids of the nodes of the staged edges (by chunks)
+    edge_node_ids = []
+
+    def process_edges(chunk: pd.DataFrame) -> gpd.GeoDataFrame:
+        e = get_projected_otp_gdf(chunk, LineString())
+        if (debug_otp_graph_gpkg != None):
+            export_debug_chunk(e, 'edges')
+        for query in edge_filter_queries:
+            e = e.query(query)
+        e = e[geom_utils.get_intersects_mask(e.geometry, extent)]
+        edge_node_ids.append(np.unique(np.concatenate((e['node_orig_id'].to_numpy(), e['node_dest_id'].to_numpy()))))
+        return e
+
+    def process_nodes(chunk: pd.DataFrame) -> gpd.GeoDataFrame:
+        if (debug_otp_graph_gpkg != None):
+            n = get_projected_otp_gdf(chunk, Point())
+            export_debug_chunk(n, 'nodes')
+            return n[n[Node.id_otp.name].isin(staged_node_ids)]
+        # other nodes are not parsed nor reprojected at all
+        return get_projected_otp_gdf(chunk[chunk[Node.id_otp.name].isin(staged_node_ids)].copy(), Point())
+
+    edge_staging_file = os.path.join(staging_dir, 'edges.parquet')
+    edge_schema = __get_staging_schema(__edge_csv_dtypes, [attr.name for attr in Edge] + ['node_orig_id', 'node_dest_id'])
+    read_count, staged_count = stage_otp_csv_chunks(
+        edge_csv_file, __edge_csv_dtypes, edge_schema, edge_staging_file, chunk_size, process_edges
+    )
+    filt_ratio = round(100 * (read_count-staged_count) / read_count, 1)
+    log.info(f'read {read_count} edges in chunks of {chunk_size}, filtered out {read_count-staged_count} ({filt_ratio} %) edges by {edge_filter_queries} and extent')
+
+    staged_node_ids = np.unique(np.concatenate(edge_node_ids)) if edge_node_ids else np.array([], dtype=np.int64)
+    del edge_node_ids
+    node_staging_file = os.path.join(staging_dir, 'nodes.parquet')
+    node_schema = __get_staging_schema(__node_csv_dtypes, [attr.name for attr in Node])
+    read_count, staged_count = stage_otp_csv_chunks(
+        node_csv_file, __node_csv_dtypes, node_schema, node_staging_file, chunk_size, process_nodes
+    )
+    log.info(f'read {read_count} nodes in chunks of {chunk_size}, staged {staged_count} nodes (of the staged edges) to {node_staging_file}')
+
+    log.info('loading staged nodes and edges')
+    return read_staged_otp_gdf(node_staging_file), read_staged_otp_gdf(edge_staging_file)
+
+def get_ig_uv_array(node_ids_otp: pd.Series, orig_ids_otp: pd.Series, dest_ids_otp: pd.Series) -> np.ndarray:
+    """Returns an array of (source, target) ig id pairs for the edges, given the otp ids of the nodes
+    (in the order of the ig ids) and the otp ids of the origin and destination nodes of the edges.
+    Raises ValueError if an edge refers to a node that is not in node_ids_otp.
+    """
+    indexer = pd.Index(node_ids_otp)
+    uv = np.column_stack((indexer.get_indexer(orig_ids_otp), indexer.get_indexer(dest_ids_otp)))
+    if ((uv == -1).any()):
+        missing = set(orig_ids_otp[uv[:, 0] == -1]) | set(dest_ids_otp[uv[:, 1] == -1])
+        raise ValueError(f'edges refer to {len(missing)} unknown nodes (otp ids), e.g. {list(missing)[:5]}')
+    return uv
+
+def get_edge_components(G: ig.Graph) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the strongly connected component of each edge (-1 for edges between components) and the sizes
+    (edge counts) of the components. Equals the edge counts of the subgraphs given by G.decompose(mode='STRONG'), 
+    but the subgraphs are not created.
+    """
+    membership = np.array(G.connected_components(mode='strong').membership, dtype=np.int64)
+    comp_count = membership.max() + 1 if len(membership) else 0
+    uv = np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    source_comps = membership[uv[:, 0]]
+    edge_comps = np.where(source_comps == membership[uv[:, 1]], source_comps, -1)
+    comp_sizes = np.bincount(edge_comps[edge_comps >= 0], minlength=comp_count)
+    return edge_comps, comp_sizes
+
+def get_geom_hashes(geoms: list) -> np.ndarray:
+    """Returns hashes (uint64) of the geometries rounded to centimeter precision (in projected CRS), so that
+    the geometries of different imports (or of an import and a graph read from file) can be compared.
+    """
+    return pd.util.hash_array(shapely.to_wkt(np.asarray(geoms, dtype=object), rounding_precision=2).astype(object))
+
+def get_edge_diff(G: ig.Graph, prev_G: ig.Graph) -> pd.DataFrame:
+    """Matches the edges of a graph to the edges of a previous version of the graph (e.g. from a previous 
+    OTP export) by id_otp and geometry. Returns a DataFrame of columns id_otp, id_ig, id_ig_prev and status, 
+    where status is one of unchanged, changed (geometry), new or deleted. id_ig is -1 for deleted edges and 
+    id_ig_prev is -1 for new edges, hence the rows of unchanged and changed edges map old ids to new ids.
+    """
+    def get_edges(graph: ig.Graph) -> pd.DataFrame:
+        ig_utils.decode_raw_geoms(graph.es, [Edge.geometry])
+        return pd.DataFrame({
+            Edge.id_otp.name: [str(id_otp) for id_otp in graph.es[Edge.id_otp.value]],
+            Edge.id_ig.name: np.arange(graph.ecount()),
+            'geom_hash': pd.array(get_geom_hashes(graph.es[Edge.geometry.value]), dtype='UInt64')
+        })
+
+    edge_diff = pd.merge(
+        get_edges(G), get_edges(prev_G), on=Edge.id_otp.name, how='outer', suffixes=('', '_prev'), indicator=True
+    )
+    edge_diff['status'] = np.select(
+        [
+            edge_diff['_merge'] == 'left_only',
+            edge_diff['_merge'] == 'right_only',
+            (edge_diff['geom_hash'] == edge_diff['geom_hash_prev']).fillna(False).astype(bool)
+        ],
+        ['new', 'deleted', 'unchanged'],
+        default='changed'
+    )
+    for id_col in [Edge.id_ig.name, f'{Edge.id_ig.name}_prev']:
+        edge_diff[id_col] = edge_diff[id_col].fillna(-1).astype(int)
+    return edge_diff[[Edge.id_otp.name, Edge.id_ig.name, f'{Edge.id_ig.name}_prev', 'status']]
+
+# environmental attributes that depend only on the geometry of an edge (and not on the topology of the graph)
+__reusable_edge_attributes = [
+    Edge.noises,
+    Edge.noise_source,
+    Edge.noise_sources,
+    Edge.noise_bins,
+    Edge.aqi,
+    Edge.gvi_gsv,
+    Edge.gvi_low_veg_share,
+    Edge.gvi_high_veg_share,
+    Edge.gvi_comb_gsv_veg,
+    Edge.gvi_comb_gsv_high_veg,
+    Edge.gvi
+]
+
+def reuse_edge_attributes(G: ig.Graph, prev_G: ig.Graph, edge_diff: pd.DataFrame) -> List[str]:
+    """Copies the environmental edge attributes (noises, AQI and GVI) of the previous version of the graph 
+    to the unchanged edges of the graph (see get_edge_diff). New and changed edges get None values (nodata), 
+    to be updated by the later stages of the graph building. Attributes that depend on the topology of the 
+    graph (e.g. uv) are not copied, but uv is recomputed if the previous graph had it. Returns the names of 
+    the copied attributes.
+    """
+    unchanged = edge_diff[edge_diff['status'] == 'unchanged']
+    ids = unchanged[Edge.id_ig.name].to_numpy()
+    prev_ids = unchanged[f'{Edge.id_ig.name}_prev'].to_numpy()
+    prev_attrs = prev_G.es.attribute_names()
+    attrs = [attr.value for attr in __reusable_edge_attributes if attr.value in prev_attrs and attr.value not in G.es.attribute_names()]
+    for attr in attrs:
+        values = np.full(G.ecount(), None, dtype=object)
+        # fromiter keeps sequence values (e.g. tuples) as objects, unlike np.asarray
+        values[ids] = np.fromiter(prev_G.es[attr], dtype=object, count=prev_G.ecount())[prev_ids]
+        G.es[attr] = values.tolist()
+    if (Edge.uv.value in prev_attrs and Edge.uv.value not in G.es.attribute_names()):
+        G.es[Edge.uv.value] = G.get_edgelist()
+    return attrs
+
+def get_prev_edge_id_map(edge_diff: pd.DataFrame, prev_ecount: int) -> np.ndarray:
+    """Returns a mapping of the id_ig values of the edges of the previous graph to the ones of the new graph 
+    (see get_edge_diff) as an int64 array indexed by the previous ids. Deleted edges are mapped to -1. 
+    """
+    matched = edge_diff[edge_diff['status'].isin(['unchanged', 'changed'])]
+    id_map = np.full(prev_ecount, -1, dtype=np.int64)
+    id_map[matched[f'{Edge.id_ig.name}_prev'].to_numpy()] = matched[Edge.id_ig.name].to_numpy()
+    return id_map
 
 def convert_otp_graph_to_igraph(
     node_csv_file: str,
@@ -23,212 +316,242 @@ def convert_otp_graph_to_igraph(
     b_export_final_graph_to_gpkg: bool = False,
     debug_otp_graph_gpkg: str = 'debug/otp_graph_features.gpkg',
     debug_igraph_gpkg: str = 'debug/otp2igraph_features.gpkg',
-    log: Logger = Logger(printing=True)
+    log: Logger = Logger(printing=True),
+    clip_processes: int = 1,
+    prev_igraph_file: str = None,
+    edge_diff_csv_file: str = None,
+    chunk_size: int = None,
+    staging_dir: str = None,
+    stage_report_file: str = None,
+    id_mapping_file: str = None,
+    prev_edge_id_map_file: str = None
     ) -> dict:
 
-    hma_poly = geom_utils.project_geom(gpd.read_file(hma_poly_file)['geometry'][0])
-
-    # 1) read nodes nodes from CSV
-    n = pd.read_csv(node_csv_file, sep=';')
-    log.info(f'read {len(n.index)} nodes')
-    log.debug(f'node column types: {n.dtypes}')
-    log.debug(f'nodes head: {n.head()}')
-    log.info('creating node gdf')
-    n[Node.geometry.name] = [shapely.wkt.loads(geom) if isinstance(geom, str) else Point() for geom in n[Node.geometry.name]]
-    n[Node.geom_wgs.name] = n[Node.geometry.name]
-    n = gpd.GeoDataFrame(n, geometry=Node.geometry.name, crs=CRS.from_epsg(4326))
-    log.info('reprojecting nodes to etrs')
-    n = n.to_crs(epsg=3879)
-    log.debug(f'nodes head: {n.head()}')
-
-    # 2) read edges from CSV
-    e = pd.read_csv(edge_csv_file, sep=';')
-    log.info(f'read {len(e.index)} edges')
-    log.debug(f'edge column types: {e.dtypes}')
-    log.debug(f'edges head: {e.head()}')
-    log.info('creating edge gdf')
-    e[Edge.geometry.name] = [shapely.wkt.loads(geom) if isinstance(geom, str) else LineString() for geom in e[Edge.geometry.name]]
-    e[Edge.geom_wgs.name] = e[Edge.geometry.name]
-    e = gpd.GeoDataFrame(e, geometry=Edge.geometry.name, crs=CRS.from_epsg(4326))
-    log.info('reprojecting edges to etrs')
-    e = e.to_crs(epsg=3879)
-    log.debug(f'edges head: {e.head()}')
-
-    # 3) export graph data to gpkg
-    if (b_export_otp_data_to_gpkg == True):
-        log.info('writing otp graph data to gpkg')
-        e.drop(columns=[Edge.geom_wgs.name]).to_file(debug_otp_graph_gpkg, layer='edges', driver='GPKG')
-        log.info(f'exported edges to {debug_otp_graph_gpkg} (layer=edges)')
-        n.drop(columns=[Edge.geom_wgs.name]).to_file(debug_otp_graph_gpkg, layer='nodes', driver='GPKG')
-        log.info(f'exported nodes to {debug_otp_graph_gpkg} (layer=nodes)')
-
-    # 4) filter out edges that are unsuitable for both walking and cycling
-    def filter_df_by_query(df: pd.DataFrame, query: str, name: str = 'rows'):
-        count_before = len(df.index)
-        df_filt = df.query(query).copy()
-        filt_ratio = (count_before-len(df_filt.index)) / count_before
-        log.info(f'filtered out {count_before-len(df_filt.index)} {name} ({round(filt_ratio * 100, 1)} %) by {query}')
-        return df_filt
-
-    e_filt = filter_df_by_query(e, f'{Edge.allows_walking.name} == True or {Edge.allows_biking.name} == True', name='edges')
-    e_filt = filter_df_by_query(e_filt, f'{Edge.is_no_thru_traffic.name} == False', name='edges')
-
-    # 5) create a dictionaries for converting otp ids to ig ids and vice versa
-    log.debug('create maps for converting otp ids to ig ids')
-    n[Node.id_ig.name] = np.arange(len(n.index))
-    ids_otp_ig = {}
-    ids_ig_otp = {}
-    for node in n.itertuples():
-        ids_otp_ig[getattr(node, Node.id_otp.name)] = getattr(node, Node.id_ig.name)
-        ids_ig_otp[getattr(node, Node.id_ig.name)] = getattr(node, Node.id_otp.name)
-        
-    # 6) add nodes to graph
-    log.info('adding nodes to graph')
-    G = ig.Graph(directed=True)
-    G.add_vertices(len(n.index))
-    for attr in Node:
-        if (attr.name in n.columns):
-            G.vs[attr.value] = list(n[attr.name])
+    # stages of the import are measured only if a report file is given
+    stages = StageProfiler(log=log, enabled=stage_report_file != None and stage_report_file != '')
+
+    with stages.stage('0) read extent'):
+        hma_poly = geom_utils.project_geom(gpd.read_file(hma_poly_file)['geometry'][0])
+        hma_buffered = hma_poly.buffer(100)
+
+    # debug layers are written to GeoPackages in a background thread (only if some are exported)
+    b_debug_exports = b_export_otp_data_to_gpkg or b_export_decomposed_igraphs_to_gpkg or b_export_final_graph_to_gpkg
+    with (GpkgExportQueue(log) if b_debug_exports else nullcontext()) as gpkg_exports:
+        if (chunk_size != None):
+            # 1) – 4) read, reproject, filter and clip (to HMA) nodes and edges chunk by chunk via staging files
+            with stages.stage('1-4) read, filter and clip nodes and edges by chunks') as stage:
+                # staging files are written to a temporary directory (removed also on errors) if no staging_dir is given
+                with (tempfile.TemporaryDirectory() if staging_dir == None else nullcontext(staging_dir)) as chunk_staging_dir:
+                    n, e_filt = read_otp_csvs_by_chunks(
+                        node_csv_file, 
+                        edge_csv_file,
+                        hma_buffered,
+                        chunk_size,
+                        chunk_staging_dir,
+                        debug_otp_graph_gpkg if b_export_otp_data_to_gpkg == True else None,
+                        log=log,
+                        gpkg_exports=gpkg_exports
+                    )
+                stage.rows = len(e_filt.index)
         else:
-            log.warning(f'node column {attr.name} not present in dataframe')
-
-    # 7) add edges to graph
-    log.info('adding edges to graph')
-
-    # get edge lengths by projected geometry
-    e_filt[Edge.length.name] = [round(geom.length, 4) if isinstance(geom, LineString) else 0.0 for geom in e_filt[Edge.geometry.name]]
-
-    def get_ig_uv(edge):
-        return (ids_otp_ig[edge['node_orig_id']], ids_otp_ig[edge['node_dest_id']])
-
-    e_filt['uv_ig'] = e_filt.apply(lambda row: get_ig_uv(row), axis=1)
-    e_filt[Edge.id_ig.name] = np.arange(len(e_filt.index))
-    G.add_edges(list(e_filt['uv_ig']))
-    for attr in Edge:
-        if (attr.name in e_filt.columns):
-            G.es[attr.value] = list(e_filt[attr.name])
-        else:
-            log.warning(f'edge column {attr.name} not present in dataframe')
-
-    # 8) delete edges outside Helsinki Metropolitan Area (HMA)
-    hma_buffered = hma_poly.buffer(100)
-
-    def intersects_hma(geom: LineString):
-        if (geom.is_empty == True): return True
-        return True if geom.intersects(hma_buffered) else False
-
-    e_gdf = ig_utils.get_edge_gdf(G)
-    log.info('finding edges that intersect with HMA')
-    e_gdf['in_hma'] = [intersects_hma(line) for line in e_gdf[Edge.geometry.name]]
-    e_gdf_del = e_gdf.query('in_hma == False').copy()
-    out_ratio = round(100 * len(e_gdf_del.index)/len(e_gdf.index), 1)
-    log.info(f'found {len(e_gdf_del.index)} ({out_ratio} %) edges outside HMA')
-
-    log.info('deleting edges')
-    before_count = G.ecount()
-    G.delete_edges(e_gdf_del.index.tolist())
-    after_count = G.ecount()
-    log.info(f'deleted {before_count-after_count} edges')
-
-    # check if id_ig:s need to be updated to edge attributes
-    mismatch_count = len([edge.index for edge in G.es if edge.attributes()[Edge.id_ig.value] != edge.index])
-    log.info(f'invalid edge ids: {mismatch_count}')
-    # reassign igraph indexes to edge and node attributes
-    G.es[Edge.id_ig.value] = [e.index for e in G.es]
-    G.vs[Node.id_ig.value] = [v.index for v in G.vs]
-    # check if id_ig:s need to be updated to edge attributes
-    mismatch_count = len([edge.index for edge in G.es if edge.attributes()[Edge.id_ig.value] != edge.index])
-    log.info(f'invalid edge ids: {mismatch_count} (after re-indexing)')
-
-    # 9) find and inspect subgraphs by decomposing the graph
-    sub_graphs = G.decompose(mode='STRONG')
-    log.info(f'found {len(sub_graphs)} subgraphs')
-
-    graph_sizes = [graph.ecount() for graph in sub_graphs]
-    log.info(f'subgraphs with more than 10 edges: {len([s for s in graph_sizes if s > 10])}')
-    log.info(f'subgraphs with more than 50 edges: {len([s for s in graph_sizes if s > 50])}')
-    log.info(f'subgraphs with more than 100 edges: {len([s for s in graph_sizes if s > 100])}')
-    log.info(f'subgraphs with more than 500 edges: {len([s for s in graph_sizes if s > 500])}')
-    log.info(f'subgraphs with more than 10000 edges: {len([s for s in graph_sizes if s > 10000])}')
-
-    small_graphs = [graph for graph in sub_graphs if graph.ecount() <= 15]
-    medium_graphs = [graph for graph in sub_graphs if (graph.ecount() > 15 and graph.ecount() <= 500)]
-    big_graphs = [graph for graph in sub_graphs if graph.ecount() > 500]
-
-    small_graph_edges = []
-    for graph_id, graph in enumerate(small_graphs):
-        edges = ig_utils.get_edge_dicts(graph, attrs=[Edge.id_otp, Edge.id_ig, Edge.geometry])
-        for edge in edges:
-            edge['graph_id'] = graph_id
-        small_graph_edges.extend(edges)
-
-    medium_graph_edges = []
-    for graph_id, graph in enumerate(medium_graphs):
-        edges = ig_utils.get_edge_dicts(graph, attrs=[Edge.id_otp, Edge.id_ig, Edge.geometry])
-        for edge in edges:
-            edge['graph_id'] = graph_id
-        medium_graph_edges.extend(edges)
-
-    big_graph_edges = []
-    for graph_id, graph in enumerate(big_graphs):
-        edges = ig_utils.get_edge_dicts(graph, attrs=[Edge.id_otp, Edge.id_ig, Edge.geometry])
-        for edge in edges:
-            edge['graph_id'] = graph_id
-        big_graph_edges.extend(edges)
-
-    if (b_export_decomposed_igraphs_to_gpkg == True):
-        log.info('exporting subgraphs to gpkg')
-        # graphs with <= 15 edges
-        small_graph_edges_gdf = gpd.GeoDataFrame(small_graph_edges, crs=CRS.from_epsg(3879))
-        small_graph_edges_gdf.to_file(debug_igraph_gpkg, layer='small_graph_edges', driver='GPKG')
-        # graphs with  15–500 edges
-        medium_graph_edges_gdf = gpd.GeoDataFrame(medium_graph_edges, crs=CRS.from_epsg(3879))
-        medium_graph_edges_gdf.to_file(debug_igraph_gpkg, layer='medium_graph_edges', driver='GPKG')
-        # graphs with > 500 edges
-        big_graph_edges_gdf = gpd.GeoDataFrame(big_graph_edges, crs=CRS.from_epsg(3879))
-        big_graph_edges_gdf.to_file(debug_igraph_gpkg, layer='big_graph_edges', driver='GPKG')
-        log.info(f'graphs exported')
-
-    # 10) delete smallest subgraphs from the graph
-    del_edge_ids = [edge[Edge.id_ig.name] for edge in small_graph_edges]
-    log.info(f'deleting {len(del_edge_ids)} isolated edges')
-    before_count = G.ecount()
-    G.delete_edges(del_edge_ids)
-    after_count = G.ecount()
-    del_ratio = round(100 * (before_count-after_count) / before_count, 1)
-    log.info(f'deleted {before_count-after_count} ({del_ratio} %) edges')
-
-    # 11) delete isolated nodes from the graph
-    del_node_ids = [v.index for v in G.vs.select(_degree_eq=0)]
-    log.info(f'deleting {len(del_node_ids)} isolated nodes')
-    before_count = G.vcount()
-    G.delete_vertices(del_node_ids)
-    after_count = G.vcount()
-    del_ratio = round(100 * (before_count-after_count) / before_count, 1)
-    log.info(f'deleted {before_count-after_count} ({del_ratio} %) nodes')
-
-    # check if id_ig:s need to be updated to edge attributes
-    mismatch_count = len([edge.index for edge in G.es if edge.attributes()[Edge.id_ig.value] != edge.index])
-    log.info(f'invalid edge ids: {mismatch_count}')
-    # reassign igraph indexes to edge and node attributes
-    G.es[Edge.id_ig.value] = [e.index for e in G.es]
-    G.vs[Node.id_ig.value] = [v.index for v in G.vs]
-    # check if id_ig:s need to be updated to edge attributes
-    mismatch_count = len([edge.index for edge in G.es if edge.attributes()[Edge.id_ig.value] != edge.index])
-    log.info(f'invalid edge ids: {mismatch_count} (after re-indexing)')
-
-    # 12) export graph data to GeoDataFrames fro debugging
-
-    if (b_export_final_graph_to_gpkg == True):
-        log.info(f'exporting final graph to {debug_igraph_gpkg} for debugging')
-        e_gdf = ig_utils.get_edge_gdf(G, attrs=[Edge.id_otp, Edge.id_ig], ig_attrs=['source', 'target'])
-        n_gdf = ig_utils.get_node_gdf(G, ig_attrs=['index'])
-        e_gdf.to_file(debug_igraph_gpkg, layer='final_graph_edges', driver='GPKG')
-        n_gdf.to_file(debug_igraph_gpkg, layer='final_graph_nodes', driver='GPKG')
-
-    if (igraph_out_file != None and igraph_out_file != ''):
-        ig_utils.export_to_graphml(G, igraph_out_file)
-
+            # 1) read nodes nodes from CSV
+            with stages.stage('1) read nodes') as stage:
+                n = read_otp_csv(node_csv_file, __node_csv_dtypes)
+                log.info(f'read {len(n.index)} nodes')
+                log.debug(f'node column types: {n.dtypes}')
+                log.debug(f'nodes head: {n.head()}')
+                log.info('creating node gdf (reprojected to etrs)')
+                n = get_projected_otp_gdf(n, Point())
+                log.debug(f'nodes head: {n.head()}')
+                stage.rows = len(n.index)
+
+            # 2) read edges from CSV
+            with stages.stage('2) read edges') as stage:
+                e = read_otp_csv(edge_csv_file, __edge_csv_dtypes)
+                log.info(f'read {len(e.index)} edges')
+                log.debug(f'edge column types: {e.dtypes}')
+                log.debug(f'edges head: {e.head()}')
+                log.info('creating edge gdf (reprojected to etrs)')
+                e = get_projected_otp_gdf(e, LineString())
+                log.debug(f'edges head: {e.head()}')
+                stage.rows = len(e.index)
+
+            # 3) export graph data to gpkg
+            with stages.stage('3) export otp data to gpkg'):
+                if (b_export_otp_data_to_gpkg == True):
+                    log.info(f'exporting otp graph data to {debug_otp_graph_gpkg} (layers=edges, nodes)')
+                    gpkg_exports.export(e.drop(columns=[Edge.geom_wgs.name]), debug_otp_graph_gpkg, 'edges', copy=False)
+                    gpkg_exports.export(n.drop(columns=[Edge.geom_wgs.name]), debug_otp_graph_gpkg, 'nodes', copy=False)
+
+            # 4) filter out edges that are unsuitable for both walking and cycling
+            def filter_df_by_query(df: pd.DataFrame, query: str, name: str = 'rows'):
+                count_before = len(df.index)
+                df_filt = df.query(query).copy()
+                filt_ratio = (count_before-len(df_filt.index)) / count_before
+                log.info(f'filtered out {count_before-len(df_filt.index)} {name} ({round(filt_ratio * 100, 1)} %) by {query}')
+                return df_filt
+
+            with stages.stage('4) filter edges') as stage:
+                e_filt = e
+                for query in edge_filter_queries:
+                    e_filt = filter_df_by_query(e_filt, query, name='edges')
+                del e
+                stage.rows = len(e_filt.index)
+
+        # 5) map otp ids of the nodes of the edges to ig ids (indexes of the nodes)
+        with stages.stage('5) map otp ids to ig ids') as stage:
+            log.debug('create indexer for converting otp ids to ig ids')
+            n[Node.id_ig.name] = np.arange(len(n.index))
+            uv_ig = get_ig_uv_array(n[Node.id_otp.name], e_filt['node_orig_id'], e_filt['node_dest_id'])
+            e_filt[Edge.id_ig.name] = np.arange(len(e_filt.index))
+
+            # get edge lengths by projected geometry
+            e_filt[Edge.length.name] = np.where(
+                e_filt.geometry.geom_type == 'LineString', 
+                np.round(e_filt.geometry.length, 4), 
+                0.0
+            )
+            stage.rows = len(e_filt.index)
+
+        # 6) & 7) create graph with all nodes, edges and their attributes at once
+        with stages.stage('6-7) create graph') as stage:
+            log.info('adding nodes and edges to graph')
+            for attr in Node:
+                if (attr.name not in n.columns):
+                    log.warning(f'node column {attr.name} not present in dataframe')
+            for attr in Edge:
+                if (attr.name not in e_filt.columns):
+                    log.warning(f'edge column {attr.name} not present in dataframe')
+
+            G = ig.Graph(
+                n=len(n.index),
+                edges=uv_ig,
+                directed=True,
+                vertex_attrs={attr.value: n[attr.name].tolist() for attr in Node if attr.name in n.columns},
+                edge_attrs={attr.value: e_filt[attr.name].tolist() for attr in Edge if attr.name in e_filt.columns}
+            )
+            stage.rows = G.ecount()
+
+        # 8) delete edges outside Helsinki Metropolitan Area (HMA) (unless clipped already by chunks)
+        with stages.stage('8) clip edges to HMA') as stage:
+            if (chunk_size == None):
+                log.info('finding edges that intersect with HMA')
+                in_hma = geom_utils.get_intersects_mask(G.es[Edge.geometry.value], hma_buffered, processes=clip_processes)
+                del_edge_ids = np.flatnonzero(~in_hma).tolist()
+                out_ratio = round(100 * len(del_edge_ids)/G.ecount(), 1)
+                log.info(f'found {len(del_edge_ids)} ({out_ratio} %) edges outside HMA')
+
+                log.info('deleting edges')
+                before_count = G.ecount()
+                G.delete_edges(del_edge_ids)
+                after_count = G.ecount()
+                log.info(f'deleted {before_count-after_count} edges')
+
+            # check if id_ig:s need to be updated to edge attributes
+            log.info(f'invalid edge ids: {ig_utils.get_id_mismatch_count(G.es, Edge.id_ig)}')
+            # reassign igraph indexes to edge and node attributes
+            clip_id_mapping = ig_utils.reindex_graph(G)
+            log.info(f'invalid edge ids: {ig_utils.get_id_mismatch_count(G.es, Edge.id_ig)} (after re-indexing)')
+            stage.rows = G.ecount()
+
+        # 9) find and inspect strongly connected subgraphs (by component membership, without copying them)
+        with stages.stage('9) find strongly connected subgraphs') as stage:
+            edge_comps, comp_sizes = get_edge_components(G)
+            log.info(f'found {len(comp_sizes)} subgraphs')
+
+            for size in [10, 50, 100, 500, 10000]:
+                log.info(f'subgraphs with more than {size} edges: {np.count_nonzero(comp_sizes > size)}')
+
+            size_classes = {
+                'small': comp_sizes <= 15,
+                'medium': (comp_sizes > 15) & (comp_sizes <= 500),
+                'big': comp_sizes > 500
+            }
+            in_component = edge_comps >= 0
+            small_graph_edges = in_component & size_classes['small'][edge_comps]
+
+            if (b_export_decomposed_igraphs_to_gpkg == True):
+                log.info('exporting subgraphs to gpkg')
+                e_gdf = ig_utils.get_edge_gdf(G, attrs=[Edge.id_otp, Edge.id_ig])
+                # graphs with <= 15, 15–500 and > 500 edges
+                for size_class, comps_in_class in size_classes.items():
+                    class_edges = in_component & comps_in_class[edge_comps]
+                    class_gdf = e_gdf[class_edges].copy()
+                    # graph_id is the running number of the subgraph within the size class
+                    class_gdf['graph_id'] = np.searchsorted(np.flatnonzero(comps_in_class), edge_comps[class_edges])
+                    gpkg_exports.export(class_gdf.sort_values('graph_id', kind='stable'), debug_igraph_gpkg, f'{size_class}_graph_edges', copy=False)
+            stage.rows = len(comp_sizes)
+
+        # 10) delete smallest subgraphs from the graph
+        with stages.stage('10) delete small subgraphs') as stage:
+            del_edge_ids = np.flatnonzero(small_graph_edges).tolist()
+            log.info(f'deleting {len(del_edge_ids)} isolated edges')
+            before_count = G.ecount()
+            G.delete_edges(del_edge_ids)
+            after_count = G.ecount()
+            del_ratio = round(100 * (before_count-after_count) / before_count, 1)
+            log.info(f'deleted {before_count-after_count} ({del_ratio} %) edges')
+            stage.rows = len(del_edge_ids)
+
+        # 11) delete isolated nodes from the graph
+        with stages.stage('11) delete isolated nodes') as stage:
+            del_node_ids = [v.index for v in G.vs.select(_degree_eq=0)]
+            log.info(f'deleting {len(del_node_ids)} isolated nodes')
+            before_count = G.vcount()
+            G.delete_vertices(del_node_ids)
+            after_count = G.vcount()
+            del_ratio = round(100 * (before_count-after_count) / before_count, 1)
+            log.info(f'deleted {before_count-after_count} ({del_ratio} %) nodes')
+
+            # check if id_ig:s need to be updated to edge attributes
+            log.info(f'invalid edge ids: {ig_utils.get_id_mismatch_count(G.es, Edge.id_ig)}')
+            # reassign igraph indexes to edge and node attributes
+            id_mapping = ig_utils.combine_id_mappings(clip_id_mapping, ig_utils.reindex_graph(G))
+            log.info(f'invalid edge ids: {ig_utils.get_id_mismatch_count(G.es, Edge.id_ig)} (after re-indexing)')
+            if (id_mapping_file != None and id_mapping_file != ''):
+                # maps ids of the edges and nodes of the initial graph (as created in step 7) to the final ids
+                ig_utils.save_id_mapping(id_mapping, id_mapping_file)
+                log.info(f'exported id mapping to {id_mapping_file}')
+            stage.rows = len(del_node_ids)
+
+        # 12) match edges to the previous version of the graph and reuse attributes of unchanged edges
+        with stages.stage('12) match edges to previous graph') as stage:
+            if (prev_igraph_file != None and prev_igraph_file != ''):
+                log.info(f'comparing edges to previous graph {prev_igraph_file}')
+                prev_G = ig_utils.read_graphml(prev_igraph_file, log=log)
+                edge_diff = get_edge_diff(G, prev_G)
+                for status, count in edge_diff['status'].value_counts().items():
+                    log.info(f'found {count} {status} edges')
+                reused_attrs = reuse_edge_attributes(G, prev_G, edge_diff)
+                log.info(f'reused attributes {reused_attrs} of unchanged edges')
+                if (edge_diff_csv_file != None and edge_diff_csv_file != ''):
+                    # only new, changed and deleted edges are written (to be processed by the later stages)
+                    edge_diff[edge_diff['status'] != 'unchanged'].to_csv(edge_diff_csv_file, sep=';', index=False)
+                    log.info(f'exported edge diff to {edge_diff_csv_file}')
+                if (prev_edge_id_map_file != None and prev_edge_id_map_file != ''):
+                    np.save(prev_edge_id_map_file, get_prev_edge_id_map(edge_diff, prev_G.ecount()))
+                    log.info(f'exported mapping of previous edge ids to {prev_edge_id_map_file}')
+                stage.rows = len(edge_diff.index)
+
+        # 13) export graph data to GeoDataFrames fro debugging
+        with stages.stage('13) export final graph to gpkg'):
+            if (b_export_final_graph_to_gpkg == True):
+                log.info(f'exporting final graph to {debug_igraph_gpkg} for debugging')
+                e_gdf = ig_utils.get_edge_gdf(G, attrs=[Edge.id_otp, Edge.id_ig], ig_attrs=['source', 'target'])
+                n_gdf = ig_utils.get_node_gdf(G, ig_attrs=['index'])
+                gpkg_exports.export(e_gdf, debug_igraph_gpkg, 'final_graph_edges', copy=False)
+                gpkg_exports.export(n_gdf, debug_igraph_gpkg, 'final_graph_nodes', copy=False)
+
+        with stages.stage('14) export graph') as stage:
+            if (igraph_out_file != None and igraph_out_file != ''):
+                ig_utils.export_to_graphml(G, igraph_out_file)
+            stage.rows = G.ecount()
+
+        with stages.stage('15) wait for debug exports'):
+            if (gpkg_exports != None):
+                gpkg_exports.wait()
+
+    stages.export_report(stage_report_file)
     return G
 
 
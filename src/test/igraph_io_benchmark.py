@@ -0,0 +1,185 @@
+"""Benchmarks for loading and exporting graph files with common.igraph.
+
+The benchmarks are run on the test graph and on synthetic graphs scaled to N times its size,
+built by tiling the test graph. Durations and peak memory usage of the functions are written 
+to a JSON file, so that the results of different runs can be compared. Peak memory usage is 
+measured as the peak resident set size (RSS) of a fresh subprocess running the function, so that
+also the allocations of GEOS and igraph (C libraries) are included. For functions that need 
+a loaded graph, the peak RSS after loading it (setup) is reported as well.
+
+Usage (in src/test): python igraph_io_benchmark.py [--graph_file] [--scales] [--repeat_count] [--out_file]
+"""
+
+import sys
+sys.path.append('..')
+import os
+import json
+import math
+import time
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List
+import igraph as ig
+from shapely.affinity import translate
+import common.igraph as ig_utils
+from common.igraph import Edge as E, Node as N
+from common.logger import Logger, get_peak_rss_mb
+
+def time_function(func: Callable, repeat_count: int) -> float:
+    """Returns the minimum duration (s) of a number of calls of the given function.
+    """
+    durations = []
+    for _ in range(repeat_count):
+        start_time = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start_time)
+    return min(durations)
+
+def get_functions(graph_file: str, export_file: str, graph: ig.Graph = None) -> Dict[str, Callable]:
+    """Returns the benchmarked functions by name. The graph is needed by the functions other than the readers.
+    """
+    return {
+        'read_graphml (per_value_decode)': lambda: ig_utils.read_graphml(graph_file, bulk_decode=False),
+        'read_graphml': lambda: ig_utils.read_graphml(graph_file),
+        'export_to_graphml': lambda: ig_utils.export_to_graphml(graph, export_file),
+        'get_edge_gdf': lambda: ig_utils.get_edge_gdf(graph, attrs=[E.id_ig, E.length]),
+        'get_node_gdf': lambda: ig_utils.get_node_gdf(graph, attrs=[N.id_ig])
+    }
+
+def reset_peak_rss() -> None:
+    """Resets the peak RSS of the process to its current RSS (only on Linux, elsewhere does nothing).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def measure_peak_rss(function_name: str, graph_file: str, export_file: str) -> dict:
+    """Runs the given function once and returns the peak RSS (MB) of the process before (setup) and during the call.
+    The peak is reset after the setup where possible, so that the peak of loading the graph does not hide the peak
+    of the function. Should be run in a fresh process (see get_peak_rss).
+    """
+    graph = None if function_name.startswith('read_graphml') else ig_utils.read_graphml(graph_file)
+    setup_peak_rss = get_peak_rss_mb()
+    reset_peak_rss()
+    get_functions(graph_file, export_file, graph)[function_name]()
+    return { 'setup_peak_rss_mb': setup_peak_rss, 'peak_rss_mb': get_peak_rss_mb() }
+
+def get_peak_rss(function_name: str, graph_file: str, export_file: str) -> dict:
+    """Measures the peak RSS of a function in a fresh (spawned) subprocess, so that the memory used by previous
+    benchmarks does not affect the result.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        peak_rss = executor.submit(measure_peak_rss, function_name, graph_file, export_file).result()
+    return { name: round(value, 2) if value is not None else None for name, value in peak_rss.items() }
+
+def get_tiled_graph(graph: ig.Graph, scale: int) -> ig.Graph:
+    """Returns a synthetic graph of [scale] copies of the given graph, tiled next to each other
+    by translating the geometries of the copies.
+    """
+    if (scale == 1):
+        return graph.copy()
+
+    col_count = math.ceil(math.sqrt(scale))
+    tile_offsets = {}
+    for geom_attr in [E.geometry, E.geom_wgs]:
+        minx, miny, maxx, maxy = ig_utils.get_edge_gdf(graph, geom_attr=geom_attr).total_bounds
+        tile_offsets[geom_attr.value] = [
+            ((idx % col_count) * (maxx - minx) * 1.1, (idx // col_count) * (maxy - miny) * 1.1) for idx in range(scale)
+        ]
+
+    tiled = ig.Graph(directed=graph.is_directed())
+    tiled.add_vertices(graph.vcount() * scale)
+    tiled.add_edges([
+        (source + tile * graph.vcount(), target + tile * graph.vcount())
+        for tile in range(scale) for source, target in graph.get_edgelist()
+    ])
+
+    for seq, tiled_seq in [(graph.vs, tiled.vs), (graph.es, tiled.es)]:
+        for attr in seq.attribute_names():
+            values = seq[attr]
+            if (attr in tile_offsets):
+                tiled_seq[attr] = [
+                    translate(geom, xoff, yoff) for xoff, yoff in tile_offsets[attr] for geom in values
+                ]
+            else:
+                tiled_seq[attr] = values * scale
+
+    tiled.vs[N.id_ig.value] = list(range(tiled.vcount()))
+    tiled.es[E.id_ig.value] = list(range(tiled.ecount()))
+    return tiled
+
+def benchmark_graph(log: Logger, graph: ig.Graph, graph_name: str, repeat_count: int, temp_dir: str) -> List[dict]:
+    """Benchmarks the I/O functions of common.igraph on the given graph.
+    """
+    graph_file = os.path.join(temp_dir, f'{graph_name}.graphml')
+    export_file = os.path.join(temp_dir, f'{graph_name}_export.graphml')
+    ig_utils.export_to_graphml(graph, graph_file)
+    graph = ig_utils.read_graphml(graph_file)
+
+    results = []
+    for name, func in get_functions(graph_file, export_file, graph).items():
+        duration = time_function(func, repeat_count)
+        peak_rss = get_peak_rss(name, graph_file, export_file)
+        log.info(f'{graph_name}: {name}: {round(duration, 3)} s, peak RSS {peak_rss["peak_rss_mb"]} MB (setup {peak_rss["setup_peak_rss_mb"]} MB)')
+        results.append({
+            'graph': graph_name,
+            'ecount': graph.ecount(),
+            'vcount': graph.vcount(),
+            'function': name,
+            'duration_s': round(duration, 4),
+            **peak_rss
+        })
+    return results
+
+def run_benchmarks(
+    log: Logger,
+    graph_file: str,
+    scales: List[int] = [1, 10, 100],
+    repeat_count: int = 3,
+    out_file: str = None
+) -> dict:
+    """Runs the benchmarks on the given graph and its scaled (tiled) versions and writes the results to
+    a JSON file (out_file) if it is given.
+    """
+    graph = ig_utils.read_graphml(graph_file)
+    graph_name = os.path.splitext(os.path.basename(graph_file))[0]
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for scale in scales:
+            log.info(f'creating graph of scale {scale}x')
+            tiled_graph = get_tiled_graph(graph, scale)
+            results.extend(benchmark_graph(log, tiled_graph, f'{graph_name}_x{scale}', repeat_count, temp_dir))
+            del(tiled_graph)
+
+    benchmark = {
+        'created': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'igraph': ig.__version__,
+        'graph_file': graph_file,
+        'repeat_count': repeat_count,
+        'results': results
+    }
+
+    if out_file:
+        with open(out_file, 'w') as f:
+            json.dump(benchmark, f, indent=2)
+        log.info(f'wrote benchmark results to {out_file}')
+
+    return benchmark
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Benchmark I/O functions of common.igraph')
+    parser.add_argument('--graph_file', default='data/test_graph.graphml')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--repeat_count', type=int, default=3)
+    parser.add_argument('--out_file', default='igraph_io_benchmark.json')
+    args = parser.parse_args()
+
+    run_benchmarks(Logger(printing=True), args.graph_file, args.scales, args.repeat_count, args.out_file)
@@ -3,6 +3,7 @@ sys.path.append('..')
 sys.path.append('../noise_graph_join')
 import os
 import time
+import shutil
 from collections import Counter
 import fiona
 import unittest
@@ -11,10 +12,12 @@ import pandas as pd
 import geopandas as gpd
 import noise_graph_join.utils as utils
 import common.igraph as ig_utils
-from noise_graph_join import noise_graph_join, noise_graph_update
+from noise_graph_join import noise_graph_join, noise_graph_update, noise_raster
 from common.igraph import Edge as E
 from common.logger import Logger
+from common.gpkg_export import GpkgExportQueue
 import common.geometry as geom_utils
+import graph_export.utils as export_utils
 from shapely.geometry import LineString, Polygon, Point, GeometryCollection
 
 log = Logger()
@@ -59,6 +62,126 @@ class TestNoiseGraphJoinUtils(unittest.TestCase):
                 sampling_length_sum = edge_sps['sample_len'].sum()            
                 self.assertAlmostEqual(sampling_length_sum, edge.geometry.length, 5)
 
+    def test_get_sampling_point_gdf(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        gdf = ig_utils.get_edge_gdf(graph)
+        sampling_gdf = utils.get_sampling_point_gdf(gdf, 2)
+        self.assertEqual(list(sampling_gdf.columns), ['edge_id', 'sample_len', 'geometry'])
+        self.assertEqual(len(sampling_gdf), 58554)
+        self.assertEqual(sampling_gdf['edge_id'].nunique(), 3522)
+        # equals sampling points created per edge
+        exploded_gdf = utils.explode_sampling_point_gdf(utils.add_sampling_points_to_gdf(gdf, 2), 'sampling_points')
+        self.assertEqual(list(sampling_gdf['edge_id']), list(exploded_gdf['edge_id']))
+        self.assertEqual(list(sampling_gdf['sample_len']), list(exploded_gdf['sample_len']))
+        for point, exploded_point in zip(sampling_gdf['geometry'], exploded_gdf['geometry']):
+            self.assertTrue(point.equals_exact(exploded_point, 1e-9))
+
+    def test_get_xy_ids(self):
+        xs = np.array([25501668.94, 25501668.96, 25501668.9, 25497000.0])
+        ys = np.array([6684943.12, 6684943.12, 6684943.1, 6684943.1])
+        xy_ids = utils.get_xy_ids(xs, ys)
+        self.assertEqual(xy_ids.dtype, np.int64)
+        self.assertEqual(len(set(xy_ids)), 3)
+        self.assertEqual(xy_ids[0], xy_ids[2])
+        x_back, y_back = utils.get_xy_from_xy_ids(xy_ids)
+        self.assertTrue(np.allclose(x_back, [25501668.9, 25501669.0, 25501668.9, 25497000.0]))
+        self.assertTrue(np.allclose(y_back, [6684943.1, 6684943.1, 6684943.1, 6684943.1]))
+        with self.assertRaises(ValueError):
+            utils.get_xy_ids(np.array([25501668.9]), np.array([-1.0]))
+
+    def test_query_noise_values(self):
+        noise_layers = {
+            'hel_road': gpd.GeoDataFrame({'hel_road': [55.0, 65.0]}, geometry=[
+                Point(25501668.9, 6684943.1).buffer(50), Point(25501700.0, 6684943.1).buffer(20)
+            ], crs=3879),
+            'hel_train': gpd.GeoDataFrame({'hel_train': [50.0]}, geometry=[Point(25501600.0, 6684943.1).buffer(40)], crs=3879)
+        }
+        point_gdf = gpd.GeoDataFrame({'xy_id': [1, 2, 3, 4]}, geometry=[
+            Point(25501668.9, 6684943.1), Point(25501700.0, 6684943.1), Point(25501630.0, 6684943.1), Point(25500000.0, 6680000.0)
+        ], crs=3879)
+        noise_index = utils.get_noise_layer_index(noise_layers)
+        samples = utils.query_noise_values(point_gdf, noise_index)
+        self.assertEqual(list(samples.columns), ['xy_id', 'geometry', 'hel_road', 'hel_train'])
+        self.assertEqual(list(samples['hel_road'].fillna(0)), [55.0, 65.0, 55.0, 0.0])
+        self.assertEqual(list(samples['hel_train'].fillna(0)), [0.0, 0.0, 50.0, 0.0])
+        # equals values joined layer by layer
+        sjoin_samples = utils.sjoin_noise_values(point_gdf, noise_layers, log).sort_values('xy_id')
+        for name in noise_layers.keys():
+            self.assertEqual(list(samples[name].fillna(0)), list(sjoin_samples[name].fillna(0)))
+
+    def test_noise_raster_lookup(self):
+        noise_gdf = gpd.GeoDataFrame({'hel_road': [55.0, 65.0, 60.0]}, geometry=[
+            Point(25501668.9, 6684943.1).buffer(50),
+            Point(25501700.0, 6684943.1).buffer(20),
+            Point(25501900.0, 6685000.0).buffer(30)
+        ], crs=3879)
+        raster = noise_raster.rasterize_noise_layer(noise_gdf, 'hel_road', 1)
+        self.assertEqual(raster.array.dtype, np.uint8)
+        point_gdf = gpd.GeoDataFrame({'xy_id': [1, 2, 3, 4, 5]}, geometry=[
+            Point(25501668.9, 6684943.1), Point(25501700.0, 6684943.1), Point(25501900.0, 6685000.0),
+            Point(25501800.0, 6685000.0), Point(25500000.0, 6680000.0)
+        ], crs=3879)
+        raster_samples = noise_raster.lookup_noise_values(point_gdf, { 'hel_road': raster })
+        self.assertEqual(list(raster_samples.columns), ['xy_id', 'geometry', 'hel_road'])
+        self.assertEqual(list(raster_samples['hel_road'].fillna(0)), [55.0, 65.0, 60.0, 0.0, 0.0])
+        sjoin_samples = utils.sjoin_noise_values(point_gdf, { 'hel_road': noise_gdf }, log)
+        report = noise_raster.get_raster_validation_report(raster_samples, sjoin_samples, ['hel_road'])
+        self.assertEqual(report['mismatch_count'][0], 0)
+        # cached rasters are read as memory mapped arrays
+        rasters = noise_raster.get_noise_rasters({ 'hel_road': noise_gdf }, 1, 'temp/noise_rasters', log)
+        rasters = noise_raster.get_noise_rasters({ 'hel_road': noise_gdf }, 1, 'temp/noise_rasters', log)
+        self.assertIsInstance(rasters['hel_road'].array, np.memmap)
+        self.assertTrue(np.array_equal(rasters['hel_road'].array, raster.array))
+        # edits to the polygons invalidate the cached raster even if the bounds and values do not change
+        edited_gdf = noise_gdf.copy()
+        edited_gdf.loc[1, 'geometry'] = Point(25501700.0, 6684953.1).buffer(20)
+        self.assertEqual(list(edited_gdf.total_bounds), list(noise_gdf.total_bounds))
+        self.assertNotEqual(noise_raster.get_layer_signature(edited_gdf, 'hel_road'), noise_raster.get_layer_signature(noise_gdf, 'hel_road'))
+        rasters = noise_raster.get_noise_rasters({ 'hel_road': edited_gdf }, 1, 'temp/noise_rasters', log)
+        self.assertTrue(np.array_equal(rasters['hel_road'].array, noise_raster.rasterize_noise_layer(edited_gdf, 'hel_road', 1).array))
+        self.assertFalse(np.array_equal(rasters['hel_road'].array, raster.array))
+        shutil.rmtree('temp/noise_rasters')
+
+    def test_aggregate_noise_values(self):
+        def get_aggregated_noises_by_row(row, prefer_syke: bool) -> tuple:
+            # reference implementation processing one sampling point at a time
+            source_columns = {
+                'road': ['hel_road', 'hel_hway', 'espoo_road', 'espoo_hway', 'syke_road', 'syke_hway'],
+                'train': ['hel_train', 'espoo_train', 'syke_train'],
+                'tram': ['hel_tram', 'syke_tram'],
+                'metro': ['hel_metro', 'syke_metro']
+            }
+            source_values = []
+            for columns in source_columns.values():
+                if prefer_syke:
+                    columns = [col for col in columns if col.startswith('syke')] + [col for col in columns if not col.startswith('syke')]
+                source_values.append(next((row[col] for col in columns if np.isfinite(row[col])), np.nan))
+            finite_values = [value for value in source_values if np.isfinite(value)]
+            if not finite_values:
+                return np.nan, [], np.nan
+            n_max = max(finite_values)
+            sources = [name for name, value in zip(source_columns.keys(), source_values) if value == n_max]
+            return n_max, sources, n_max + (len(sources) if len(sources) > 1 else 0)
+
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        sampling_gdf = utils.get_sampling_point_gdf(ig_utils.get_edge_gdf(graph), 10)
+        layers = [
+            'hel_road', 'hel_hway', 'espoo_road', 'espoo_hway', 'syke_road', 'syke_hway', 'hel_train', 'espoo_train',
+            'syke_train', 'hel_tram', 'syke_tram', 'hel_metro', 'syke_metro'
+        ]
+        rng = np.random.default_rng(1)
+        for layer in layers:
+            # few distinct values and plenty of NaNs to create ties and missing noise sources
+            sampling_gdf[layer] = np.where(rng.random(len(sampling_gdf)) < 0.7, np.nan, rng.choice([45.0, 50.0, 55.0], len(sampling_gdf)))
+
+        for prefer_syke in [False, True]:
+            samples = utils.aggregate_noise_values(sampling_gdf.copy(), prefer_syke=prefer_syke)
+            expected = [get_aggregated_noises_by_row(row, prefer_syke) for _, row in sampling_gdf.iterrows()]
+            self.assertTrue(np.array_equal(samples['n_max'], [n_max for n_max, _, _ in expected], equal_nan=True))
+            self.assertTrue(np.array_equal(samples['n_max_adj'], [n_max_adj for _, _, n_max_adj in expected], equal_nan=True))
+            self.assertEqual([utils.get_noise_source_names(mask) for mask in samples['n_max_sources']], [sources for _, sources, _ in expected])
+            self.assertGreater(len([sources for _, sources, _ in expected if len(sources) > 1]), 0)
+
     def test_get_sampling_points_around_point(self):
         point = Point(25501668.9, 6684943.1)
         sps = utils.get_sampling_points_around(point, 40, count=20)
@@ -73,6 +196,8 @@ class TestNoiseGraphJoin(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         os.remove('temp/test_graph_noises.graphml')
+        os.remove('temp/0_test_noise_join_debug.gpkg')
+        os.remove('temp/1_test_noise_join_debug.gpkg')
 
     # @unittest.skip('run before')
     def test_edge_noise_join(self):
@@ -111,6 +236,36 @@ class TestNoiseGraphJoin(unittest.TestCase):
         noise_sources = dict(Counter(list(edge_noises_df[E.noise_source.name])))
         self.assertDictEqual(noise_sources, {'road': 2322, 'train': 1198, '': 2})
 
+    def test_edge_noise_join_with_shared_debug_exports(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        edge_gdf = ig_utils.get_edge_gdf(graph, attrs=[E.id_ig, E.length])[:400]
+        edge_gdf[E.id_ig.name] = edge_gdf.index
+        minx, miny, maxx, maxy = edge_gdf.total_bounds
+        rng = np.random.default_rng(1)
+        noise_layers = {}
+        for name in [
+            'hel_road', 'hel_hway', 'espoo_road', 'espoo_hway', 'syke_road', 'syke_hway', 'hel_train', 
+            'espoo_train', 'syke_train', 'hel_tram', 'syke_tram', 'hel_metro', 'syke_metro'
+            ]:
+            points = [Point(x, y) for x, y in zip(rng.uniform(minx, maxx, 10), rng.uniform(miny, maxy, 10))]
+            noise_layers[name] = gpd.GeoDataFrame({ name: rng.choice([45.0, 55.0, 65.0], 10) }, geometry=[point.buffer(80) for point in points], crs=3879)
+        nodata_layer = gpd.GeoDataFrame({ 'nodata_zone': [1] }, geometry=[Point(minx, miny).buffer(10)], crs=3879)
+
+        # debug layers of both chunks are written by the same queue
+        with GpkgExportQueue(log) as gpkg_exports:
+            edge_noises = [
+                noise_graph_join.noise_graph_join(
+                    log, gdf, 3, noise_layers, nodata_layer, b_debug=True, 
+                    debug_gpkg=f'temp/{idx}_test_noise_join_debug.gpkg', gpkg_exports=gpkg_exports
+                )
+                for idx, gdf in enumerate([edge_gdf[:200], edge_gdf[200:]])
+            ]
+        for idx, gdf in enumerate([edge_gdf[:200], edge_gdf[200:]]):
+            self.assertIn('final_noise_samples', fiona.listlayers(f'temp/{idx}_test_noise_join_debug.gpkg'))
+            expected = noise_graph_join.noise_graph_join(log, gdf, 3, noise_layers, nodata_layer)
+            self.assertEqual(list(edge_noises[idx][E.id_ig.name]), list(expected[E.id_ig.name]))
+            self.assertEqual(list(edge_noises[idx]['noises']), list(expected['noises']))
+
     def test_noise_graph_update(self):
         in_graph_file = 'data/test_graph.graphml'
         out_graph_file = 'temp/test_graph_noises.graphml'
@@ -163,6 +318,53 @@ class TestNoiseGraphJoin(unittest.TestCase):
             if edge[E.noise_source.value]:
                 self.assertNotEqual(edge[E.noises.value], '')
                 self.assertNotEqual(edge[E.noises.value], None)
-            
+
+        # test setting noises also as noise bins
+        noise_graph_update.set_edge_noise_bins(graph, log)
+        for edge in graph.es:
+            noises = edge[E.noises.value]
+            noise_bins = edge[E.noise_bins.value]
+            self.assertEqual(len(noise_bins), len(ig_utils.noise_bins))
+            if noises is None:
+                self.assertTrue(np.isnan(noise_bins).all())
+            else:
+                self.assertAlmostEqual(float(noise_bins.sum()), sum(noises.values()), 3)
+
+    def test_mean_noise_levels_by_noise_bins(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        data_extent: Polygon = geom_utils.project_geom(gpd.read_file('data/HMA.geojson')['geometry'][0])
+        noise_graph_update.set_default_and_na_edge_noises(graph, data_extent, log)
+        noise_graph_update.noise_graph_update(graph, 'noise_csv/', log)
+        noise_graph_update.set_edge_noise_bins(graph, log)
+        # noises floored to the dB classes of the noise bins, so that only the rounding differs between the two paths
+        graph.es[E.noises.value] = [ig_utils.bins_to_noises(bins) for bins in graph.es[E.noise_bins.value]]
+        edges = [edge for edge in graph.es if edge[E.noises.value] is not None]
+        noise_bins = np.vstack([edge[E.noise_bins.value] for edge in edges])
+        lengths = np.array([edge[E.length.value] for edge in edges])
+
+        get_mean_noise_levels_by_bins = getattr(export_utils, '__get_mean_noise_levels_by_bins')
+        update_db_40_exp = getattr(export_utils, '__update_db_40_exp')
+        get_mean_noise_level = getattr(export_utils, '__get_mean_noise_level')
+        mean_dbs = get_mean_noise_levels_by_bins(noise_bins, lengths)
+        mean_dbs_ref = np.array([
+            get_mean_noise_level(update_db_40_exp(edge[E.noises.value], edge[E.length.value]), edge[E.length.value]) for edge in edges
+        ])
+        # float32 noise bins cause a 0.1 dB difference in the (rounded) mean noise levels of two edges
+        self.assertEqual(len(mean_dbs), 3522)
+        self.assertEqual(int((mean_dbs != mean_dbs_ref).sum()), 2)
+        self.assertAlmostEqual(float(np.abs(mean_dbs - mean_dbs_ref).max()), 0.1, 6)
+
+        # the differences do not change the dB ranges of the GeoJSON features
+        graph.es[E.id_way.value] = list(range(graph.ecount()))
+        graph.es[E.gvi.value] = [0.5] * graph.ecount()
+        db_ranges = [feature['properties']['db'] for feature in export_utils.create_geojson(graph)['features']]
+        del(graph.es[E.noise_bins.value])
+        db_ranges_ref = [feature['properties']['db'] for feature in export_utils.create_geojson(graph)['features']]
+        self.assertListEqual(db_ranges, db_ranges_ref)
+
+        # nodata noise bins and zero length edges raise an error
+        self.assertRaises(ValueError, get_mean_noise_levels_by_bins, np.vstack([noise_bins[:2], ig_utils.noises_to_bins(None)]), np.ones(3))
+        self.assertRaises(ValueError, get_mean_noise_levels_by_bins, noise_bins[:2], np.array([1.0, 0.0]))
+
 if (__name__ == '__main__'):
     unittest.main()
@@ -1,16 +1,25 @@
 import sys
 sys.path.append('..')
 import os
+import json
+import shutil
 import unittest
 from shapely.geometry import LineString, Polygon, Point, GeometryCollection
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import fiona
+import igraph as ig
+import shapely
 import shapely.wkt
+from shapely.affinity import translate
 from pyproj import CRS
 from common.igraph import Node, Edge
-from common.logger import Logger
+from common.logger import Logger, StageProfiler
+from common.gpkg_export import GpkgExportQueue
 import common.igraph as ig_utils
-from otp_graph_import.otp_graph_import import convert_otp_graph_to_igraph
+import common.geometry as geom_utils
+from otp_graph_import.otp_graph_import import convert_otp_graph_to_igraph, get_ig_uv_array, get_edge_components
 
 class TestCreateTestOtpGraphData(unittest.TestCase):
 
@@ -42,6 +51,20 @@ class TestOtp2IgraphImport(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         os.remove('temp/test_graph.graphml')
+        shutil.rmtree('temp/test_graph_arrow')
+        os.remove('temp/test_graph_subset.graphml.gz')
+        os.remove('temp/test_graph_attrs.graphml')
+        os.remove('temp/test_graph.snapshot')
+        os.remove('temp/test_graph_prev.graphml')
+        os.remove('temp/test_graph_prev_shifted.graphml')
+        os.remove('temp/test_edge_diff.csv')
+        os.remove('temp/test_prev_edge_id_map.npy')
+        os.remove('temp/nodes.parquet')
+        os.remove('temp/edges.parquet')
+        os.remove('temp/test_otp2igraph_features.gpkg')
+        os.remove('temp/test_gpkg_export.gpkg')
+        os.remove('temp/test_stage_report.json')
+        os.remove('temp/test_id_mapping.npz')
 
     def test_otp_2_igraph_import(self):
         graph = convert_otp_graph_to_igraph(
@@ -59,6 +82,246 @@ class TestOtp2IgraphImport(unittest.TestCase):
         self.assertEqual(graph.ecount(), 3702)
         self.assertEqual(graph.vcount(), 1328)
     
+    def test_otp_2_igraph_import_equals_test_graph(self):
+        graph = ig_utils.read_graphml('temp/test_graph.graphml')
+        test_graph = ig_utils.read_graphml('data/test_graph.graphml')
+        self.assertEqual(graph.get_edgelist(), test_graph.get_edgelist())
+        for seq, test_seq in [(graph.vs, test_graph.vs), (graph.es, test_graph.es)]:
+            self.assertEqual(sorted(seq.attribute_names()), sorted(test_seq.attribute_names()))
+            for attr in test_seq.attribute_names():
+                if (attr in [Edge.geometry.value, Edge.geom_wgs.value]):
+                    for geom, test_geom in zip(seq[attr], test_seq[attr]):
+                        self.assertTrue(geom.equals_exact(test_geom, 1e-6))
+                elif (attr == Edge.bike_safety_factor.value):
+                    np.testing.assert_allclose(seq[attr], test_seq[attr])
+                else:
+                    self.assertEqual(seq[attr], test_seq[attr])
+
+    def test_get_ig_uv_array(self):
+        node_ids_otp = pd.Series([10, 30, 20])
+        uv = get_ig_uv_array(node_ids_otp, pd.Series([20, 10]), pd.Series([30, 20]))
+        self.assertEqual(uv.tolist(), [[2, 1], [0, 2]])
+        with self.assertRaises(ValueError):
+            get_ig_uv_array(node_ids_otp, pd.Series([20, 40]), pd.Series([30, 20]))
+
+    def test_project_geoms(self):
+        self.assertIs(geom_utils.get_transformer(4326, 3879), geom_utils.get_transformer(4326, 3879))
+        gdf = ig_utils.get_edge_gdf(ig_utils.read_graphml('data/test_graph.graphml'), geom_attr=Edge.geom_wgs, epsg=4326)
+        geoms = geom_utils.project_geoms(gdf[Edge.geom_wgs.name])
+        self.assertEqual(len(geoms), len(gdf))
+        for geom, wgs_geom, projected in zip(geoms, gdf[Edge.geom_wgs.name], gdf.to_crs(epsg=3879)[Edge.geom_wgs.name]):
+            self.assertTrue(geom.equals_exact(geom_utils.project_geom(wgs_geom), 1e-6))
+            self.assertTrue(geom.equals_exact(projected, 1e-6))
+        coords = shapely.get_coordinates(gdf[Edge.geom_wgs.name].values)
+        np.testing.assert_allclose(geom_utils.project_coords(coords), shapely.get_coordinates(geoms))
+
+    def test_get_intersects_mask(self):
+        gdf = ig_utils.get_edge_gdf(ig_utils.read_graphml('data/test_graph.graphml'), attrs=[Edge.id_ig])
+        extent = gdf.unary_union.centroid.buffer(300)
+        gdf.loc[0, Edge.geometry.name] = LineString()
+        expected = [line.is_empty or line.intersects(extent) for line in gdf[Edge.geometry.name]]
+        self.assertTrue(0 < sum(expected) < len(gdf))
+        mask = geom_utils.get_intersects_mask(gdf[Edge.geometry.name], extent)
+        self.assertEqual(mask.tolist(), expected)
+        mask = geom_utils.get_intersects_mask(gdf[Edge.geometry.name], extent, processes=2)
+        self.assertEqual(mask.tolist(), expected)
+
+    def test_get_edge_components(self):
+        graph = ig.Graph(directed=True)
+        graph.add_vertices(6)
+        # a cycle of three nodes, a self-loop, an edge between components and a cycle of two nodes
+        graph.add_edges([(0, 1), (1, 2), (2, 0), (3, 3), (2, 3), (4, 5), (5, 4)])
+        edge_comps, comp_sizes = get_edge_components(graph)
+        self.assertEqual(sorted(comp_sizes.tolist()), sorted(sub.ecount() for sub in graph.decompose(mode='STRONG')))
+        self.assertEqual(edge_comps[4], -1)
+        self.assertEqual(comp_sizes[edge_comps[[0, 3, 5]]].tolist(), [3, 1, 2])
+
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        edge_comps, comp_sizes = get_edge_components(graph)
+        self.assertEqual(sorted(comp_sizes.tolist()), sorted(sub.ecount() for sub in graph.decompose(mode='STRONG')))
+
+    def test_otp_2_igraph_import_with_prev_graph(self):
+        prev_graph = ig_utils.read_graphml('data/test_graph.graphml')
+        prev_graph.es[Edge.gvi.value] = [float(id_ig) for id_ig in range(prev_graph.ecount())]
+        prev_graph.es[5][Edge.geometry.value] = translate(prev_graph.es[5][Edge.geometry.value], xoff=1.0)
+        prev_graph.es[7][Edge.id_otp.value] = 'deleted'
+        ig_utils.export_to_graphml(prev_graph, 'temp/test_graph_prev.graphml')
+
+        graph = convert_otp_graph_to_igraph(
+            node_csv_file = 'data/test_nodes.csv',
+            edge_csv_file = 'data/test_edges.csv',
+            hma_poly_file = 'data/HMA.geojson',
+            igraph_out_file = None,
+            log = Logger(),
+            prev_igraph_file = 'temp/test_graph_prev.graphml',
+            edge_diff_csv_file = 'temp/test_edge_diff.csv',
+            prev_edge_id_map_file = 'temp/test_prev_edge_id_map.npy'
+        )
+        # only new, changed and deleted edges are exported
+        edge_diff = pd.read_csv('temp/test_edge_diff.csv', sep=';')
+        self.assertEqual(dict(edge_diff['status'].value_counts()), { 'changed': 1, 'new': 1, 'deleted': 1 })
+        self.assertEqual(edge_diff.query('status == "changed"')['id_ig'].tolist(), [5])
+        self.assertEqual(edge_diff.query('status == "new"')['id_ig'].tolist(), [7])
+        self.assertEqual(edge_diff.query('status == "deleted"')['id_ig_prev'].tolist(), [7])
+        prev_edge_id_map = np.load('temp/test_prev_edge_id_map.npy')
+        self.assertEqual(len(prev_edge_id_map), prev_graph.ecount())
+        self.assertEqual(prev_edge_id_map[7], -1)
+        self.assertEqual(int((prev_edge_id_map == np.arange(prev_graph.ecount())).sum()), 3701)
+
+        gvis = graph.es[Edge.gvi.value]
+        self.assertEqual([gvis[id_ig] for id_ig in [4, 5, 7, 8]], [4.0, None, None, 8.0])
+
+    def test_otp_2_igraph_import_with_shifted_prev_graph(self):
+        prev_graph = ig_utils.read_graphml('data/test_graph.graphml')
+        # node indexes of the previous graph are shifted (e.g. by an earlier import with more nodes)
+        prev_graph = prev_graph.permute_vertices([(index + 10) % prev_graph.vcount() for index in range(prev_graph.vcount())])
+        prev_graph.es[Edge.uv.value] = prev_graph.get_edgelist()
+        prev_graph.es[Edge.id_way.value] = list(range(prev_graph.ecount()))
+        prev_graph.es[Edge.aqi.value] = [1.5] * prev_graph.ecount()
+        ig_utils.export_to_graphml(prev_graph, 'temp/test_graph_prev_shifted.graphml')
+
+        graph = convert_otp_graph_to_igraph(
+            node_csv_file = 'data/test_nodes.csv',
+            edge_csv_file = 'data/test_edges.csv',
+            hma_poly_file = 'data/HMA.geojson',
+            igraph_out_file = None,
+            log = Logger(),
+            prev_igraph_file = 'temp/test_graph_prev_shifted.graphml'
+        )
+        self.assertEqual(graph.es[Edge.aqi.value], [1.5] * graph.ecount())
+        self.assertNotIn(Edge.id_way.value, graph.es.attribute_names())
+        # uv is recomputed from the new graph instead of copied from the previous one
+        self.assertEqual(graph.es[Edge.uv.value], graph.get_edgelist())
+        self.assertNotEqual(graph.es[Edge.uv.value], prev_graph.es[Edge.uv.value])
+
+    def test_otp_2_igraph_import_by_chunks(self):
+        graph = convert_otp_graph_to_igraph(
+            node_csv_file = 'data/test_nodes.csv',
+            edge_csv_file = 'data/test_edges.csv',
+            hma_poly_file = 'data/HMA.geojson',
+            igraph_out_file = None,
+            log = Logger(),
+            chunk_size = 1000,
+            staging_dir = 'temp'
+        )
+        self.assertTrue(os.path.exists('temp/nodes.parquet'))
+        self.assertTrue(os.path.exists('temp/edges.parquet'))
+        # only the nodes of the staged edges are staged
+        staged_edges = pd.read_parquet('temp/edges.parquet', columns=['node_orig_id', 'node_dest_id'])
+        staged_nodes = pd.read_parquet('temp/nodes.parquet', columns=[Node.id_otp.name])
+        self.assertEqual(sorted(staged_nodes[Node.id_otp.name]), sorted(set(staged_edges['node_orig_id']) | set(staged_edges['node_dest_id'])))
+        test_graph = ig_utils.read_graphml('data/test_graph.graphml')
+        self.assertEqual(graph.get_edgelist(), test_graph.get_edgelist())
+        self.assertEqual([str(id_otp) for id_otp in graph.es[Edge.id_otp.value]], test_graph.es[Edge.id_otp.value])
+        self.assertEqual(graph.es[Edge.length.value], test_graph.es[Edge.length.value])
+        self.assertEqual([str(id_otp) for id_otp in graph.vs[Node.id_otp.value]], test_graph.vs[Node.id_otp.value])
+
+    def test_otp_2_igraph_import_with_debug_exports(self):
+        graph = convert_otp_graph_to_igraph(
+            node_csv_file = 'data/test_nodes.csv',
+            edge_csv_file = 'data/test_edges.csv',
+            hma_poly_file = 'data/HMA.geojson',
+            igraph_out_file = None,
+            b_export_decomposed_igraphs_to_gpkg = True,
+            b_export_final_graph_to_gpkg = True,
+            debug_igraph_gpkg = 'temp/test_otp2igraph_features.gpkg',
+            log = Logger()
+        )
+        self.assertEqual(
+            sorted(fiona.listlayers('temp/test_otp2igraph_features.gpkg')), 
+            ['big_graph_edges', 'final_graph_edges', 'final_graph_nodes', 'medium_graph_edges', 'small_graph_edges']
+        )
+        final_edges = gpd.read_file('temp/test_otp2igraph_features.gpkg', layer='final_graph_edges')
+        self.assertEqual(len(final_edges), graph.ecount())
+
+    def test_gpkg_export_queue(self):
+        gdf = gpd.GeoDataFrame({ 'id': [1, 2] }, geometry=[Point(1, 1), Point(2, 2)], crs=CRS.from_epsg(3879))
+        with GpkgExportQueue() as gpkg_exports:
+            gpkg_exports.export(gdf, 'temp/test_gpkg_export.gpkg', 'points')
+            gdf['id'] = [3, 4]
+            gpkg_exports.export(gdf, 'temp/test_gpkg_export.gpkg', 'points', mode='a')
+        self.assertEqual(gpd.read_file('temp/test_gpkg_export.gpkg', layer='points')['id'].tolist(), [1, 2, 3, 4])
+
+        gpkg_exports = GpkgExportQueue()
+        gpkg_exports.export(gdf, 'temp/no_such_dir/test_gpkg_export.gpkg', 'points')
+        with self.assertRaises(Exception):
+            gpkg_exports.close()
+
+    def test_otp_2_igraph_import_with_stage_report(self):
+        convert_otp_graph_to_igraph(
+            node_csv_file = 'data/test_nodes.csv',
+            edge_csv_file = 'data/test_edges.csv',
+            hma_poly_file = 'data/HMA.geojson',
+            igraph_out_file = None,
+            log = Logger(),
+            stage_report_file = 'temp/test_stage_report.json'
+        )
+        with open('temp/test_stage_report.json') as f:
+            report = json.load(f)
+        stages = { stage['name']: stage for stage in report['stages'] }
+        self.assertEqual(len(stages), 15)
+        self.assertEqual(stages['2) read edges']['rows'], 6314)
+        self.assertEqual(stages['4) filter edges']['rows'], 6032)
+        for stage in stages.values():
+            self.assertGreaterEqual(stage['wall_time_s'], 0)
+            self.assertGreaterEqual(stage['cpu_time_s'], 0)
+
+    def test_stage_profiler(self):
+        stages = StageProfiler()
+        with stages.stage('sum') as stage:
+            stage.rows = len([i for i in range(1000)])
+
+        @stages.profile()
+        def get_range(count: int):
+            return list(range(count))
+
+        self.assertEqual(len(get_range(10)), 10)
+        self.assertEqual([stage.name for stage in stages.stages], ['sum', 'get_range'])
+        self.assertEqual(stages.stages[0].rows, 1000)
+        self.assertIsNotNone(stages.stages[1].wall_time_s)
+
+        stages = StageProfiler(enabled=False)
+        with stages.stage('sum') as stage:
+            stage.rows = 1
+        self.assertEqual(stages.stages, [])
+
+    def test_otp_2_igraph_import_with_id_mapping(self):
+        graph = convert_otp_graph_to_igraph(
+            node_csv_file = 'data/test_nodes.csv',
+            edge_csv_file = 'data/test_edges.csv',
+            hma_poly_file = 'data/HMA.geojson',
+            igraph_out_file = None,
+            log = Logger(),
+            id_mapping_file = 'temp/test_id_mapping.npz'
+        )
+        id_mapping = ig_utils.load_id_mapping('temp/test_id_mapping.npz')
+        self.assertEqual(len(id_mapping.edges), 6032)
+        self.assertEqual(len(id_mapping.nodes), 3420)
+        for id_map, count in [(id_mapping.edges, graph.ecount()), (id_mapping.nodes, graph.vcount())]:
+            # the order of the kept edges and nodes is preserved
+            self.assertEqual(id_map[id_map >= 0].tolist(), list(range(count)))
+
+    def test_reindex_graph(self):
+        graph = ig.Graph(directed=True)
+        graph.add_vertices(4)
+        graph.add_edges([(0, 1), (1, 2), (2, 3), (3, 0)])
+        graph.vs[Node.id_ig.value] = list(range(4))
+        graph.es[Edge.id_ig.value] = list(range(4))
+        graph.delete_edges([1])
+        self.assertEqual(ig_utils.get_id_mismatch_count(graph.es, Edge.id_ig), 2)
+        first = ig_utils.reindex_graph(graph)
+        self.assertEqual(ig_utils.get_id_mismatch_count(graph.es, Edge.id_ig), 0)
+        self.assertEqual(first.edges.tolist(), [0, -1, 1, 2])
+        self.assertEqual(first.nodes.tolist(), [0, 1, 2, 3])
+        graph.delete_vertices([1])
+        second = ig_utils.reindex_graph(graph)
+        self.assertEqual(graph.vs[Node.id_ig.value], [0, 1, 2])
+        self.assertEqual(second.edges.tolist(), [-1, 0, 1])
+        combined = ig_utils.combine_id_mappings(first, second)
+        self.assertEqual(combined.edges.tolist(), [-1, -1, 0, 1])
+        self.assertEqual(combined.nodes.tolist(), [0, -1, 1, 2])
+        self.assertEqual(ig_utils.remap_ids(combined.edges, [3, 2, 0, 7]).tolist(), [1, 0, -1, -1])
+
     def test_read_igraph(self):
         graph = ig_utils.read_graphml('temp/test_graph.graphml', log=Logger(printing=True))
         self.assertEqual(graph.ecount(), 3702)
@@ -117,6 +380,217 @@ class TestOtp2IgraphImport(unittest.TestCase):
             geom_attr=Edge.geometry)
         gdf['geom_length'] = [geom.length for geom in gdf[Edge.geometry.name]]
         self.assertAlmostEqual(gdf['geom_length'].mean(), 31.65, 2)
+        # test read to DataFrame without geometry
+        df = ig_utils.get_edge_gdf(
+            graph, 
+            attrs=[Edge.id_ig, Edge.length], 
+            ig_attrs=['source', 'target'], 
+            geom_attr=None)
+        self.assertNotIsInstance(df, gpd.GeoDataFrame)
+        self.assertListEqual(list(df.columns), [Edge.id_ig.name, Edge.length.name, 'source', 'target'])
+        self.assertListEqual(list(zip(df['source'], df['target'])), graph.get_edgelist())
+        self.assertListEqual(list(df[Edge.id_ig.name]), list(df.index))
+
+    def test_export_selected_attributes_to_graphml_gz(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        ig_utils.export_to_graphml(
+            graph, 
+            'temp/test_graph_subset.graphml.gz', 
+            n_attrs=[Node.id_ig, Node.geometry], 
+            e_attrs=[Edge.id_ig, Edge.geometry, Edge.length])
+        # the exported graph must not be mutated
+        self.assertIn(Edge.bike_safety_factor.value, graph.es.attribute_names())
+        graph_subset = ig_utils.read_graphml('temp/test_graph_subset.graphml.gz')
+        self.assertListEqual(graph_subset.get_edgelist(), graph.get_edgelist())
+        self.assertListEqual(graph_subset.vs.attribute_names(), [Node.id_ig.value, Node.geometry.value])
+        self.assertListEqual(graph_subset.es.attribute_names(), [Edge.id_ig.value, Edge.geometry.value, Edge.length.value])
+        for attr in graph_subset.es.attribute_names():
+            self.assertListEqual([str(v) for v in graph_subset.es[attr]], [str(v) for v in graph.es[attr]])
+
+    def test_export_graph_attributes_to_graphml(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        graph['name'] = 'kumpula & <test>'
+        graph['version'] = 2
+        ig_utils.export_to_graphml(graph, 'temp/test_graph_attrs.graphml', e_attrs=[Edge.id_ig])
+        exported = ig_utils.read_graphml('temp/test_graph_attrs.graphml')
+        self.assertEqual(sorted(exported.attributes()), ['name', 'version'])
+        self.assertEqual(exported['name'], 'kumpula & <test>')
+        self.assertEqual(exported['version'], '2')
+        self.assertListEqual(exported.get_edgelist(), graph.get_edgelist())
+
+    def test_export_and_load_graph_snapshot(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        graph.es[Edge.noises.value] = [None if e.index == 0 else {45: 2.5, 52: 1.0, 77: 1.0} for e in graph.es]
+        ig_utils.export_graph_snapshot(graph, 'temp/test_graph.snapshot', e_attrs=[Edge.length, Edge.noises, Edge.geometry])
+        snapshot = ig_utils.load_graph_snapshot('temp/test_graph.snapshot')
+        self.assertEqual(snapshot['ecount'], 3702)
+        self.assertEqual(snapshot['vcount'], 1328)
+        arrays = snapshot['arrays']
+        self.assertIsInstance(arrays['e_l'], np.memmap)
+        self.assertListEqual(arrays['e_l'].tolist(), graph.es[Edge.length.value])
+        self.assertListEqual([tuple(uv) for uv in arrays['edges'].tolist()], graph.get_edgelist())
+        self.assertEqual(arrays['e_n_bins'].shape, (3702, len(ig_utils.noise_bins)))
+        self.assertNotIn('e_bsf', arrays)
+
+        graph_snapshot = ig_utils.read_graph_snapshot('temp/test_graph.snapshot')
+        self.assertListEqual(graph_snapshot.get_edgelist(), graph.get_edgelist())
+        self.assertEqual(graph_snapshot.es[0][Edge.noises.value], None)
+        self.assertDictEqual(graph_snapshot.es[1][Edge.noises.value], {45: 2.5, 50: 1.0, 75: 1.0})
+        self.assertListEqual(
+            [geom.wkt for geom in graph_snapshot.es[Edge.geometry.value]], 
+            [geom.wkt for geom in graph.es[Edge.geometry.value]])
+        self.assertListEqual(
+            [geom.wkt for geom in graph_snapshot.vs[Node.geometry.value]], 
+            [geom.wkt for geom in graph.vs[Node.geometry.value]])
+
+    def test_graph_snapshot_with_missing_values(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        attrs = [Edge.id_ig, Edge.length, Edge.is_stairs]
+        for attr in attrs:
+            graph.es[attr.value] = [None if e.index in (0, 5) else value for e, value in zip(graph.es, graph.es[attr.value])]
+        ig_utils.export_graph_snapshot(graph, 'temp/test_graph_missing.snapshot', e_attrs=attrs + [Edge.allows_biking])
+        arrays = ig_utils.load_graph_snapshot('temp/test_graph_missing.snapshot')['arrays']
+        self.assertListEqual(np.flatnonzero(~arrays['e_ii_valid']).tolist(), [0, 5])
+        self.assertNotIn('e_b_ab_valid', arrays)
+        graph_snapshot = ig_utils.read_graph_snapshot('temp/test_graph_missing.snapshot')
+        os.remove('temp/test_graph_missing.snapshot')
+        for attr in attrs + [Edge.allows_biking]:
+            self.assertListEqual(graph_snapshot.es[attr.value], graph.es[attr.value])
+        self.assertIsNone(graph_snapshot.es[0][Edge.is_stairs.value])
+        self.assertIsInstance(graph_snapshot.es[1][Edge.id_ig.value], int)
+
+    def test_geometry_buffers(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        geoms = [geom.wkt for geom in graph.es[Edge.geometry.value]]
+        geoms_wgs = [geom.wkt for geom in graph.es[Edge.geom_wgs.value]]
+        geom_buffers = ig_utils.get_geometry_buffers(graph)
+        self.assertNotIn(Edge.geometry.value, graph.es.attribute_names())
+        self.assertNotIn(Edge.geom_wgs.value, graph.es.attribute_names())
+        self.assertEqual(len(geom_buffers[Edge.geometry].offsets), 3703)
+        self.assertEqual(geom_buffers[Edge.geometry].coords.dtype, np.float64)
+        self.assertEqual(ig_utils.get_buffer_geom(geom_buffers[Edge.geometry], 10).wkt, geoms[10])
+        self.assertListEqual([geom.wkt for geom in ig_utils.get_buffer_geoms(geom_buffers[Edge.geom_wgs])], geoms_wgs)
+        self.assertListEqual(
+            [geom.wkt for geom in ig_utils.get_buffer_geoms(geom_buffers[Edge.geometry], [20, 3, 20])], 
+            [geoms[20], geoms[3], geoms[20]])
+        gdf = ig_utils.get_edge_gdf(graph, attrs=[Edge.id_ig], geom_buffers=geom_buffers)
+        self.assertListEqual([geom.wkt for geom in gdf[Edge.geometry.name]], geoms)
+        ig_utils.set_buffer_geoms(graph, geom_buffers)
+        self.assertListEqual([geom.wkt for geom in graph.es[Edge.geometry.value]], geoms)
+
+    def test_read_graphml_with_cache(self):
+        cache_dir = 'temp/graph_cache'
+        graph = ig_utils.read_graphml('data/test_graph.graphml', cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        graph_cached = ig_utils.read_graphml('data/test_graph.graphml', cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertListEqual(graph_cached.get_edgelist(), graph.get_edgelist())
+        for attr in graph.es.attribute_names():
+            self.assertListEqual([str(v) for v in graph_cached.es[attr]], [str(v) for v in graph.es[attr]])
+        # raw geometries are kept when writing the cache and the flag is a part of the cache key
+        graph_raw = ig_utils.read_graphml('data/test_graph.graphml', decode_geoms=False, cache_dir=cache_dir)
+        self.assertIsInstance(graph_raw.es[0][Edge.geometry.value], str)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        graph_raw_cached = ig_utils.read_graphml('data/test_graph.graphml', decode_geoms=False, cache_dir=cache_dir)
+        self.assertIsInstance(graph_raw_cached.es[0][Edge.geometry.value], bytes)
+        self.assertListEqual(
+            [geom.wkt for geom in ig_utils.get_edge_gdf(graph_raw_cached)[Edge.geometry.name]], 
+            [geom.wkt for geom in graph.es[Edge.geometry.value]])
+        # different attributes are cached to a different entry and older entries are evicted by the size limit
+        graph_cached = ig_utils.read_graphml('data/test_graph.graphml', e_attrs=[Edge.id_ig], cache_dir=cache_dir, cache_size_limit_mb=0)
+        self.assertListEqual(graph_cached.es.attribute_names(), [Edge.id_ig.value])
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(ig_utils.clear_graph_cache(cache_dir, 'data/HMA.geojson'), 0)
+        self.assertEqual(ig_utils.clear_graph_cache(cache_dir, 'data/test_graph.graphml'), 1)
+        self.assertEqual(len(os.listdir(cache_dir)), 0)
+        os.rmdir(cache_dir)
+
+    def test_export_and_read_graph_arrow(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        ig_utils.export_graph_arrow(graph, 'temp/test_graph_arrow')
+        graph_arrow = ig_utils.read_graph_arrow('temp/test_graph_arrow', log=Logger(printing=True))
+        self.assertEqual(graph_arrow.ecount(), 3702)
+        self.assertEqual(graph_arrow.vcount(), 1328)
+        self.assertEqual(graph_arrow.is_directed(), graph.is_directed())
+        self.assertListEqual(graph_arrow.get_edgelist(), graph.get_edgelist())
+        self.assertListEqual(graph_arrow.vs.attribute_names(), graph.vs.attribute_names())
+        self.assertListEqual(graph_arrow.es.attribute_names(), graph.es.attribute_names())
+        # compare values as text since some of the values are NaN
+        for attr in graph.vs.attribute_names():
+            self.assertListEqual([str(v) for v in graph_arrow.vs[attr]], [str(v) for v in graph.vs[attr]])
+        for attr in graph.es.attribute_names():
+            self.assertListEqual([str(v) for v in graph_arrow.es[attr]], [str(v) for v in graph.es[attr]])
+        # node and edge tables can be read as GeoDataFrames
+        gdf = gpd.read_parquet('temp/test_graph_arrow/edges.parquet')
+        self.assertEqual(len(gdf), 3702)
+        self.assertEqual(gdf.crs.to_epsg(), 3879)
+
+
+class TestIgraphAttributeDecoding(unittest.TestCase):
+
+    def test_bulk_converters(self):
+        self.assertListEqual(ig_utils.to_noises_list(['{45: 13.2, 50: 22.1}', '{}', 'None']), [{45: 13.2, 50: 22.1}, {}, None])
+        self.assertListEqual(ig_utils.to_noise_sources_list(["{'road': 3, 'train': 6}", '{}']), [{'road': 3, 'train': 6}, {}])
+        self.assertListEqual(ig_utils.to_uv_list(['(1, 2)', 'None']), [(1, 2), None])
+        self.assertListEqual(ig_utils.to_bool_list(['True', 'False', 'None']), [True, False, None])
+        self.assertListEqual(ig_utils.to_int_list(['1', 'None']), [1, None])
+        self.assertListEqual(ig_utils.to_float_list(['1.5', '2']), [1.5, 2.0])
+        # invalid values raise ValueError, on which read_graphml falls back to the per-value converters
+        self.assertRaises(ValueError, ig_utils.to_int_list, ['1', '1.5'])
+        self.assertRaises(ValueError, ig_utils.to_bool_list, ['True', '1'])
+
+    def test_noise_bin_conversions(self):
+        bins = ig_utils.noises_to_bins({45: 13.5, 47: 1.0, 50: 2.25, 80: 1.0})
+        self.assertEqual(bins.dtype, np.float32)
+        self.assertListEqual(bins.tolist(), [0.0, 14.5, 2.25, 0.0, 0.0, 0.0, 0.0, 1.0])
+        self.assertDictEqual(ig_utils.bins_to_noises(bins), {45: 14.5, 50: 2.25, 75: 1.0})
+        self.assertDictEqual(ig_utils.bins_to_noises(ig_utils.noises_to_bins({})), {})
+        self.assertIsNone(ig_utils.bins_to_noises(ig_utils.noises_to_bins(None)))
+        matrix = ig_utils.get_noise_bin_matrix([{60: 1.5}, None])
+        self.assertEqual(matrix.shape, (2, len(ig_utils.noise_bins)))
+        self.assertEqual(matrix[0][4], 1.5)
+        self.assertTrue(np.isnan(matrix[1]).all())
+
+    def test_noise_bins_io(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml')
+        noises = [None if e.index == 0 else {} if e.index == 1 else {45: 13.2, 55: 0.25} for e in graph.es]
+        graph.es[Edge.noise_bins.value] = list(ig_utils.get_noise_bin_matrix(noises))
+        ig_utils.export_to_graphml(graph, 'temp/test_graph_noise_bins.graphml', e_attrs=[Edge.id_ig, Edge.noise_bins])
+        ig_utils.export_graph_arrow(graph, 'temp/test_graph_noise_bins', e_attrs=[Edge.id_ig, Edge.noise_bins])
+        graph_graphml = ig_utils.read_graphml('temp/test_graph_noise_bins.graphml')
+        graph_arrow = ig_utils.read_graph_arrow('temp/test_graph_noise_bins')
+        os.remove('temp/test_graph_noise_bins.graphml')
+        shutil.rmtree('temp/test_graph_noise_bins')
+        for g in [graph_graphml, graph_arrow]:
+            self.assertEqual(g.es[2][Edge.noise_bins.value].dtype, np.float32)
+            self.assertListEqual([ig_utils.bins_to_noises(bins) for bins in g.es[Edge.noise_bins.value]], noises)
+
+    def test_bulk_decode_equals_per_value_decode(self):
+        graph = ig_utils.read_graphml('data/test_graph.graphml', bulk_decode=True)
+        graph_ref = ig_utils.read_graphml('data/test_graph.graphml', bulk_decode=False)
+        self.assertListEqual(graph.vs.attribute_names(), graph_ref.vs.attribute_names())
+        self.assertListEqual(graph.es.attribute_names(), graph_ref.es.attribute_names())
+        for attr in graph.vs.attribute_names():
+            self.assertListEqual([str(v) for v in graph.vs[attr]], [str(v) for v in graph_ref.vs[attr]])
+        for attr in graph.es.attribute_names():
+            self.assertListEqual([str(v) for v in graph.es[attr]], [str(v) for v in graph_ref.es[attr]])
+            self.assertListEqual([type(v) for v in graph.es[attr]], [type(v) for v in graph_ref.es[attr]])
+
+    def test_read_selected_attributes_with_raw_geoms(self):
+        graph = ig_utils.read_graphml(
+            'data/test_graph.graphml', 
+            n_attrs=[Node.id_ig], 
+            e_attrs=[Edge.id_ig, Edge.geometry], 
+            decode_geoms=False)
+        self.assertEqual(graph.ecount(), 3702)
+        self.assertListEqual(graph.vs.attribute_names(), [Node.id_ig.value])
+        self.assertListEqual(graph.es.attribute_names(), [Edge.id_ig.value, Edge.geometry.value])
+        self.assertIsInstance(graph.es[0][Edge.geometry.value], str)
+        # geometries are decoded on first access
+        gdf = ig_utils.get_edge_gdf(graph, attrs=[Edge.id_ig])
+        self.assertEqual(len(gdf), 3702)
+        self.assertIsInstance(gdf[Edge.geometry.name][0], LineString)
+        self.assertIsInstance(graph.es[0][Edge.geometry.value], LineString)
 
 
 if (__name__ == '__main__'):